@@ -0,0 +1,258 @@
+""" Approximate top-K recommendation with an inverted file (IVF) index over the item embeddings """
+
+# python ann.py tmp/export_ml_10m -k 50 --nprobe 1 2 4 8 16
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from embeddings import BilinearScorer, load_train_ratings
+from topk import TopKRecommender, softmax
+
+
+def kmeans(x, num_clusters, num_iters=20, seed=1234):
+    """
+    Plain Lloyd's k-means with numpy.
+    :return: centroids (num_clusters x dim) and cluster assignment of every row of x
+    """
+
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], num_clusters, replace=False)].copy()
+    x_sq = np.sum(x ** 2, axis=1, keepdims=True)
+
+    assignments = np.zeros(x.shape[0], dtype=np.int64)
+    for _ in range(num_iters):
+        distances = x_sq - 2. * np.dot(x, centroids.T) + np.sum(centroids ** 2, axis=1)
+        assignments = np.argmin(distances, axis=1)
+
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+
+        # empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    return centroids, assignments
+
+
+class IVFIndex(object):
+    """
+    Inverted file index for maximum inner product search (MIPS).
+    Vectors are augmented with sqrt(M^2 - |v|^2), with M the largest norm, which turns
+    MIPS into nearest neighbour search (Bachrach et al., 2014). The augmented vectors are
+    clustered with k-means, and a query only scans the items in the nprobe lists whose
+    centroids have the largest inner product with it.
+    """
+
+    def __init__(self, vectors, num_lists=None, num_iters=20, seed=1234):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        num_vectors = vectors.shape[0]
+        if num_lists is None:
+            num_lists = max(1, int(np.sqrt(num_vectors)))
+        num_lists = min(num_lists, num_vectors)
+
+        norms_sq = np.sum(vectors ** 2, axis=1)
+        augmented = np.hstack([vectors, np.sqrt(norms_sq.max() - norms_sq)[:, None]])
+
+        centroids, assignments = kmeans(augmented, num_lists, num_iters=num_iters, seed=seed)
+
+        order = np.argsort(assignments, kind='stable')
+        self.vectors = vectors
+        self.centroids = centroids[:, :-1]
+        self.list_items = order
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=num_lists))])
+        self.num_lists = num_lists
+
+    def probe(self, queries, nprobe):
+        """ Indices of the nprobe lists to scan for every query, num_queries x nprobe. """
+        nprobe = min(nprobe, self.num_lists)
+        list_scores = np.dot(queries, self.centroids.T)
+        if nprobe == self.num_lists:
+            return np.tile(np.arange(self.num_lists), (queries.shape[0], 1))
+        return np.argpartition(-list_scores, nprobe - 1, axis=1)[:, :nprobe]
+
+    def candidates(self, lists):
+        """ All items in the given lists. """
+        return np.concatenate([self.list_items[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+
+    def search(self, query, k, nprobe):
+        """ Approximate top-k items by inner product with a single query vector. """
+
+        items = self.candidates(self.probe(query[None, :], nprobe)[0])
+        if items.size > k:
+            scores = np.dot(self.vectors[items], query)
+            items = items[np.argpartition(-scores, k - 1)[:k]]
+        return items
+
+
+class ANNRecommender(object):
+    """
+    Approximate top-K recommender for the BilinearMixture decoder.
+    Every basis score u^T Q_s v is an inner product between the projected user u^T Q_s
+    and the item v, so any linear combination of basis scores is an inner product with
+    q = sum_s w_s u^T Q_s. The weights w_s come from a first-order expansion of the
+    ranking score (expected rating or class probability) around the mean item of the
+    user. Candidates retrieved with q from the IVF index are re-ranked with the exact
+    decoder.
+
+    Recall vs. latency is controlled by nprobe (number of scanned lists) and
+    num_candidates (number of items that are re-ranked exactly).
+    """
+
+    def __init__(self, scorer, rated=None, num_lists=None, num_iters=20, score='expected', class_index=None,
+                 seed=1234):
+        assert score in ('expected', 'class'), 'score can only be expected or class'
+        if score == 'class':
+            assert class_index is not None, 'class_index is required to rank by class probability'
+
+        self.scorer = scorer
+        self.rated = rated.tocsr() if rated is not None else None
+        self.score = score
+        self.class_index = class_index
+
+        # mean item embedding, the point around which the ranking score is linearized
+        self.v_mean = np.asarray(scorer.v_embeddings).mean(axis=0)
+
+        self.index = IVFIndex(np.asarray(scorer.v_embeddings), num_lists=num_lists, num_iters=num_iters, seed=seed)
+
+    def query_weights(self, u_projected):
+        """
+        Per-user weights w_s of the basis scores: gradient of the ranking score w.r.t. the
+        basis scores at the basis scores of the mean item, num_users x num_weights.
+        """
+
+        probs = softmax(np.dot(np.dot(u_projected, self.v_mean), self.scorer.scalars), axis=1)
+        if self.score == 'expected':
+            expected = np.dot(probs, self.scorer.class_values)
+            logit_grads = probs * (self.scorer.class_values[None, :] - expected[:, None])
+        else:
+            logit_grads = -probs * probs[:, self.class_index:self.class_index + 1]
+            logit_grads[:, self.class_index] += probs[:, self.class_index]
+        return np.dot(logit_grads, self.scorer.scalars.T)
+
+    def query_vectors(self, users):
+        """ Inner product queries of the users, num_users x hidden. """
+        u = np.asarray(self.scorer.u_embeddings[users])
+        u_projected = self.scorer.project_users(u)
+        return np.einsum('nkd,nk->nd', u_projected, self.query_weights(u_projected))
+
+    def exact_scores(self, users, items):
+        """ Ranking scores of the given (user, item) pairs with the exact decoder. """
+        probs = softmax(self.scorer.logits(users, items), axis=1)
+        if self.score == 'expected':
+            return np.dot(probs, self.scorer.class_values)
+        return probs[:, self.class_index]
+
+    def recommend(self, users, k=50, nprobe=8, num_candidates=None):
+        """
+        Approximate top-k items for every user in users.
+        :return: items (num_users x k) and scores (num_users x k), sorted by decreasing score.
+            Rows are padded with item -1 and score -inf if fewer than k candidates are found.
+        """
+
+        users = np.asarray(users)
+        if num_candidates is None:
+            num_candidates = 4 * k
+
+        queries = self.query_vectors(users)
+        lists = self.index.probe(queries, nprobe)
+
+        all_items = np.full((len(users), k), -1, dtype=np.int64)
+        all_scores = np.full((len(users), k), -np.inf, dtype=np.float32)
+
+        for row, user in enumerate(users):
+            items = self.index.candidates(lists[row])
+
+            if self.rated is not None:
+                rated = self.rated.indices[self.rated.indptr[user]:self.rated.indptr[user + 1]]
+                items = items[~np.isin(items, rated)]
+
+            if items.size > num_candidates:
+                ip = np.dot(self.index.vectors[items], queries[row])
+                items = items[np.argpartition(-ip, num_candidates - 1)[:num_candidates]]
+
+            if items.size == 0:
+                continue
+
+            scores = self.exact_scores(np.full(items.size, user), items)
+            top = np.argsort(-scores, kind='stable')[:k]
+            all_items[row, :top.size] = items[top]
+            all_scores[row, :top.size] = scores[top]
+
+        return all_items, all_scores
+
+
+def benchmark(ann, exact, users, k=50, nprobes=(1, 2, 4, 8, 16), num_candidates=None):
+    """
+    Recall@k of the approximate recommender against the exact one, and the mean latency
+    per user of both, for every value of nprobe.
+    :return: list of dicts, one per nprobe
+    """
+
+    t = time.time()
+    exact_items, _ = exact.recommend(users, k=k)
+    exact_latency = (time.time() - t) / len(users)
+
+    results = []
+    for nprobe in nprobes:
+        t = time.time()
+        ann_items, _ = ann.recommend(users, k=k, nprobe=nprobe, num_candidates=num_candidates)
+        ann_latency = (time.time() - t) / len(users)
+
+        hits = [np.intersect1d(a[a >= 0], e).size for a, e in zip(ann_items, exact_items)]
+        recall = np.sum(hits) / float(exact_items.size)
+
+        results.append({'nprobe': nprobe, 'recall': recall,
+                        'ann_latency': ann_latency, 'exact_latency': exact_latency})
+    return results
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("export_dir", type=str,
+                    help="Directory with the exported embeddings and decoder weights.")
+
+    ap.add_argument("-k", "--top_k", type=int, default=50,
+                    help="Number of recommended items per user.")
+
+    ap.add_argument("-nl", "--num_lists", type=int, default=None,
+                    help="Number of IVF lists (default: sqrt(number of items)).")
+
+    ap.add_argument("-np", "--nprobe", type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                    help="Numbers of scanned IVF lists to benchmark.")
+
+    ap.add_argument("-nc", "--num_candidates", type=int, default=None,
+                    help="Number of candidates re-ranked with the exact decoder (default: 4 * top_k).")
+
+    ap.add_argument("-nu", "--num_users", type=int, default=1000,
+                    help="Number of randomly sampled users to benchmark on.")
+
+    ap.add_argument("-s", "--seed", type=int, default=1234,
+                    help="Seed for the user sample and the k-means initialization.")
+
+    args = vars(ap.parse_args())
+
+    scorer = BilinearScorer(args['export_dir'])
+    rated = load_train_ratings(args['export_dir'])
+
+    t = time.time()
+    ann = ANNRecommender(scorer, rated=rated, num_lists=args['num_lists'], seed=args['seed'])
+    print('IVF index with %d lists built in %.2f s' % (ann.index.num_lists, time.time() - t))
+
+    # single thread and one user per block, to compare per-request latencies
+    exact = TopKRecommender(scorer, rated=rated, user_block=1, num_threads=1)
+
+    rng = np.random.RandomState(args['seed'])
+    users = rng.choice(scorer.num_users, min(args['num_users'], scorer.num_users), replace=False)
+
+    for result in benchmark(ann, exact, users, k=args['top_k'], nprobes=args['nprobe'],
+                            num_candidates=args['num_candidates']):
+        print("[*] nprobe=", '%3d' % result['nprobe'],
+              "recall@%d=" % args['top_k'], "{:.4f}".format(result['recall']),
+              "ann_latency=", "{:.6f}".format(result['ann_latency']),
+              "exact_latency=", "{:.6f}".format(result['exact_latency']))
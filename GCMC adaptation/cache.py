@@ -0,0 +1,230 @@
+""" Bounded caches of per-user decoder state for skewed serving traffic """
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import heapq
+import threading
+
+import numpy as np
+
+from topk import softmax
+
+
+class BoundedCache(object):
+    """
+    Dict with at most capacity entries and lru (least recently used) or lfu (least
+    frequently used) eviction, with hit, miss, eviction and invalidation counters.
+    Not thread-safe, see HotUserCache.
+    """
+
+    def __init__(self, capacity, policy='lru'):
+        assert policy in ('lru', 'lfu'), 'policy can only be lru or lfu'
+        self.capacity = capacity
+        self.policy = policy
+
+        self.entries = collections.OrderedDict()
+        self.counts = {}
+        self.heap = []  # (count, tick, key), stale entries are skipped on eviction
+        self.tick = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _touch(self, key):
+        if self.policy == 'lru':
+            self.entries.move_to_end(key)
+        else:
+            self.counts[key] += 1
+            self.tick += 1
+            heapq.heappush(self.heap, (self.counts[key], self.tick, key))
+            if len(self.heap) > 4 * max(self.capacity, 1):
+                # drop the stale entries, one per entry and count
+                self.heap = [(count, self.tick, key) for key, count in self.counts.items()]
+                heapq.heapify(self.heap)
+
+    def _evict(self):
+        if self.policy == 'lru':
+            self.entries.popitem(last=False)
+        else:
+            while True:
+                count, _, key = heapq.heappop(self.heap)
+                if self.counts.get(key) == count:
+                    break
+            del self.entries[key]
+            del self.counts[key]
+        self.evictions += 1
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        if key in self.entries:
+            self.entries[key] = value
+            self._touch(key)
+            return
+        if len(self.entries) >= self.capacity:
+            self._evict()
+        self.entries[key] = value
+        if self.policy == 'lfu':
+            self.counts[key] = 0
+            self._touch(key)
+
+    def pop(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.counts.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.counts.clear()
+        self.heap = []
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
+class HotUserCache(object):
+    """
+    Caches the per-basis projections u^T Q_s of the BilinearMixture decoder and the top-K
+    lists of frequently requested users, so that repeated requests of the same users skip
+    the projection (score requests) or the scan over the item catalog (top-K requests).
+    A cached top-K list of length k also serves requests for fewer items.
+
+    Entries of a user are invalidated when the user's embedding changes (EmbeddingRefresher
+    does so in add_ratings when it is given the cache), and everything is dropped when a new embedding
+    version is exported (meta version of the export, see sync). Top-K lists that contain
+    a refreshed item are dropped as well. An item whose score rose after a refresh only
+    enters the cached lists of other users once they are invalidated or evicted.
+    """
+
+    def __init__(self, scorer, recommender=None, capacity=10000, topk_capacity=None, policy='lru'):
+        """
+        :param capacity: maximum number of cached user projections
+        :param topk_capacity: maximum number of cached top-K lists (default: capacity)
+        :param policy: eviction policy, lru or lfu
+        """
+        self.scorer = scorer
+        self.recommender = recommender
+        self.version = scorer.meta.get('version')
+
+        self.projections = BoundedCache(capacity, policy)
+        self.topk = BoundedCache(capacity if topk_capacity is None else topk_capacity, policy)
+        self.lock = threading.Lock()
+
+    def projected(self, users):
+        """ u^T Q_s of the given users, n x num_weights x hidden, computing only the misses. """
+
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        unique, inverse = np.unique(users, return_inverse=True)
+        projected = np.empty((len(unique), self.scorer.num_weights, self.scorer.hidden), dtype=np.float32)
+
+        with self.lock:
+            cached = [self.projections.get(u) for u in unique.tolist()]
+        missing = np.array([i for i, p in enumerate(cached) if p is None], dtype=np.int64)
+        for i, p in enumerate(cached):
+            if p is not None:
+                projected[i] = p
+
+        if len(missing):
+            projected[missing] = self.scorer.project_users(np.asarray(self.scorer.u_embeddings[unique[missing]]))
+            with self.lock:
+                for i in missing.tolist():
+                    self.projections.put(int(unique[i]), projected[i])
+
+        return projected[inverse]
+
+    def predict(self, users, items):
+        """ Expected ratings of the given pairs, as BilinearScorer.predict. """
+
+        v = np.asarray(self.scorer.v_embeddings[np.asarray(items)])
+        basis_scores = np.einsum('nkd,nd->nk', self.projected(users), v)
+        probs = softmax(np.dot(basis_scores, self.scorer.scalars), axis=1)
+        return np.dot(probs, self.scorer.class_values)
+
+    def recommend(self, users, k=50):
+        """ Top-k items and scores of the given users, as TopKRecommender.recommend. """
+
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        k = min(k, self.scorer.num_items)
+        items = np.empty((len(users), k), dtype=np.int64)
+        scores = np.empty((len(users), k), dtype=np.float32)
+
+        with self.lock:
+            cached = [self.topk.get(u) for u in users.tolist()]
+
+        missing = []
+        for i, entry in enumerate(cached):
+            if entry is not None and entry[0].shape[0] >= k:
+                items[i], scores[i] = entry[0][:k], entry[1][:k]
+            else:
+                missing.append(i)
+
+        if missing:
+            missing = np.array(missing, dtype=np.int64)
+            # duplicates within a request are scored once
+            unique, inverse = np.unique(users[missing], return_inverse=True)
+            new_items, new_scores = self.recommender.recommend(unique, k=k)
+            items[missing], scores[missing] = new_items[inverse], new_scores[inverse]
+            with self.lock:
+                for u, u_items, u_scores in zip(unique.tolist(), new_items, new_scores):
+                    self.topk.put(u, (u_items, u_scores))
+
+        return items, scores
+
+    def invalidate(self, users=None, items=None):
+        """ Drops the entries of users whose embeddings changed, and the top-K lists that contain changed items. """
+
+        with self.lock:
+            for u in np.asarray(users if users is not None else [], dtype=np.int64).tolist():
+                self.projections.pop(u)
+                self.topk.pop(u)
+
+            if items is not None and len(items):
+                items = np.asarray(items, dtype=np.int64)
+                stale = [u for u, (u_items, _) in self.topk.entries.items() if np.isin(u_items, items).any()]
+                for u in stale:
+                    self.topk.pop(u)
+
+    def sync(self, scorer, recommender=None):
+        """ Switches to the scorer of a (possibly) new export, and drops all entries if its version differs. """
+
+        with self.lock:
+            version = scorer.meta.get('version')
+            if version != self.version:
+                self.projections.clear()
+                self.topk.clear()
+            self.scorer = scorer
+            self.recommender = recommender
+            self.version = version
+
+    def summary(self):
+        with self.lock:
+            return {'version': self.version,
+                    'projections': self.projections.summary(),
+                    'topk': self.topk.summary()}
@@ -0,0 +1,228 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+RUNS_DIR = 'tmp/runs'
+INDEX = 'checkpoints.json'
+
+
+def default_run_dir(model_name, dataset, root=RUNS_DIR):
+    """ Per-run checkpoint directory, unique across parallel runs. """
+    return os.path.join(root, '%s_%s_%s_%d' % (model_name, dataset, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+
+class CheckpointManager(object):
+    """
+    Versioned checkpoints of all global variables (including the Adam slots and the EMA
+    shadow variables) in a per-run directory, with periodic and best-validation checkpoints
+    and retention limits.
+
+    A checkpoint is an in-memory snapshot of the variable values taken with a single
+    sess.run, which is written to disk (.npz, renamed into place once complete) by a
+    background thread, so the training loop only pays for the snapshot. At most one best
+    checkpoint waits to be written at any time, a better one replaces it. Likewise at most
+    one periodic checkpoint waits: if the writer falls behind, a newer one replaces it
+    (counted in dropped) instead of blocking the training loop.
+    """
+
+    def __init__(self, sess, model, run_dir, keep_last=3, keep_best=1):
+        self.sess = sess
+        self.model = model
+        self.run_dir = run_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+
+        self.variables = tf.global_variables()
+        self.names = [v.op.name for v in self.variables]
+
+        # assign ops to load snapshots back, without tf.train.Saver and its file format
+        with tf.name_scope('checkpoint_restore'):
+            self.placeholders = {}
+            self.assign_ops = {}
+            for v in self.variables:
+                placeholder = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                self.placeholders[v.op.name] = placeholder
+                self.assign_ops[v.op.name] = v.assign(placeholder)
+
+        self.checkpoints = []  # (step, path) of the periodic checkpoints, oldest first
+        self.best_checkpoints = []  # (score, step, path) of the best checkpoints, best first
+
+        self._lock = threading.Lock()
+        self._pending_best = None
+        self._pending_periodic = None
+        self.dropped = 0
+        # 'best' and 'periodic' jobs only point to the pending snapshots, at most one of each is queued
+        self._jobs = queue.Queue()
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def snapshot(self):
+        """ Current values of all variables, as a dict from variable name to array. """
+        return dict(zip(self.names, self.sess.run(self.variables)))
+
+    def _write_loop(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if job == 'best':
+                    with self._lock:
+                        pending, self._pending_best = self._pending_best, None
+                    if pending is not None:
+                        self._write_best(*pending)
+                elif job == 'periodic':
+                    with self._lock:
+                        pending, self._pending_periodic = self._pending_periodic, None
+                    if pending is not None:
+                        self._write_periodic(*pending)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _write(self, path, values):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **values)
+        os.rename(tmp_path, path)
+
+    def _write_periodic(self, step, values):
+        path = os.path.join(self.run_dir, 'ckpt-%08d.npz' % step)
+        self._write(path, values)
+
+        self.checkpoints.append((step, path))
+        while len(self.checkpoints) > self.keep_last:
+            _, old_path = self.checkpoints.pop(0)
+            os.remove(old_path)
+        self._write_index()
+
+    def _write_best(self, step, score, values):
+        if len(self.best_checkpoints) >= self.keep_best and score >= self.best_checkpoints[-1][0]:
+            return
+
+        path = os.path.join(self.run_dir, 'best-%08d.npz' % step)
+        self._write(path, values)
+
+        self.best_checkpoints.append((score, step, path))
+        self.best_checkpoints.sort()
+        while len(self.best_checkpoints) > self.keep_best:
+            _, _, old_path = self.best_checkpoints.pop()
+            os.remove(old_path)
+        self._write_index()
+
+    def _write_index(self):
+        index = {'checkpoints': [{'step': step, 'path': path} for step, path in self.checkpoints],
+                 'best': [{'step': step, 'score': float(score), 'path': path}
+                          for score, step, path in self.best_checkpoints]}
+        with open(os.path.join(self.run_dir, INDEX), 'w') as f:
+            json.dump(index, f, indent=2)
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, step, wait=False):
+        """
+        Periodic checkpoint at step. Returns the snapshot, which can be passed to restore.
+        The oldest checkpoints beyond keep_last are deleted. Never blocks on the writer
+        (unless wait is set): a periodic checkpoint that is still waiting to be written is
+        replaced by this one.
+        """
+
+        self._check_error()
+        values = self.snapshot()
+        with self._lock:
+            schedule = self._pending_periodic is None
+            if not schedule:
+                self.dropped += 1
+            self._pending_periodic = (step, values)
+        if schedule:
+            self._jobs.put('periodic')
+        if wait:
+            self.wait()
+        return values
+
+    def save_best(self, step, score, values=None):
+        """
+        Best-validation checkpoint, kept if score (lower is better) is among the keep_best best.
+        values is the snapshot that was validated, if it was taken earlier (asynchronous validation).
+        """
+
+        self._check_error()
+        with self._lock:
+            pending = self._pending_best
+        if pending is not None and score >= pending[1]:
+            return
+        if len(self.best_checkpoints) >= self.keep_best and score >= self.best_checkpoints[-1][0]:
+            return
+
+        if values is None:
+            values = self.snapshot()
+        with self._lock:
+            schedule = self._pending_best is None
+            self._pending_best = (step, score, values)
+        if schedule:
+            self._jobs.put('best')
+
+    def wait(self):
+        """ Blocks until all scheduled checkpoints are on disk. """
+        self._jobs.join()
+        self._check_error()
+
+    def close(self):
+        self.wait()
+        self._jobs.put(None)
+        self._writer.join()
+
+    def latest(self):
+        """ Path of the latest periodic checkpoint, or None. """
+        return self.checkpoints[-1][1] if self.checkpoints else None
+
+    def best(self):
+        """ Path of the best checkpoint, or None. """
+        return self.best_checkpoints[0][2] if self.best_checkpoints else None
+
+    def restore(self, checkpoint, polyak=False):
+        """
+        Loads a checkpoint (path or snapshot) into the session. With polyak set, the trainable
+        variables are loaded with their exponential moving averages instead.
+        """
+
+        if isinstance(checkpoint, dict):
+            values = checkpoint
+        else:
+            with np.load(checkpoint) as f:
+                values = {name: f[name] for name in f.files}
+
+        if polyak:
+            # same mapping as tf.train.Saver(variable_averages.variables_to_restore())
+            mapping = {name: v.op.name for name, v in self.model.variable_averages.variables_to_restore().items()}
+        else:
+            mapping = {name: name for name in self.names}
+
+        feed_dict = {}
+        ops = []
+        for source, target in mapping.items():
+            if source in values and target in self.assign_ops:
+                feed_dict[self.placeholders[target]] = values[source]
+                ops.append(self.assign_ops[target])
+        self.sess.run(ops, feed_dict=feed_dict)
@@ -0,0 +1,158 @@
+""" Inductive embeddings for new users and items from their side features and a few ratings """
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from embeddings import ENCODER, META
+
+
+class ColdStartEncoder(object):
+    """
+    Embeds users and items that were not part of the training graph with the trained
+    encoder weights, so that they can be scored with the BilinearScorer without retraining.
+    The graph convolution of a new node aggregates the first layer weights of its rated
+    neighbours (node id input features, so x_j W is row j of W) with the same c_ij
+    normalization as the training supports, the side features go through the side feature
+    layer, and both are combined by the Dense layer. All new nodes of a call are embedded
+    in a single pass with one sparse matmul per rating class.
+
+    Requires an export with adj_train of a model with a single stack or sum graph
+    convolution layer, see embeddings.export_embeddings. With more layers the embedding
+    of a new node also depends on the hidden activations of its neighbours.
+    """
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, META)) as f:
+            meta = json.load(f)
+
+        assert meta.get('encoder') is not None, 'no encoder weights in %s, export with adj_train' % export_dir
+        assert meta['encoder']['num_layers'] == 1, 'cold-start embeddings need a single graph convolution layer'
+
+        self.meta = meta['encoder']
+        self.num_users = meta['num_users']
+        self.num_items = meta['num_items']
+        self.num_classes = meta['num_classes']
+        self.accum = self.meta['accum']
+        self.num_support = self.meta['num_support']
+        self.symmetric = self.meta['symmetric']
+        self.side_features = self.meta['side_features']
+        self.num_user_side_features = self.meta['num_user_side_features']
+
+        weights = np.load(os.path.join(export_dir, ENCODER))
+        self.weights = {key: weights[key] for key in weights.files}
+
+        # node id input features: the first num_users rows of the first layer weights belong to
+        # the users, the others to the items. Users aggregate over items and vice versa.
+        num_users = self.num_users
+        self.neighbour_weights = {'user': self._rows(self.weights['gcn_weights_v_0'], num_users, None),
+                                  'item': self._rows(self.weights['gcn_weights_u_0'], 0, num_users)}
+        self.neighbour_degrees = {'user': self.weights['item_degrees'],
+                                  'item': self.weights['user_degrees']}
+
+    def _rows(self, weights, start, end):
+        if self.accum == 'stack':
+            return weights[start:end]
+        return weights[:, start:end]
+
+    def _support(self, nodes, neighbours, classes, num_nodes, node_type):
+        """ Normalized num_nodes x num_neighbours adjacency of the new nodes for every rating class. """
+
+        num_neighbours = self.neighbour_degrees[node_type].shape[0]
+        degrees = np.bincount(nodes, minlength=num_nodes).astype(np.float32)
+        # degrees of the neighbours as if the new edges were part of the training graph
+        neighbour_degrees = self.neighbour_degrees[node_type] + np.bincount(neighbours, minlength=num_neighbours)
+
+        if self.symmetric:
+            values = 1. / np.sqrt(degrees[nodes] * neighbour_degrees[neighbours])
+        else:
+            values = 1. / degrees[nodes]
+
+        return [sp.csr_matrix((values[classes == c], (nodes[classes == c], neighbours[classes == c])),
+                              shape=(num_nodes, num_neighbours))
+                for c in range(self.num_classes)]
+
+    def _graph_convolution(self, support, node_type):
+        weights = self.neighbour_weights[node_type]
+
+        if self.accum == 'stack':
+            # weights are split along the output dimension, one slice per support
+            split = weights.shape[1] // self.num_support
+            z = np.zeros((support[0].shape[0], weights.shape[1]), dtype=np.float32)
+            for c in range(self.num_classes):
+                z[:, c * split:(c + 1) * split] = support[c].dot(weights[:, c * split:(c + 1) * split])
+        else:
+            # ordinal weight sharing: class c uses W_0 + ... + W_c, so W_s is aggregated over
+            # all edges with class >= s
+            z = np.zeros((support[0].shape[0], weights.shape[2]), dtype=np.float32)
+            support_geq = support[-1]
+            for c in reversed(range(self.num_classes)):
+                if c < self.num_classes - 1:
+                    support_geq = support_geq + support[c]
+                z += support_geq.dot(weights[c])
+
+        return np.maximum(z, 0.)
+
+    def _side_hidden(self, side_features, node_type):
+        side_features = np.asarray(side_features, dtype=np.float32)
+
+        # row normalization as in preprocessing.normalize_features
+        row_sums = side_features.sum(axis=1, keepdims=True)
+        row_sums[row_sums == 0.] = np.inf
+        side_features = side_features / row_sums
+
+        # user and item side features occupy disjoint columns of the side feature layer input
+        d = self.num_user_side_features
+        if node_type == 'user':
+            hidden = np.dot(side_features, self.weights['side_weights_u'][:d])
+            return np.maximum(hidden, 0.) + self.weights['side_bias_u']
+        hidden = np.dot(side_features, self.weights['side_weights_v'][d:])
+        return np.maximum(hidden, 0.) + self.weights['side_bias_v']
+
+    def _embed(self, num_nodes, nodes, neighbours, classes, side_features, node_type):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        neighbours = np.asarray(neighbours, dtype=np.int64)
+        classes = np.asarray(classes, dtype=np.int64)
+
+        if nodes.size and (classes.min() < 0 or classes.max() >= self.num_classes):
+            raise ValueError('rating classes must be in [0, %d)' % self.num_classes)
+
+        hidden = self._graph_convolution(self._support(nodes, neighbours, classes, num_nodes, node_type),
+                                         node_type)
+
+        if self.side_features:
+            if side_features is None:
+                raise ValueError('the model was trained with side features, side_features are required')
+            hidden = np.hstack([hidden, self._side_hidden(side_features, node_type)])
+
+        suffix = 'u' if node_type == 'user' else 'v'
+        return np.dot(hidden, self.weights['dense_weights_' + suffix])
+
+    def embed_users(self, num_new_users, users, items, classes, side_features=None):
+        """
+        Embeddings of new users.
+        :param num_new_users: number of new users, they are indexed 0 ... num_new_users - 1
+        :param users: new user index of every rating
+        :param items: (existing) item of every rating
+        :param classes: rating class of every rating, i.e. index into class_values
+        :param side_features: num_new_users x num raw user side features, for side feature models
+        :return: num_new_users x hidden embeddings, to be scored against the exported item embeddings
+        """
+        return self._embed(num_new_users, users, items, classes, side_features, 'user')
+
+    def embed_items(self, num_new_items, items, users, classes, side_features=None):
+        """
+        Embeddings of new items.
+        :param num_new_items: number of new items, they are indexed 0 ... num_new_items - 1
+        :param items: new item index of every rating
+        :param users: (existing) user of every rating
+        :param classes: rating class of every rating, i.e. index into class_values
+        :param side_features: num_new_items x num raw item side features, for side feature models
+        :return: num_new_items x hidden embeddings, to be scored against the exported user embeddings
+        """
+        return self._embed(num_new_items, items, users, classes, side_features, 'item')
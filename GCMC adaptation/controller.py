@@ -0,0 +1,88 @@
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+class TrainingController(object):
+    """
+    Patience-based early stopping and plateau learning rate decay on the validation score
+    (lower is better), with an optional restore of the best checkpoint at the end.
+
+    update is called with every validation result. When the score has not improved by
+    more than min_delta for lr_patience validations, the learning rate is divided by
+    decay_rate (down to min_lr) through the learning rate assign op of the trainer. After
+    patience validations without improvement, update returns True and training stops.
+    patience and lr_patience of 0 disable early stopping and learning rate decay.
+    """
+
+    def __init__(self, sess, model, learning_rate, patience=0, lr_patience=0, decay_rate=1.25, min_lr=0.,
+                 min_delta=0., restore_best=False, assign_op=None, assign_placeholder=None, verbose=True):
+        self.sess = sess
+        self.learning_rate = learning_rate
+        self.patience = patience
+        self.lr_patience = lr_patience
+        self.decay_rate = decay_rate
+        self.min_lr = min_lr
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        self.verbose = verbose
+
+        if assign_op is None:
+            assign_placeholder = tf.placeholder(tf.float32)
+            assign_op = model.learning_rate.assign(assign_placeholder)
+        self.assign_op = assign_op
+        self.assign_placeholder = assign_placeholder
+
+        self.best_score = float('inf')
+        self.best_step = None
+        self.wait = 0  # validations since the last improvement
+        self.plateau = 0  # validations since the last improvement or learning rate decay
+        self.stopped_step = None
+
+    def update(self, step, score):
+        """ Records the validation score of step. Returns True if training should stop. """
+
+        if score < self.best_score - self.min_delta:
+            self.best_score = score
+            self.best_step = step
+            self.wait = 0
+            self.plateau = 0
+            return False
+
+        self.wait += 1
+        self.plateau += 1
+
+        if self.lr_patience > 0 and self.plateau >= self.lr_patience and self.learning_rate > self.min_lr:
+            self.learning_rate = max(self.learning_rate / self.decay_rate, self.min_lr)
+            self.sess.run(self.assign_op, feed_dict={self.assign_placeholder: self.learning_rate})
+            self.plateau = 0
+            if self.verbose:
+                print('New learning rate is {}'.format(self.learning_rate))
+
+        if self.patience > 0 and self.wait >= self.patience:
+            self.stopped_step = step
+            if self.verbose:
+                print('Early stopping at {}, best validation score {} at {}'.format(step, self.best_score,
+                                                                                   self.best_step))
+            return True
+
+        return False
+
+    def finish(self, checkpoints, step):
+        """
+        Saves the final checkpoint at step and, with restore_best, loads the best checkpoint
+        into the session instead. Returns the checkpoint the model ends up with, to restore
+        its Polyak averages from.
+        """
+
+        final_checkpoint = checkpoints.save(step, wait=True)
+        if self.restore_best:
+            checkpoints.wait()
+            best = checkpoints.best()
+            if best is not None:
+                checkpoints.restore(best)
+                if self.verbose:
+                    print('Restored the best checkpoint {}'.format(best))
+                return best
+        return final_checkpoint
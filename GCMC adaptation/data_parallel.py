@@ -0,0 +1,645 @@
+""" Synchronous data-parallel minibatch training with several worker processes on one host """
+
+# python data_parallel.py -d ml_10m -np 8 -bs 10000 -e 20 -t
+# python data_parallel.py -d ml_1m -np 8 --scaling
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+
+from preprocessing import create_trainvaltest_split, load_data_monti, \
+    sparse_to_tuple, preprocess_user_item_features, globally_normalize_bipartite_adjacency
+from model import RecommenderGAE
+from utils import construct_feed_dict
+from resident import ResidentInputs
+from minibatch import MinibatchBuilder, BatchProducer
+from checkpoints import CheckpointManager, default_run_dir
+from polyak import PolyakAverages
+from telemetry import Telemetry, batch_edges
+from execution import ExecutionProfile, session_config, available_cpus, apply_cpu_affinity
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _context():
+    # the workers inherit the shared buffers, and build their graphs after the fork
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+class SharedArray(object):
+    """ numpy array in shared memory (RawArray), inherited by forked worker processes. """
+
+    _TYPECODES = {np.dtype(np.float32): 'f', np.dtype(np.float64): 'd',
+                  np.dtype(np.int32): 'i', np.dtype(np.int64): 'q'}
+
+    def __init__(self, ctx, array):
+        array = np.ascontiguousarray(array)
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.raw = ctx.RawArray(self._TYPECODES[self.dtype], max(array.size, 1))
+        self.array()[...] = array
+
+    def array(self):
+        """ numpy view of the shared buffer, no copy. """
+        return np.frombuffer(self.raw, dtype=self.dtype, count=int(np.prod(self.shape))).reshape(self.shape)
+
+
+class SharedCSR(object):
+    """ scipy CSR matrix with its data, indices and indptr in shared memory. """
+
+    def __init__(self, ctx, matrix):
+        matrix = sp.csr_matrix(matrix)
+        self.shape = matrix.shape
+        self.data = SharedArray(ctx, matrix.data)
+        self.indices = SharedArray(ctx, matrix.indices)
+        self.indptr = SharedArray(ctx, matrix.indptr)
+
+    def matrix(self):
+        return sp.csr_matrix((self.data.array(), self.indices.array(), self.indptr.array()), shape=self.shape,
+                             copy=False)
+
+
+class GradientAllreduce(object):
+    """
+    Averages the flat gradient vectors of num_workers processes in shared memory.
+
+    Every worker writes its gradients to its row of a num_workers x size buffer. After a
+    barrier, worker k averages the k-th slice of the columns into the result buffer
+    (reduce-scatter), and after a second barrier all workers read the complete average
+    (allgather). The result stays valid until the next allreduce, whose first barrier is only
+    passed once every worker is done with it.
+    """
+
+    def __init__(self, ctx, num_workers, size, timeout=None):
+        self.num_workers = num_workers
+        self.size = size
+        self.timeout = timeout
+        self._grads = ctx.RawArray('f', num_workers * size)
+        self._mean = ctx.RawArray('f', size)
+        self._barrier = ctx.Barrier(num_workers)
+        self.bounds = np.linspace(0, size, num_workers + 1).astype(np.int64)
+
+    def _views(self):
+        grads = np.frombuffer(self._grads, dtype=np.float32).reshape(self.num_workers, self.size)
+        mean = np.frombuffer(self._mean, dtype=np.float32)
+        return grads, mean
+
+    def wait(self):
+        self._barrier.wait(self.timeout)
+
+    def allreduce(self, rank, grads):
+        """ :return: the average of the grads of all workers (a view of the shared result buffer) """
+        all_grads, mean = self._views()
+        all_grads[rank] = grads
+        self.wait()
+        start, end = self.bounds[rank], self.bounds[rank + 1]
+        mean[start:end] = all_grads[:, start:end].mean(axis=0)
+        self.wait()
+        return mean
+
+    def broadcast(self, rank, values=None, root=0):
+        """ :return: the values of root, e.g. its initial parameters """
+        _, mean = self._views()
+        if rank == root:
+            mean[:] = values
+        self.wait()
+        return mean
+
+    def abort(self):
+        """ Breaks the barrier, so that the other workers fail instead of waiting forever. """
+        self._barrier.abort()
+
+
+def load_training_data(dataset, data_seed, testing, symmetric=True):
+    """
+    Training pairs, validation and test pairs and the hstacked, globally normalized
+    supports of a dataset, as in train_mini_batch.py.
+    """
+
+    if dataset == 'ml_1m' or dataset == 'ml_100k' or dataset == 'douban':
+        num_classes = 5
+    elif dataset == 'ml_10m' or dataset == 'flixster':
+        num_classes = 10
+    elif dataset == 'yahoo_music':
+        num_classes = 71
+    else:
+        raise ValueError('Invalid choice of dataset: %s' % dataset)
+
+    if dataset == 'flixster' or dataset == 'douban' or dataset == 'yahoo_music':
+        splits = load_data_monti(dataset, testing)
+    else:
+        if dataset == 'ml_100k':
+            datasplit_path = 'data/' + dataset + '/nofeatures.pickle'
+        else:
+            datasplit_path = 'data/' + dataset + '/split_seed' + str(data_seed) + '.pickle'
+        splits = create_trainvaltest_split(dataset, data_seed, testing, datasplit_path, True, True)
+
+    _, _, adj_train, train_labels, train_u_indices, train_v_indices, \
+        val_labels, val_u_indices, val_v_indices, test_labels, \
+        test_u_indices, test_v_indices, class_values = splits
+
+    num_users, num_items = adj_train.shape
+    u_features, v_features = preprocess_user_item_features(sp.identity(num_users, format='csr'),
+                                                           sp.identity(num_items, format='csr'))
+
+    support = []
+    support_t = []
+    adj_train_int = sp.csr_matrix(adj_train, dtype=np.int32)
+    for i in range(num_classes):
+        support_unnormalized = sp.csr_matrix(adj_train_int == i + 1, dtype=np.float32)
+        support.append(support_unnormalized)
+        support_t.append(support_unnormalized.T)
+
+    support = globally_normalize_bipartite_adjacency(support, symmetric=symmetric)
+    support_t = globally_normalize_bipartite_adjacency(support_t, symmetric=symmetric)
+
+    return {'num_classes': num_classes,
+            'num_support': len(support),
+            'num_users': num_users,
+            'num_items': num_items,
+            'u_features': u_features,
+            'v_features': v_features,
+            'support': sp.hstack(support, format='csr'),
+            'support_t': sp.hstack(support_t, format='csr'),
+            'train': (train_u_indices, train_v_indices, train_labels),
+            'val': (val_u_indices, val_v_indices, val_labels),
+            'test': (test_u_indices, test_v_indices, test_labels),
+            'class_values': class_values}
+
+
+def build_worker_graph(data, settings):
+    """
+    Builds the RecommenderGAE of a worker in the default graph, with ops that compute its
+    gradients as one flat vector and apply an averaged flat gradient vector with the Adam
+    optimizer (and the Polyak averages) of the model.
+    """
+
+    u_features = data['u_features']
+    class_values = data['class_values']
+
+    resident = ResidentInputs()
+    placeholders = {
+        'u_features': resident.sparse('u_features'),
+        'v_features': resident.sparse('v_features'),
+        'u_features_nonzero': resident.dense('u_features_nonzero', tf.int32),
+        'v_features_nonzero': resident.dense('v_features_nonzero', tf.int32),
+        'class_values': resident.dense('class_values', tf.float32, class_values.shape),
+
+        'labels': tf.placeholder(tf.int32, shape=(None,)),
+        'user_indices': tf.placeholder(tf.int32, shape=(None,)),
+        'item_indices': tf.placeholder(tf.int32, shape=(None,)),
+        'dropout': tf.placeholder_with_default(0., shape=()),
+
+        'support': tf.sparse_placeholder(tf.float32, shape=(None, None)),
+        'support_t': tf.sparse_placeholder(tf.float32, shape=(None, None)),
+
+        'E_start_list': [],
+        'E_end_list': [],
+    }
+
+    model = RecommenderGAE(placeholders,
+                           input_dim=u_features.shape[1],
+                           num_classes=data['num_classes'],
+                           num_support=data['num_support'],
+                           num_basis_functions=settings['num_basis_functions'],
+                           hidden=settings['hidden'],
+                           num_users=data['num_users'],
+                           num_items=data['num_items'],
+                           accum=settings['accumulation'],
+                           num_layers=settings['num_layers'],
+                           learning_rate=settings['learning_rate'],
+                           logging=False)
+
+    variables = tf.trainable_variables()
+    sizes = [v.get_shape().num_elements() for v in variables]
+    grads = tf.gradients(model.loss, variables)
+    flat_grads = tf.concat([tf.reshape(tf.convert_to_tensor(g) if g is not None else tf.zeros_like(v), [-1])
+                            for g, v in zip(grads, variables)], axis=0)
+
+    # the optimizer of the model, so that the Adam slots and the global step are shared with it
+    mean_grads = tf.placeholder(tf.float32, shape=(sum(sizes),))
+    apply_op = model.optimizer.apply_gradients(
+        [(tf.reshape(g, v.get_shape()), v) for g, v in zip(tf.split(mean_grads, sizes), variables)],
+        global_step=model.global_step)
+    with tf.control_dependencies([apply_op]):
+        step_op = tf.group(model.variables_averages_op)
+
+    flat_values = tf.concat([tf.reshape(v, [-1]) for v in variables], axis=0)
+    values = tf.placeholder(tf.float32, shape=(sum(sizes),))
+    assign_op = tf.group(*[tf.assign(v, tf.reshape(x, v.get_shape()))
+                           for x, v in zip(tf.split(values, sizes), variables)])
+
+    return {'model': model,
+            'polyak': PolyakAverages(model),
+            'placeholders': placeholders,
+            'resident': resident,
+            'num_parameters': sum(sizes),
+            'flat_grads': flat_grads,
+            'mean_grads': mean_grads,
+            'step_op': step_op,
+            'flat_values': flat_values,
+            'values': values,
+            'assign_op': assign_op}
+
+
+def _feed_dict(graph, data, batch, dropout):
+    """ feed_dict of a subgraph built by MinibatchBuilder, without the resident inputs """
+    feed_dict = construct_feed_dict(graph['placeholders'], None, None, None, None, batch['support'],
+                                    batch['support_t'], batch['labels'], batch['u_indices'], batch['v_indices'],
+                                    data['class_values'], dropout)
+    return graph['resident'].strip(feed_dict)
+
+
+def _load_resident(sess, graph, data):
+    u_features = sparse_to_tuple(data['u_features'])
+    v_features = sparse_to_tuple(data['v_features'])
+    placeholders = graph['placeholders']
+    graph['resident'].load(sess, {placeholders['u_features']: u_features,
+                                  placeholders['v_features']: v_features,
+                                  placeholders['u_features_nonzero']: u_features[1].shape[0],
+                                  placeholders['v_features_nonzero']: v_features[1].shape[0],
+                                  placeholders['class_values']: data['class_values']})
+
+
+def _worker(rank, num_workers, data, shared, settings, allreduce, results):
+    try:
+        profile = settings['profiles'][rank]
+        apply_cpu_affinity(profile)
+
+        # graph structures and training pairs from shared memory, no copies per worker
+        support = shared['support'].matrix()
+        support_t = shared['support_t'].matrix()
+        u_indices, v_indices, labels = (shared[key].array() for key in ('train_u', 'train_v', 'train_labels'))
+        shard = shared['shards'].array()[rank]
+
+        # same initial parameters on all workers through the broadcast below, different dropout
+        np.random.seed(settings['seed'] + rank)
+        tf.set_random_seed(settings['seed'] + rank)
+        graph = build_worker_graph(data, settings)
+        model = graph['model']
+
+        sess = tf.Session(config=session_config(profile=profile))
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+
+        _load_resident(sess, graph, data)
+
+        builder = MinibatchBuilder(support, support_t)
+        if rank == 0 and settings['validate']:
+            val_feed_dict = _feed_dict(graph, data, builder.build(*data['val']), 0.)
+        else:
+            val_feed_dict = None
+
+        values = allreduce.broadcast(rank, sess.run(graph['flat_values']) if rank == 0 else None)
+        if rank != 0:
+            # only the Polyak averages of worker 0 are saved, those of the others may differ
+            sess.run(graph['assign_op'], feed_dict={graph['values']: values})
+
+        if rank == 0 and settings['validate']:
+            checkpoints = CheckpointManager(sess, model, settings['run_dir'], keep_last=1)
+        else:
+            checkpoints = None
+
+        # one telemetry file per worker, the allreduce time is recorded next to the phases
+        telemetry_path = None
+        if settings['telemetry']:
+            telemetry_path = os.path.join(settings['run_dir'], 'telemetry_%d_of_%d.jsonl' % (rank, num_workers))
+        telemetry = Telemetry(telemetry_path, settings=dict(settings, rank=rank))
+
+        batch_size = settings['batch_size'] // num_workers
+        producer = BatchProducer(builder, u_indices[shard], v_indices[shard], labels[shard], batch_size,
+                                 settings['epochs'], num_workers=settings['num_workers'],
+                                 prefetch=settings['prefetch'])
+
+        stats = {'compute_time': 0., 'allreduce_time': 0., 'steps': 0}
+        warmup = settings['warmup_steps']
+        best_val_rmse = np.inf
+        t_start = None
+        t_batch = time.time()
+
+        for epoch, batch_iter, batch in producer:
+            if stats['steps'] == warmup:
+                t_start = time.time()
+
+            record = telemetry.step(stats['steps'], epoch=epoch, build_time=batch.get('build_time'))
+            record.add('batch', time.time() - t_batch)
+
+            t = time.time()
+            feed_dict = _feed_dict(graph, data, batch, settings['dropout'])
+            t_feed = time.time()
+            grads, train_loss, train_rmse = sess.run([graph['flat_grads'], model.loss, model.rmse],
+                                                     feed_dict=feed_dict)
+            t_grads = time.time()
+            mean_grads = allreduce.allreduce(rank, grads)
+            t_reduced = time.time()
+            sess.run(graph['step_op'], feed_dict={graph['mean_grads']: mean_grads})
+
+            record.add('feed', t_feed - t)
+            record.add('train', (t_grads - t_feed) + (time.time() - t_reduced))
+            record.add('allreduce', t_reduced - t_grads)
+            record.count(edges=batch_edges(batch), pairs=len(batch['labels']))
+
+            if stats['steps'] >= warmup:
+                stats['compute_time'] += (t_grads - t) + (time.time() - t_reduced)
+                stats['allreduce_time'] += t_reduced - t_grads
+            stats['steps'] += 1
+
+            if val_feed_dict is not None and batch_iter == producer.num_batches - 1:
+                with record.time('eval'):
+                    val_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+                print('[*] Epoch: %04d' % epoch, 'step: %05d' % stats['steps'],
+                      'train_loss=', '{:.5f}'.format(train_loss), 'train_rmse=', '{:.5f}'.format(train_rmse),
+                      'val_loss=', '{:.5f}'.format(val_loss), 'val_rmse=', '{:.5f}'.format(val_rmse))
+                if val_rmse < best_val_rmse:
+                    best_val_rmse = val_rmse
+                    checkpoints.save_best(stats['steps'], val_rmse)
+
+            telemetry.write(record)
+            t_batch = time.time()
+
+            if settings['max_steps'] and stats['steps'] >= settings['max_steps']:
+                break
+
+        producer.close()
+        # all workers finish the last step before worker 0 reports
+        allreduce.wait()
+
+        timed_steps = max(stats['steps'] - warmup, 0)
+        stats['step_time'] = stats['pairs_per_sec'] = float('nan')
+        if t_start is not None and timed_steps > 0:
+            elapsed = time.time() - t_start
+            stats['step_time'] = elapsed / timed_steps
+            stats['pairs_per_sec'] = batch_size * num_workers * timed_steps / elapsed
+        stats['compute_time'] /= max(timed_steps, 1)
+        stats['allreduce_time'] /= max(timed_steps, 1)
+
+        if checkpoints is not None:
+            checkpoints.save(stats['steps'], wait=True)
+            split = 'test' if settings['testing'] else 'val'
+            feed_dict = _feed_dict(graph, data, builder.build(*data[split]), 0.)
+            _, rmse, _, polyak_rmse = graph['polyak'].evaluate(sess, feed_dict)
+            stats['%s_rmse' % split] = float(rmse)
+            stats['polyak_%s_rmse' % split] = float(polyak_rmse)
+            stats['best_val_rmse'] = float(best_val_rmse)
+            stats['run_dir'] = checkpoints.run_dir
+            checkpoints.close()
+
+        telemetry.close(pairs_per_sec=stats['pairs_per_sec'], allreduce_time=stats['allreduce_time'])
+        if telemetry_path is not None:
+            stats['telemetry'] = telemetry_path
+
+        sess.close()
+        results.put((rank, stats))
+
+    except Exception:
+        allreduce.abort()
+        results.put((rank, {'error': traceback.format_exc()}))
+        raise
+
+
+def worker_profiles(num_workers, pin_cpus=False):
+    """ One ExecutionProfile per worker, with its share of the available CPUs. """
+    cpus = available_cpus()
+    per_worker = max(len(cpus) // num_workers, 1)
+    profiles = []
+    for rank in range(num_workers):
+        worker_cpus = tuple(cpus[(rank * per_worker) % len(cpus):][:per_worker]) if pin_cpus else None
+        profiles.append(ExecutionProfile(per_worker, min(2, per_worker), worker_cpus))
+    return profiles
+
+
+def _collect_results(results, workers, allreduce, poll_interval=1.):
+    """
+    Results of all workers as a dict from rank to stats. Polls the queue, so that a worker
+    that dies without a result (e.g. killed by the OOM killer) raises RuntimeError instead
+    of blocking the parent forever. The remaining workers are stopped then.
+    """
+
+    stats = {}
+    while len(stats) < len(workers):
+        try:
+            rank, worker_stats = results.get(timeout=poll_interval)
+            stats[rank] = worker_stats
+            continue
+        except queue.Empty:
+            pass
+
+        dead = [rank for rank, worker in enumerate(workers) if worker.exitcode is not None and rank not in stats]
+        if not dead:
+            continue
+        # results put right before the worker exited
+        try:
+            while True:
+                rank, worker_stats = results.get_nowait()
+                stats[rank] = worker_stats
+        except queue.Empty:
+            pass
+        dead = [rank for rank in dead if rank not in stats]
+        if dead:
+            allreduce.abort()
+            for worker in workers:
+                if worker.exitcode is None:
+                    worker.terminate()
+            raise RuntimeError('Data-parallel worker %d exited with code %d without a result'
+                               % (dead[0], workers[dead[0]].exitcode))
+    return stats
+
+
+def train_data_parallel(data, settings, num_workers):
+    """
+    Trains on num_workers forked worker processes. The training pairs are split into
+    num_workers shards of equal size, every step each worker computes the gradients of a
+    minibatch of batch_size / num_workers pairs of its shard, and all workers apply the
+    same averaged gradients, so they keep identical parameters.
+    :return: statistics of the run as reported by worker 0, with the mean allreduce time
+        over all workers
+    """
+
+    ctx = _context()
+    settings = dict(settings, profiles=worker_profiles(num_workers, settings['pin_cpus']))
+
+    # only for the number of parameters and the model name, the workers build their own graphs
+    with tf.Graph().as_default():
+        graph = build_worker_graph(data, settings)
+        num_parameters = graph['num_parameters']
+        model_name = graph['model'].name
+
+    # one run directory for the checkpoints of worker 0 and the telemetry of all workers
+    if settings['run_dir'] is None and (settings['validate'] or settings['telemetry']):
+        settings['run_dir'] = default_run_dir(model_name, settings['dataset'])
+
+    u_indices, v_indices, labels = data['train']
+    random = np.random.RandomState(settings['seed'])
+    shard_size = labels.shape[0] // num_workers
+    shards = random.permutation(labels.shape[0])[:shard_size * num_workers].reshape(num_workers, shard_size)
+
+    shared = {'support': SharedCSR(ctx, data['support']),
+              'support_t': SharedCSR(ctx, data['support_t']),
+              'train_u': SharedArray(ctx, u_indices),
+              'train_v': SharedArray(ctx, v_indices),
+              'train_labels': SharedArray(ctx, labels),
+              'shards': SharedArray(ctx, shards)}
+    # the workers only use the shared copies
+    data = dict(data, support=None, support_t=None, train=None)
+
+    allreduce = GradientAllreduce(ctx, num_workers, num_parameters, timeout=settings['timeout'])
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(rank, num_workers, data, shared, settings, allreduce, results))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    stats = _collect_results(results, workers, allreduce)
+    for worker in workers:
+        worker.join()
+
+    errors = [s['error'] for s in stats.values() if 'error' in s]
+    if errors:
+        raise RuntimeError('Data-parallel worker failed:\n' + errors[0])
+
+    report = dict(stats[0])
+    report['num_processes'] = num_workers
+    report['num_parameters'] = num_parameters
+    report['allreduce_time'] = float(np.mean([s['allreduce_time'] for s in stats.values()]))
+    return report
+
+
+def scaling_report(data, settings, num_workers, num_steps):
+    """
+    Throughput of num_steps training steps with 1 and with num_workers processes, at the
+    same global batch size. Efficiency is the speedup divided by num_workers.
+    """
+
+    if num_steps <= settings['warmup_steps']:
+        raise ValueError('The scaling runs need more than %d steps.' % settings['warmup_steps'])
+
+    settings = dict(settings, max_steps=num_steps, validate=False)
+    single = train_data_parallel(data, settings, 1)
+    parallel = train_data_parallel(data, settings, num_workers)
+
+    speedup = parallel['pairs_per_sec'] / single['pairs_per_sec']
+    report = {'num_processes': num_workers,
+              'steps': num_steps,
+              'batch_size': settings['batch_size'],
+              'pairs_per_sec_1': single['pairs_per_sec'],
+              'pairs_per_sec_n': parallel['pairs_per_sec'],
+              'step_time_1': single['step_time'],
+              'step_time_n': parallel['step_time'],
+              'compute_time_n': parallel['compute_time'],
+              'allreduce_time_n': parallel['allreduce_time'],
+              'speedup': speedup,
+              'efficiency': speedup / num_workers}
+    return report
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-d", "--dataset", type=str, default="ml_1m",
+                    choices=['ml_100k', 'ml_1m', 'ml_10m', 'douban', 'yahoo_music', 'flixster'],
+                    help="Dataset string.")
+
+    ap.add_argument("-np", "--num_processes", type=int, default=4,
+                    help="Number of data-parallel worker processes.")
+
+    ap.add_argument("-lr", "--learning_rate", type=float, default=0.01,
+                    help="Learning rate")
+
+    ap.add_argument("-e", "--epochs", type=int, default=20,
+                    help="Number training epochs")
+
+    ap.add_argument("-hi", "--hidden", type=int, nargs=2, default=[500, 75],
+                    help="Number hidden units in 1st and 2nd layer")
+
+    ap.add_argument("-ac", "--accumulation", type=str, default="stack", choices=['sum', 'stack'],
+                    help="Accumulation function: sum or stack.")
+
+    ap.add_argument("-numlay", "--num_layers", type=int, default=1,
+                    help="Number of graph conv layers")
+
+    ap.add_argument("-do", "--dropout", type=float, default=0.3,
+                    help="Dropout fraction")
+
+    ap.add_argument("-nb", "--num_basis_functions", type=int, default=2,
+                    help="Number of basis functions for Mixture Model GCN.")
+
+    ap.add_argument("-ds", "--data_seed", type=int, default=1234,
+                    help="Seed used to shuffle data in data_utils, taken from cf-nade (1234, 2341, 3412, 4123, 1324)")
+
+    ap.add_argument("-bs", "--batch_size", type=int, default=10000,
+                    help="Global batch size of a synchronized step, split evenly over the processes.")
+
+    ap.add_argument("-nw", "--num_workers", type=int, default=1,
+                    help="Number of background threads per process that build minibatches.")
+
+    ap.add_argument("-pf", "--prefetch", type=int, default=4,
+                    help="Maximum number of minibatches built ahead of the training step.")
+
+    ap.add_argument("-ms", "--max_steps", type=int, default=0,
+                    help="Stop after this many synchronized steps, 0 to train for all epochs.")
+
+    ap.add_argument("-rdir", "--run_dir", type=str, default=None,
+                    help="Checkpoint directory of this run (default: a new directory under tmp/runs).")
+
+    ap.add_argument("-to", "--timeout", type=float, default=600.,
+                    help="Seconds a worker waits for the others at an allreduce before giving up.")
+
+    ap.add_argument("--scaling", action='store_true',
+                    help="Option to only measure the throughput with 1 and --num_processes processes and report the scaling efficiency")
+
+    ap.add_argument("--scaling_steps", type=int, default=50,
+                    help="Number of synchronized steps per run of --scaling.")
+
+    ap.add_argument('--pin_cpus', action='store_true',
+                    help='Option to pin every process to its share of the CPUs')
+
+    ap.add_argument('-tel', '--telemetry', action='store_true',
+                    help='Option to write per-step phase times, throughput and peak memory of every process to '
+                         'telemetry_<rank>_of_<num_processes>.jsonl in the run directory')
+
+    fp = ap.add_mutually_exclusive_group(required=False)
+    fp.add_argument('-nsym', '--norm_symmetric', dest='norm_symmetric',
+                    help="Option to turn on symmetric global normalization", action='store_true')
+    fp.add_argument('-nleft', '--norm_left', dest='norm_symmetric',
+                    help="Option to turn on left global normalization", action='store_false')
+    ap.set_defaults(norm_symmetric=True)
+
+    fp = ap.add_mutually_exclusive_group(required=False)
+    fp.add_argument('-t', '--testing', dest='testing',
+                    help="Option to turn on test set evaluation", action='store_true')
+    fp.add_argument('-v', '--validation', dest='testing',
+                    help="Option to only use validation set evaluation", action='store_false')
+    ap.set_defaults(testing=False)
+
+    args = vars(ap.parse_args())
+
+    print('Settings:')
+    print(args, '\n')
+
+    data = load_training_data(args['dataset'], args['data_seed'], args['testing'], args['norm_symmetric'])
+
+    settings = dict(args)
+    settings.update({'seed': int(time.time()),
+                     'warmup_steps': 2,
+                     'validate': True,
+                     'timeout': args['timeout'] if args['timeout'] > 0 else None})
+
+    if args['scaling']:
+        report = scaling_report(data, settings, args['num_processes'], args['scaling_steps'])
+    else:
+        report = train_data_parallel(data, settings, args['num_processes'])
+    print(json.dumps(report))
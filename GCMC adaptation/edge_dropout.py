@@ -0,0 +1,135 @@
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class EdgeDropout(object):
+    """
+    Stochastic edge subsampling (DropEdge) for the per-class rating supports.
+    Every call to sample() draws a fresh subset of the training rating edges. The
+    per-class supports are then rebuilt directly from the kept edges and globally
+    renormalized with the degrees of the subsampled graph, in the same way as
+    globally_normalize_bipartite_adjacency does for the full graph.
+    """
+
+    def __init__(self, adj_train, num_classes, rate=0., max_degree=None, symmetric=True,
+                 E_start=None, E_end=None, self_connections=False):
+        """
+        :param adj_train: num_users x num_items sparse matrix of training ratings, with
+            values 1, ..., num_classes (class index + 1)
+        :param num_classes: number of rating classes, i.e. number of supports
+        :param rate: fraction of rating edges dropped at every step
+        :param max_degree: optional cap on the number of kept edges per item (hub items)
+        :param symmetric: symmetric (True) or left (False) global normalization
+        :param E_start, E_end: optional lists of edge incidence matrices for the RGGCN layers,
+            as returned by get_edges_matrices
+        :param self_connections: append the identity supports (never dropped), as the
+            training scripts do with SELFCONNECTIONS
+        """
+        assert 0. <= rate < 1., 'edge dropout rate must be in [0, 1)'
+
+        adj = sp.coo_matrix(adj_train)
+        self.num_users, self.num_items = adj.shape
+        self.num_classes = num_classes
+        self.rows = adj.row.astype(np.int64)
+        self.cols = adj.col.astype(np.int64)
+        self.classes = np.rint(adj.data).astype(np.int64) - 1
+        self.keys = self.rows * self.num_items + self.cols
+
+        self.rate = rate
+        self.max_degree = max_degree
+        self.symmetric = symmetric
+        self.self_connections = self_connections
+
+        # every row of an incidence matrix holds exactly one edge, which in the full
+        # (users + items) graph is stored once in each direction. Both directions map
+        # to the same user/item key so that they are dropped together.
+        self.E_start = None
+        self.E_end = None
+        self.E_keys = None
+        if E_start is not None and E_end is not None:
+            self.E_start = [sp.csr_matrix(e) for e in E_start]
+            self.E_end = [sp.csr_matrix(e) for e in E_end]
+            self.E_keys = []
+            for e_start, e_end in zip(self.E_start, self.E_end):
+                start = e_start.indices.astype(np.int64)
+                end = e_end.indices.astype(np.int64)
+                u = np.minimum(start, end)
+                v = np.maximum(start, end) - self.num_users
+                self.E_keys.append(u * self.num_items + v)
+
+    @property
+    def num_edges(self):
+        return self.rows.shape[0]
+
+    def sample(self, random=None):
+        """
+        Returns a boolean mask over the training edges that are kept for one step.
+        :param random: optional np.random.RandomState to draw from, instead of the global one
+        """
+
+        random = random if random is not None else np.random
+        keep = random.uniform(size=self.num_edges) >= self.rate
+
+        if self.max_degree is not None:
+            idx = np.flatnonzero(keep)
+            if idx.size > 0:
+                # random rank of every kept edge among the kept edges of its item
+                order = np.lexsort((random.uniform(size=idx.size), self.cols[idx]))
+                sorted_cols = self.cols[idx[order]]
+                starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_cols)) + 1])
+                counts = np.diff(np.concatenate([starts, [sorted_cols.size]]))
+                rank = np.arange(sorted_cols.size) - np.repeat(starts, counts)
+                keep[idx[order[rank >= self.max_degree]]] = False
+
+        return keep
+
+    def supports(self, keep):
+        """
+        Builds the horizontally stacked and globally normalized supports (support and
+        support_t) from the kept edges.
+        """
+
+        rows = self.rows[keep]
+        cols = self.cols[keep]
+        classes = self.classes[keep]
+
+        degree_u = np.bincount(rows, minlength=self.num_users).astype(np.float32)
+        degree_v = np.bincount(cols, minlength=self.num_items).astype(np.float32)
+
+        # kept edges always have non-zero degree at both end points
+        if self.symmetric:
+            values = 1. / np.sqrt(degree_u[rows] * degree_v[cols])
+            values_t = values
+        else:
+            values = 1. / degree_u[rows]
+            values_t = 1. / degree_v[cols]
+
+        support = sp.csr_matrix((values, (rows, classes * self.num_items + cols)),
+                                shape=(self.num_users, self.num_classes * self.num_items), dtype=np.float32)
+        support_t = sp.csr_matrix((values_t, (cols, classes * self.num_users + rows)),
+                                  shape=(self.num_items, self.num_classes * self.num_users), dtype=np.float32)
+
+        if self.self_connections:
+            support = sp.hstack([support, sp.identity(self.num_users, dtype=np.float32)], format='csr')
+            support_t = sp.hstack([support_t, sp.identity(self.num_items, dtype=np.float32)], format='csr')
+
+        return support, support_t
+
+    def incidence(self, keep):
+        """ Returns the E_start and E_end incidence matrices restricted to the kept edges. """
+
+        if self.E_keys is None:
+            raise ValueError('EdgeDropout was created without incidence matrices.')
+
+        E_start = []
+        E_end = []
+        for i in range(len(self.E_keys)):
+            kept_keys = self.keys[keep & (self.classes == i)]
+            mask = np.isin(self.E_keys[i], kept_keys)
+            E_start.append(self.E_start[i][mask])
+            E_end.append(self.E_end[i][mask])
+
+        return E_start, E_end
@@ -0,0 +1,202 @@
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+
+USER_EMBEDDINGS = 'user_embeddings.npy'
+ITEM_EMBEDDINGS = 'item_embeddings.npy'
+DECODER_BASIS = 'decoder_basis.npy'
+DECODER_SCALARS = 'decoder_scalars.npy'
+CLASS_VALUES = 'class_values.npy'
+TRAIN_RATINGS = 'train_ratings.npz'
+ENCODER = 'encoder.npz'
+META = 'meta.json'
+
+
+def _export_encoder(sess, model, export_dir, adj_train, symmetric, num_user_side_features):
+    """
+    Writes the weights that are needed to embed new users and items (see coldstart.py)
+    and to refresh embeddings after new ratings (see refresh.py): the graph convolution
+    layers, the side feature layer and the Dense layer, together with the node degrees of
+    the training graph.
+    :return: encoder meta data, or None if the encoder of model is not supported
+    """
+
+    # imported here, so that the scorers below can be used without TensorFlow
+    from layers import StackGCN, OrdinalMixtureGCN
+    from model import RecommenderSideInfoGAE
+
+    side_info = isinstance(model, RecommenderSideInfoGAE)
+    gcn_layers = model.layers[:1] if side_info else model.layers[:-2]
+    dense = model.layers[-2]
+
+    if not all(isinstance(layer, type(gcn_layers[0])) for layer in gcn_layers) or \
+            not isinstance(gcn_layers[0], (StackGCN, OrdinalMixtureGCN)):
+        print('Encoder not exported, only stack or sum graph convolution layers are supported.')
+        return None
+
+    weights = {'dense_weights_u': dense.vars['weights_u'], 'dense_weights_v': dense.vars['weights_v']}
+    for i, layer in enumerate(gcn_layers):
+        weights['gcn_weights_u_%d' % i] = layer.vars['weights_u']
+        weights['gcn_weights_v_%d' % i] = layer.vars['weights_v']
+    if side_info:
+        side = model.layers[1]
+        weights.update({'side_weights_u': side.vars['weights_u'], 'side_weights_v': side.vars['weights_v'],
+                        'side_bias_u': side.vars['user_bias'], 'side_bias_v': side.vars['item_bias']})
+
+    arrays = sess.run(weights)
+    adj_train = sp.csr_matrix(adj_train != 0)
+    arrays['user_degrees'] = np.diff(adj_train.indptr).astype(np.float32)
+    arrays['item_degrees'] = np.bincount(adj_train.indices, minlength=adj_train.shape[1]).astype(np.float32)
+    np.savez(os.path.join(export_dir, ENCODER), **arrays)
+
+    return {'accum': 'stack' if isinstance(gcn_layers[0], StackGCN) else 'sum',
+            'num_layers': len(gcn_layers),
+            'num_support': int(model.num_support),
+            'symmetric': bool(symmetric),
+            'side_features': side_info,
+            'num_user_side_features': int(num_user_side_features)}
+
+
+def export_embeddings(sess, model, feed_dict, class_values, export_dir, adj_train=None, symmetric=True,
+                      num_user_side_features=0):
+    """
+    Runs the encoder once and writes the final user/item embeddings (outputs of the Dense
+    layer, i.e. the inputs of the BilinearMixture decoder) together with the decoder basis
+    matrices and scalars to .npy files in export_dir.
+    The model variables are exported as they are in sess, so restore the Polyak averages
+    first. feed_dict must contain the full-graph supports (no GCMC indices) so that there
+    is an embedding for every user and item. If adj_train is given, the training ratings
+    are stored as well, so that already rated items can be excluded from recommendations,
+    and so are the encoder weights for cold-start embeddings. symmetric is the normalization
+    of the supports and num_user_side_features the number of raw user side features.
+    """
+
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    decoder = model.layers[-1]
+    u_embeddings, v_embeddings = sess.run(model.activations[-2], feed_dict=feed_dict)
+    basis = sess.run([decoder.vars['weights_%d' % i] for i in range(decoder.num_weights)])
+    scalars = sess.run(decoder.vars['weights_scalars'])
+
+    basis = np.stack(basis, axis=0)
+    if decoder.diagonal:
+        # diagonal basis matrices are stored as 1 x input_dim vectors
+        basis = basis.reshape(decoder.num_weights, -1)
+
+    np.save(os.path.join(export_dir, USER_EMBEDDINGS), np.asarray(u_embeddings, dtype=np.float32))
+    np.save(os.path.join(export_dir, ITEM_EMBEDDINGS), np.asarray(v_embeddings, dtype=np.float32))
+    np.save(os.path.join(export_dir, DECODER_BASIS), basis.astype(np.float32))
+    np.save(os.path.join(export_dir, DECODER_SCALARS), scalars.astype(np.float32))
+    np.save(os.path.join(export_dir, CLASS_VALUES), np.asarray(class_values, dtype=np.float32))
+    encoder = None
+    if adj_train is not None:
+        sp.save_npz(os.path.join(export_dir, TRAIN_RATINGS), sp.csr_matrix(adj_train))
+        encoder = _export_encoder(sess, model, export_dir, adj_train, symmetric, num_user_side_features)
+
+    meta = {'num_users': int(u_embeddings.shape[0]),
+            'num_items': int(v_embeddings.shape[0]),
+            'hidden': int(u_embeddings.shape[1]),
+            'num_weights': int(decoder.num_weights),
+            'num_classes': int(decoder.num_classes),
+            'diagonal': bool(decoder.diagonal),
+            'encoder': encoder,
+            'version': new_version()}
+    with open(os.path.join(export_dir, META), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+    print('Embeddings exported to %s' % export_dir)
+
+
+def new_version():
+    """ Version of an export, changes whenever the embeddings are written. """
+    return int(time.time() * 1000)
+
+
+def load_train_ratings(export_dir):
+    """ Training rating matrix stored with the embeddings (CSR), or None if it was not exported. """
+    path = os.path.join(export_dir, TRAIN_RATINGS)
+    if not os.path.isfile(path):
+        return None
+    return sp.csr_matrix(sp.load_npz(path))
+
+
+class BilinearScorer(object):
+    """
+    Decoder-only scorer for exported embeddings. Computes the same outputs as the
+    BilinearMixture layer for arbitrary (user, item) pairs with numpy only.
+    The embedding matrices are memory-mapped, so loading is zero-copy and only the rows
+    that are scored are read.
+    """
+
+    def __init__(self, export_dir, mmap=True):
+        mmap_mode = 'r' if mmap else None
+
+        with open(os.path.join(export_dir, META)) as f:
+            self.meta = json.load(f)
+
+        self.u_embeddings = np.load(os.path.join(export_dir, USER_EMBEDDINGS), mmap_mode=mmap_mode)
+        self.v_embeddings = np.load(os.path.join(export_dir, ITEM_EMBEDDINGS), mmap_mode=mmap_mode)
+        self.basis = np.load(os.path.join(export_dir, DECODER_BASIS))
+        self.scalars = np.load(os.path.join(export_dir, DECODER_SCALARS))
+        self.class_values = np.load(os.path.join(export_dir, CLASS_VALUES))
+
+        self.export_dir = export_dir
+        self.diagonal = self.meta['diagonal']
+        self.num_weights = self.meta['num_weights']
+        self.num_classes = self.meta['num_classes']
+        self.hidden = self.meta['hidden']
+        self.num_users = self.meta['num_users']
+        self.num_items = self.meta['num_items']
+
+        if not self.diagonal:
+            # [Q_0 | Q_1 | ...], so that all basis projections of a user take one matmul
+            self.basis_concat = np.ascontiguousarray(np.concatenate(list(self.basis), axis=1))
+
+    def project_users(self, u_embeddings):
+        """ Per-basis projections u^T Q_s of user embeddings, n x num_weights x hidden. """
+        if self.diagonal:
+            return u_embeddings[:, None, :] * self.basis[None, :, :]
+        return np.dot(u_embeddings, self.basis_concat).reshape(-1, self.num_weights, self.hidden)
+
+    def basis_scores(self, u_indices, v_indices):
+        """ Scores u^T Q_s v of every basis for the given pairs, n x num_weights. """
+
+        u = np.asarray(self.u_embeddings[np.asarray(u_indices)])
+        v = np.asarray(self.v_embeddings[np.asarray(v_indices)])
+        return self.embedding_basis_scores(u, v)
+
+    def embedding_basis_scores(self, u, v):
+        """ Scores u^T Q_s v of every basis for pairs of embedding rows, n x num_weights. """
+        if self.diagonal:
+            return np.dot(u * v, self.basis.T)
+        return np.einsum('nkd,nd->nk', self.project_users(u), v)
+
+    def logits(self, u_indices, v_indices):
+        """ Class logits of the given pairs, n x num_classes. """
+        return np.dot(self.basis_scores(u_indices, v_indices), self.scalars)
+
+    def probabilities(self, u_indices, v_indices):
+        """ Softmax class probabilities of the given pairs, n x num_classes. """
+        logits = self.logits(u_indices, v_indices)
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=1, keepdims=True)
+
+    def predict(self, u_indices, v_indices):
+        """ Expected ratings of the given pairs, as used for the RMSE of the model. """
+        return np.dot(self.probabilities(u_indices, v_indices), self.class_values)
+
+    def predict_embeddings(self, u, v):
+        """ Expected ratings for pairs of embedding rows, e.g. of cold-start users or items. """
+        logits = np.dot(self.embedding_basis_scores(u, v), self.scalars)
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return np.dot(probs / probs.sum(axis=1, keepdims=True), self.class_values)
@@ -0,0 +1,322 @@
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import errno
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# intra_op_threads / inter_op_threads: sizes of the TF thread pools. cpus: tuple of CPU ids
+# the process is pinned to, or None to leave the CPU affinity untouched. Only the number of
+# CPUs is binding: apply_cpu_affinity pins to as many CPUs not claimed by other runs.
+ExecutionProfile = collections.namedtuple('ExecutionProfile', ['intra_op_threads', 'inter_op_threads', 'cpus'])
+
+PROFILES_PATH = 'tmp/execution_profiles.json'
+
+# one file per pinned process (named after its pid) with the CPU ids it is pinned to
+CPU_CLAIMS_DIR = 'tmp/cpu_claims'
+
+# set once session_config is called: TF runtime state (thread pools) may exist from then on,
+# and the benchmark children forked by benchmark_profile can deadlock on it
+_session_created = False
+
+
+def session_config(jit=False, profile=None):
+    """
+    Creates the tf.ConfigProto used by the trainers.
+    :param jit: turn on XLA auto-clustering for the whole graph
+    :param profile: ExecutionProfile with the thread pool sizes, None for the TF defaults
+    :return: tf.ConfigProto
+    """
+
+    global _session_created
+    _session_created = True
+
+    config = tf.ConfigProto()
+    if profile is not None:
+        config.intra_op_parallelism_threads = profile.intra_op_threads
+        config.inter_op_parallelism_threads = profile.inter_op_threads
+    if jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+@contextlib.contextmanager
+def _no_scope():
+    yield
+
+
+def jit_scope(enabled=True):
+    """
+    Context manager that marks all ops created inside it for XLA compilation.
+    Auto-clustering through global_jit_level is not applied to CPU devices, so the
+    encoder-decoder graph has to be built inside this scope for --jit to take effect on CPU.
+    Ops without an XLA kernel (e.g. the sparse matmuls with the supports) are left to TF.
+    """
+
+    if not enabled:
+        return _no_scope()
+
+    from tensorflow.contrib.compiler import jit
+    return jit.experimental_jit_scope(compile_ops=True)
+
+
+def compile_time(step_times):
+    """
+    Estimates the one-off XLA compilation time from a list of wall times of the same
+    sess.run call, as the excess of the first call over the median of the others.
+    """
+
+    if len(step_times) < 2:
+        return 0.
+    return max(step_times[0] - float(np.median(step_times[1:])), 0.)
+
+
+def available_cpus():
+    """ CPU ids this process is allowed to run on. """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _write_json(path, obj):
+    """ Writes obj to path atomically, so concurrent readers never see a partial file. """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def claim_cpus(num_cpus, claims_dir=CPU_CLAIMS_DIR):
+    """
+    Picks num_cpus of the available CPUs for this process, the ones claimed by the fewest
+    other live processes, and records the claim, so that concurrent pinned runs (and the
+    workers of a data-parallel run) are spread over the machine instead of all being
+    pinned to its first CPUs. Claims of processes that exited are dropped.
+    :return: tuple of CPU ids
+    """
+
+    if not os.path.isdir(claims_dir):
+        try:
+            os.makedirs(claims_dir)
+        except OSError:
+            if not os.path.isdir(claims_dir):
+                raise
+
+    with open(os.path.join(claims_dir, '.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        claims = dict((cpu, 0) for cpu in available_cpus())
+        for name in os.listdir(claims_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(claims_dir, name)
+            pid = int(name[:-len('.json')])
+            if pid == os.getpid() or not _pid_alive(pid):
+                os.remove(path)
+                continue
+            with open(path) as f:
+                for cpu in json.load(f):
+                    if cpu in claims:
+                        claims[cpu] += 1
+
+        cpus = tuple(sorted(sorted(claims, key=lambda cpu: (claims[cpu], cpu))[:num_cpus]))
+        _write_json(os.path.join(claims_dir, '%d.json' % os.getpid()), list(cpus))
+    return cpus
+
+
+def apply_cpu_affinity(profile):
+    """ Pins the current process to as many CPUs as the profile has, if it has any (see claim_cpus). """
+    if profile is not None and profile.cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, claim_cpus(len(profile.cpus)))
+
+
+def profile_key(trainer, dataset, accum, hidden):
+    """ Key under which the execution profile of a trainer ('full_batch', 'mini_batch') and run configuration is stored. """
+    return '%s-%s-%s-%s' % (trainer, dataset, accum, '_'.join(str(h) for h in hidden))
+
+
+def load_profile(key, path=PROFILES_PATH):
+    """ Returns the stored ExecutionProfile for key, or None if there is none. """
+
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        profiles = json.load(f)
+    if key not in profiles:
+        return None
+
+    profile = profiles[key]
+    cpus = tuple(profile['cpus']) if profile['cpus'] is not None else None
+    return ExecutionProfile(profile['intra_op_threads'], profile['inter_op_threads'], cpus)
+
+
+def save_profile(key, profile, path=PROFILES_PATH):
+    """ Stores profile under key, keeping the profiles of all other keys. """
+
+    profiles = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            profiles = json.load(f)
+    profiles[key] = profile._asdict()
+    if profile.cpus is not None:
+        profiles[key]['cpus'] = list(profile.cpus)
+
+    _write_json(path, profiles)
+
+
+def candidate_profiles(num_support, pin_cpus=False):
+    """
+    Thread pool configurations tried by the autotuner. The per-class sparse matmuls are
+    independent, so inter-op pools of up to num_support threads are tried next to the
+    usual powers of two for the intra-op pool.
+    """
+
+    cpus = available_cpus()
+    num_cpus = len(cpus)
+
+    intra = sorted(set([n for n in (1, 2, 4, 8, 16, 32) if n <= num_cpus] + [num_cpus]))
+    inter = sorted(set([n for n in (1, 2, num_support) if n <= num_cpus]))
+
+    profiles = []
+    for intra_threads in intra:
+        for inter_threads in inter:
+            pinned = tuple(cpus[:max(intra_threads, inter_threads)]) if pin_cpus else None
+            profiles.append(ExecutionProfile(intra_threads, inter_threads, pinned))
+    return profiles
+
+
+def _benchmark_worker(fetches, feed_dict, profile, num_steps, jit, results):
+    apply_cpu_affinity(profile)
+    with tf.Session(config=session_config(jit=jit, profile=profile)) as sess:
+        sess.run(tf.global_variables_initializer())
+        # warm-up step, also triggers XLA compilation
+        sess.run(fetches, feed_dict=feed_dict)
+
+        t = time.time()
+        for _ in range(num_steps):
+            sess.run(fetches, feed_dict=feed_dict)
+        results.put((time.time() - t) / num_steps)
+
+
+def benchmark_profile(fetches, feed_dict, profile, num_steps=5, jit=False, timeout=600):
+    """
+    Average wall time of sess.run(fetches, feed_dict) under profile.
+    TF creates its thread pools once per process, so every profile is measured in a
+    forked child that builds its own session on a copy of the current graph. This must be
+    called before the parent process creates any session.
+    Raises RuntimeError if the child exits without a result or takes longer than timeout seconds.
+    """
+
+    _check_no_session()
+
+    if hasattr(multiprocessing, 'get_context'):
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing
+
+    results = ctx.Queue()
+    worker = ctx.Process(target=_benchmark_worker, args=(fetches, feed_dict, profile, num_steps, jit, results))
+    worker.start()
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            step_time = results.get(timeout=1.)
+            break
+        except queue.Empty:
+            if worker.exitcode is not None:
+                raise RuntimeError('benchmark of %s exited with code %d' % (profile, worker.exitcode))
+            if time.time() > deadline:
+                worker.terminate()
+                worker.join()
+                raise RuntimeError('benchmark of %s timed out after %d seconds' % (profile, timeout))
+    worker.join()
+    return step_time
+
+
+def _check_no_session():
+    if _session_created:
+        raise RuntimeError('execution profiles can only be tuned before the first session of the process, '
+                           'tune them in a separate run and load the stored profile')
+
+
+def autotune(key, fetches, feed_dict, num_support, num_steps=5, pin_cpus=False, jit=False,
+             path=PROFILES_PATH, verbose=True):
+    """
+    Benchmarks all candidate profiles, stores the fastest one under key and returns it.
+    Profiles whose benchmark fails are skipped, None is returned if all of them fail.
+    Like benchmark_profile, this must be called before the process creates any session.
+    """
+
+    _check_no_session()
+
+    best_profile = None
+    best_time = np.inf
+    for profile in candidate_profiles(num_support, pin_cpus=pin_cpus):
+        try:
+            step_time = benchmark_profile(fetches, feed_dict, profile, num_steps=num_steps, jit=jit)
+        except RuntimeError as e:
+            print('[*] Autotune: skipping profile,', e)
+            continue
+        if verbose:
+            print('[*] Autotune: intra_op=%d inter_op=%d pinned=%s' % (profile.intra_op_threads,
+                                                                       profile.inter_op_threads,
+                                                                       profile.cpus is not None),
+                  "step_time=", "{:.5f}".format(step_time))
+        if step_time < best_time:
+            best_time = step_time
+            best_profile = profile
+
+    if best_profile is not None:
+        save_profile(key, best_profile, path=path)
+    return best_profile
+
+
+def resolve_profile(key, fetches, feed_dict, num_support, tune=False, pin_cpus=False, jit=False,
+                    path=PROFILES_PATH):
+    """
+    Returns the execution profile to use for a run: the stored one for key, or a freshly
+    tuned one if tune is set. Returns None (TF defaults) if no profile is stored. The CPU
+    pinning of the profile is only kept with pin_cpus.
+    """
+
+    if tune:
+        profile = autotune(key, fetches, feed_dict, num_support, pin_cpus=pin_cpus, jit=jit, path=path)
+    else:
+        profile = load_profile(key, path=path)
+    if profile is not None and not pin_cpus:
+        profile = profile._replace(cpus=None)
+    return profile
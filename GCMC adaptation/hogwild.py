@@ -0,0 +1,172 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from telemetry import Telemetry, batch_edges
+
+
+class ThreadStats(object):
+    """ Throughput counters of one trainer thread. """
+
+    def __init__(self):
+        self.steps = 0
+        self.pairs = 0
+        self.busy_time = 0.  # time in sess.run, without waiting for minibatches or staleness permits
+        self.staleness_sum = 0
+        self.max_staleness = 0
+
+    def as_dict(self, elapsed):
+        return {'steps': self.steps,
+                'pairs': self.pairs,
+                'steps_per_sec': self.steps / elapsed if elapsed > 0 else 0.,
+                'pairs_per_sec': self.pairs / elapsed if elapsed > 0 else 0.,
+                'busy_fraction': self.busy_time / elapsed if elapsed > 0 else 0.,
+                'mean_staleness': self.staleness_sum / self.steps if self.steps else 0.,
+                'max_staleness': self.max_staleness}
+
+
+class HogwildTrainer(object):
+    """
+    Asynchronous (Hogwild) training: num_threads threads take minibatches from a shared
+    BatchProducer and run the training op in the same session concurrently, without locks
+    around the variable updates. A minibatch only touches the rows of its users and items,
+    so concurrent updates rarely collide.
+
+    The staleness of a step is the number of updates of other threads that are applied
+    while it runs, between reading and updating the parameters. A step only starts if
+    none of the steps in flight can exceed max_staleness updates, counting those already
+    applied, those of the other steps in flight and its own; max_staleness=0 serializes
+    the steps. The main thread follows the progress with wait_for and validates in between.
+    """
+
+    def __init__(self, sess, fetches, producer, feed_dict_fn, num_threads, max_staleness=None, telemetry=None):
+        """
+        :param fetches: fetches of a training step, e.g. [training_op, loss, rmse]
+        :param feed_dict_fn: function from a minibatch of the producer to its feed_dict
+        :param max_staleness: bound on the staleness of a step, None for num_threads - 1
+        :param telemetry: Telemetry the threads write their steps to
+        """
+        self.sess = sess
+        self.fetches = fetches
+        self.producer = producer
+        self.feed_dict_fn = feed_dict_fn
+        self.num_threads = num_threads
+        self.max_staleness = num_threads - 1 if max_staleness is None else max_staleness
+        self.telemetry = telemetry if telemetry is not None else Telemetry(None)
+
+        self.stats = [ThreadStats() for _ in range(num_threads)]
+        self.completed = 0
+        self.last_outputs = None  # outputs and (epoch, batch_iter) of the last finished step
+        self.last_position = None
+
+        self._progress = threading.Condition()
+        self._in_flight = {}  # thread index -> completed steps when its step started
+        self._stop = threading.Event()
+        self._error = None
+        self._running = 0
+        self._threads = [threading.Thread(target=self._train, args=(i,)) for i in range(num_threads)]
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._running = self.num_threads
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _train(self, index):
+        stats = self.stats[index]
+        try:
+            while not self._stop.is_set():
+                t = time.time()
+                item = self.producer.next_batch()
+                if item is None:
+                    break
+                epoch, batch_iter, batch = item
+                record = self.telemetry.step(None, epoch=epoch, thread=index, build_time=batch.get('build_time'))
+                record.add('batch', time.time() - t)
+                with record.time('feed'):
+                    feed_dict = self.feed_dict_fn(batch)
+
+                t = time.time()
+                with self._progress:
+                    while not self._admissible() and not self._stop.is_set():
+                        self._progress.wait(0.1)
+                    started = self.completed
+                    self._in_flight[index] = started
+                record.fields['staleness_wait'] = time.time() - t
+
+                t = time.time()
+                try:
+                    outputs = self.sess.run(self.fetches, feed_dict=feed_dict)
+                except Exception:
+                    with self._progress:
+                        del self._in_flight[index]
+                    raise
+                record.add('train', time.time() - t)
+                stats.busy_time += record.times['train']
+
+                with self._progress:
+                    del self._in_flight[index]
+                    staleness = self.completed - started
+                    record.step = self.completed
+                    self.completed += 1
+                    self.last_outputs = outputs
+                    self.last_position = (epoch, batch_iter)
+                    self._progress.notify_all()
+
+                record.fields['staleness'] = staleness
+                record.count(edges=batch_edges(batch), pairs=len(batch['labels']))
+                self.telemetry.write(record)
+
+                stats.steps += 1
+                stats.pairs += len(batch['labels'])
+                stats.staleness_sum += staleness
+                stats.max_staleness = max(stats.max_staleness, staleness)
+        except Exception as e:
+            self._error = e
+            self._stop.set()
+        finally:
+            with self._progress:
+                self._running -= 1
+                self._progress.notify_all()
+
+    def _admissible(self):
+        """ Whether a new step keeps every step in flight within max_staleness updates. """
+        in_flight = len(self._in_flight)
+        return all(self.completed - started + in_flight <= self.max_staleness
+                   for started in self._in_flight.values())
+
+    def wait_for(self, step):
+        """
+        Blocks until step steps are completed or all threads are finished.
+        :return: number of completed steps, and whether training is still running
+        """
+        with self._progress:
+            while self.completed < step and self._running > 0:
+                self._progress.wait(0.1)
+            completed, running = self.completed, self._running > 0
+        if self._error is not None:
+            self.stop()
+            raise self._error
+        return completed, running
+
+    def stop(self):
+        """ Lets the threads finish their current step and stop, e.g. after early stopping. """
+        self._stop.set()
+        self.producer.close()
+        for thread in self._threads:
+            thread.join()
+
+    def report(self):
+        """ Per-thread and total throughput counters since start. """
+        elapsed = time.time() - self.start_time
+        threads = [stats.as_dict(elapsed) for stats in self.stats]
+        return {'threads': threads,
+                'steps': sum(t['steps'] for t in threads),
+                'steps_per_sec': sum(t['steps_per_sec'] for t in threads),
+                'pairs_per_sec': sum(t['pairs_per_sec'] for t in threads),
+                'max_staleness': max(t['max_staleness'] for t in threads),
+                'elapsed': elapsed}
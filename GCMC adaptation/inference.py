@@ -0,0 +1,234 @@
+""" Frozen inference graphs for serving, without the training graph and without rebuilding the model in Python """
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from embeddings import BilinearScorer
+
+
+FULL_GRAPH = 'inference_graph.pb'
+DECODER_GRAPH = 'decoder_graph.pb'
+
+OUTPUTS = ('logits', 'probabilities', 'expected_rating')
+
+
+def _signature_path(graph_path):
+    return os.path.splitext(graph_path)[0] + '.json'
+
+
+def _add_outputs(logits, class_values):
+    """ Named logits, class probabilities and expected ratings under the inference scope. """
+    with tf.name_scope('inference'):
+        logits = tf.identity(logits, name='logits')
+        probabilities = tf.nn.softmax(logits, name='probabilities')
+        expected = tf.reduce_sum(probabilities * tf.constant(class_values, dtype=tf.float32), axis=1,
+                                 name='expected_rating')
+    return {'logits': logits, 'probabilities': probabilities, 'expected_rating': expected}
+
+
+def _tensor_feeds(feed_dict):
+    """ Flattens a feed_dict with sparse placeholders into a dict from placeholder op name to value. """
+
+    feeds = {}
+    for key, value in feed_dict.items():
+        if isinstance(key, tf.SparseTensor):
+            for tensor, component in zip((key.indices, key.values, key.dense_shape), value):
+                feeds[tensor.op.name] = np.asarray(component)
+        else:
+            feeds[key.op.name] = np.asarray(value)
+    return feeds
+
+
+def _inputs_path(graph_path):
+    return os.path.splitext(graph_path)[0] + '_inputs.npz'
+
+
+def _variables_to_placeholders(graph_def, names):
+    """ Replaces the variables in names (left unfrozen) by placeholders of the same name and dtype. """
+
+    converted = tf.GraphDef()
+    converted.versions.CopyFrom(graph_def.versions)
+    converted.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in names:
+            placeholder = converted.node.add()
+            placeholder.name = node.name
+            placeholder.op = 'Placeholder'
+            placeholder.device = node.device
+            placeholder.attr['dtype'].type = node.attr['dtype'].type
+        else:
+            converted.node.extend([node])
+    return converted
+
+
+def _write(graph_def, signature, path, bound_values=None):
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    if bound_values:
+        np.savez(_inputs_path(path), **bound_values)
+        signature = dict(signature, bound_inputs=sorted(bound_values))
+    with open(_signature_path(path), 'w') as f:
+        json.dump(signature, f, indent=2, sort_keys=True)
+    print('Inference graph (%.1f MB) exported to %s' % (os.path.getsize(path) / 1e6, path))
+
+
+def export_inference_graph(sess, model, placeholders, feed_dict, class_values, export_dir, bind_inputs=True):
+    """
+    Freezes the encoder and decoder of model with the variable values in sess (restore the
+    Polyak averages first) into a GraphDef that only contains the ops needed for the outputs:
+    no optimizer slots, EMA shadow variables, summaries or training ops.
+    With bind_inputs, the graph inputs in feed_dict (features, supports, incidence matrices)
+    are bound, so that only user_indices and item_indices are left as inputs. Otherwise all
+    placeholders the outputs depend on stay inputs. Resident inputs are always bound.
+    Bound inputs are not stored in the GraphDef, which is limited to 2 GB, but next to it in
+    an .npz file, which InferenceModel loads into variables once.
+    """
+
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    outputs = _add_outputs(model.outputs, class_values)
+    output_names = [outputs[name].op.name for name in OUTPUTS]
+
+    # the resident inputs (local variables) are bound like the fed inputs instead of being frozen
+    local_names = [v.op.name for v in tf.local_variables()]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names,
+                                                             variable_names_blacklist=local_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    node_names = set(node.name for node in graph_def.node)
+
+    resident = [v for v in tf.local_variables() if v.op.name in node_names]
+    graph_def = _variables_to_placeholders(graph_def, set(v.op.name for v in resident))
+    bound_values = dict(zip([v.op.name for v in resident], sess.run(resident)))
+
+    inputs = {'user_indices': placeholders['user_indices'].op.name,
+              'item_indices': placeholders['item_indices'].op.name}
+
+    if bind_inputs:
+        # values in the dtype of their placeholder, which the variables they are loaded into take
+        dtypes = dict((node.name, tf.as_dtype(node.attr['dtype'].type).as_numpy_dtype)
+                      for node in graph_def.node if node.op == 'Placeholder')
+        for name, value in _tensor_feeds(feed_dict).items():
+            if name in dtypes and name not in inputs.values():
+                bound_values[name] = value.astype(dtypes[name])
+    else:
+        # sparse placeholders are fed as indices, values and dense_shape
+        for key, placeholder in placeholders.items():
+            tensors = placeholder if isinstance(placeholder, list) else [placeholder]
+            for i, tensor in enumerate(tensors):
+                name = key if len(tensors) == 1 and not isinstance(placeholder, list) else '%s_%d' % (key, i)
+                if isinstance(tensor, tf.SparseTensor):
+                    for part, component in (('indices', tensor.indices), ('values', tensor.values),
+                                            ('dense_shape', tensor.dense_shape)):
+                        if component.op.type == 'Placeholder' and component.op.name in node_names:
+                            inputs['%s/%s' % (name, part)] = component.op.name
+                elif tensor.op.name in node_names:
+                    inputs[name] = tensor.op.name
+
+    signature = {'inputs': {key: name + ':0' for key, name in inputs.items()},
+                 'outputs': {key: outputs[key].name for key in OUTPUTS}}
+    _write(graph_def, signature, os.path.join(export_dir, FULL_GRAPH), bound_values)
+
+
+def export_decoder_graph(export_dir):
+    """
+    Builds a decoder-only inference graph from exported embeddings and decoder weights
+    (see embeddings.export_embeddings): user_indices and item_indices in, the outputs of the
+    BilinearMixture decoder out, with the embedding tables bound as inputs (stored next to
+    the graph, see export_inference_graph).
+    """
+
+    scorer = BilinearScorer(export_dir, mmap=False)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        u_indices = tf.placeholder(tf.int32, shape=(None,), name='user_indices')
+        v_indices = tf.placeholder(tf.int32, shape=(None,), name='item_indices')
+
+        u_embeddings = tf.placeholder(tf.float32, shape=scorer.u_embeddings.shape, name='u_embeddings')
+        v_embeddings = tf.placeholder(tf.float32, shape=scorer.v_embeddings.shape, name='v_embeddings')
+        u = tf.gather(u_embeddings, u_indices)
+        v = tf.gather(v_embeddings, v_indices)
+
+        if scorer.diagonal:
+            basis_scores = tf.matmul(u * v, tf.constant(scorer.basis), transpose_b=True)
+        else:
+            # u^T Q_s for all bases with one matmul, then reduced against v
+            u_projected = tf.reshape(tf.matmul(u, tf.constant(scorer.basis_concat)),
+                                     [-1, scorer.num_weights, scorer.hidden])
+            basis_scores = tf.reduce_sum(u_projected * tf.expand_dims(v, 1), axis=2)
+
+        outputs = _add_outputs(tf.matmul(basis_scores, tf.constant(scorer.scalars)), scorer.class_values)
+
+    signature = {'inputs': {'user_indices': u_indices.name, 'item_indices': v_indices.name},
+                 'outputs': {key: outputs[key].name for key in OUTPUTS}}
+    bound_values = {u_embeddings.op.name: np.asarray(scorer.u_embeddings, dtype=np.float32),
+                    v_embeddings.op.name: np.asarray(scorer.v_embeddings, dtype=np.float32)}
+    _write(graph.as_graph_def(), signature, os.path.join(export_dir, DECODER_GRAPH), bound_values)
+
+
+class InferenceModel(object):
+    """
+    Loads a frozen inference graph into its own graph and session. Loading parses the
+    GraphDef and loads its bound inputs (if any) into local variables once, there are no
+    trainable variables to initialize or restore.
+    """
+
+    def __init__(self, path, config=None):
+        t = time.time()
+
+        with open(_signature_path(path)) as f:
+            self.signature = json.load(f)
+
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        bound_names = self.signature.get('bound_inputs', [])
+        bound_values = np.load(_inputs_path(path)) if bound_names else {}
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # bound inputs are read from variables, loaded once instead of fed at every run
+            input_map = {}
+            load_feed_dict = {}
+            load_ops = []
+            with tf.name_scope('bound_inputs'):
+                for name in bound_names:
+                    value = bound_values[name]
+                    variable = tf.Variable(tf.zeros([0] * value.ndim, dtype=value.dtype), trainable=False,
+                                           validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                    placeholder = tf.placeholder(value.dtype, shape=value.shape)
+                    load_ops.append(tf.assign(variable, placeholder, validate_shape=False))
+                    load_feed_dict[placeholder] = value
+                    tensor = tf.identity(variable)
+                    tensor.set_shape(value.shape)
+                    input_map[name + ':0'] = tensor
+            tf.import_graph_def(graph_def, input_map=input_map, name='')
+
+        self.inputs = {key: self.graph.get_tensor_by_name(name) for key, name in self.signature['inputs'].items()}
+        self.outputs = {key: self.graph.get_tensor_by_name(name) for key, name in self.signature['outputs'].items()}
+        self.sess = tf.Session(graph=self.graph, config=config)
+        if load_ops:
+            self.sess.run(load_ops, feed_dict=load_feed_dict)
+
+        self.load_time = time.time() - t
+
+    def run(self, inputs, output='expected_rating'):
+        """ Runs output for inputs, a dict from the input names of the signature to values. """
+        feed_dict = {self.inputs[key]: value for key, value in inputs.items()}
+        return self.sess.run(self.outputs[output], feed_dict=feed_dict)
+
+    def predict(self, user_indices, item_indices, output='expected_rating'):
+        """ Output for the given (user, item) pairs. """
+        return self.run({'user_indices': user_indices, 'item_indices': item_indices}, output=output)
+
+    def close(self):
+        self.sess.close()
@@ -40,6 +40,20 @@ def dropout_sparse(x, keep_prob, num_nonzero_elems):
     return pre_out * tf.div(1., keep_prob)
 
 
+def stack_node_inputs(inputs, sparse_inputs, dropout):
+    """Stacks the user and item inputs of a layer into one (users + items) x input_dim matrix,
+    after dropout. Sparse inputs (e.g. one-hot features) stay sparse, for dot(x, W, sparse=True).
+    :return: the stacked inputs and the number of users
+    """
+    if sparse_inputs:
+        x = tf.sparse_concat(axis=0, sp_inputs=[inputs[0], inputs[1]])
+        x = dropout_sparse(x, 1 - dropout, tf.shape(x.values)[0])
+        return x, inputs[0].dense_shape[0]
+    x = tf.concat([inputs[0], inputs[1]], axis=0)
+    # the static number of rows is unknown for minibatch subgraphs
+    return tf.nn.dropout(x, 1 - dropout), tf.shape(inputs[0])[0]
+
+
 class Layer(object):
     """Base layer class. Defines basic API for all layer objects.
     # Properties
@@ -196,12 +210,7 @@ class OrdinalRGGCN(Layer):
         return var
 
     def _call(self, inputs):
-        num_users = inputs[0].dense_shape[0]
-        num_items = inputs[1].dense_shape[0]
-        users = tf.sparse_to_dense(inputs[0].indices, inputs[0].dense_shape, inputs[0].values)
-        items = tf.sparse_to_dense(inputs[1].indices, inputs[1].dense_shape, inputs[1].values)
-        original_x = tf.concat([users, items], axis=0)  # CHECK THIS! need to combine users and items into one single array. becomes 6000 (users+items) x 6000 (input_dim)
-        original_x = tf.nn.dropout(original_x, 1-self.dropout)
+        original_x, num_users = stack_node_inputs(inputs, self.sparse_inputs, self.dropout)
         
         outputs = []
         Ui1 = 0.
@@ -216,13 +225,13 @@ class OrdinalRGGCN(Layer):
             # E_start, E_end : E x V
             x = original_x
             # conv1
-            Vix = dot(x, Vi1)  # Vi1[i] is 6000x100
-            Vjx = dot(x, Vj1)
+            Vix = dot(x, Vi1, sparse=self.sparse_inputs)  # Vi1[i] is 6000x100
+            Vjx = dot(x, Vj1, sparse=self.sparse_inputs)
             x1 = tf.add(dot(self.E_end[i], Vix, sparse=True), dot(self.E_start[i], Vjx, sparse=True))
             x1 = tf.nn.bias_add(x1, self.bv1)
             x1 = tf.nn.sigmoid(x1)
-            Uix = dot(x, Ui1)
-            Ujx = dot(x, Uj1)
+            Uix = dot(x, Ui1, sparse=self.sparse_inputs)
+            Ujx = dot(x, Uj1, sparse=self.sparse_inputs)
             x2 = dot(self.E_start[i], Ujx, sparse=True)
             x = tf.add(Uix, dot(tf.sparse_transpose(self.E_end[i]), tf.multiply(x1, x2), sparse=True))
             x = tf.nn.bias_add(x, self.bu1)
@@ -258,7 +267,7 @@ class OrdinalRGGCN(Layer):
             outputs.append(x)
 
         output = tf.add_n(outputs)
-        output = tf.add(output, tf.matmul(original_x, self.R))
+        output = tf.add(output, dot(original_x, self.R, sparse=self.sparse_inputs))
         output = tf.nn.relu(output)
 
         u = output[:tf.cast(num_users, tf.int32)]
@@ -322,32 +331,20 @@ class StackRGGCN(Layer):
         return var
 
     def _call(self, inputs):
-        if self.sparse_inputs:
-            num_users = inputs[0].dense_shape[0]
-            num_items = inputs[1].dense_shape[0]
-            users = tf.sparse_to_dense(inputs[0].indices, inputs[0].dense_shape, inputs[0].values)
-            items = tf.sparse_to_dense(inputs[1].indices, inputs[1].dense_shape, inputs[1].values)
-        else:
-            num_users = inputs[0].shape[0]
-            num_items = inputs[1].shape[0]
-            users = inputs[0]
-            items = inputs[1]
-        
-        original_x = tf.concat([users, items], axis=0)  # CHECK THIS! need to combine users and items into one single array. becomes 6000 (users+items) x 6000 (input_dim)
-        original_x = tf.nn.dropout(original_x, 1-self.dropout)
+        original_x, num_users = stack_node_inputs(inputs, self.sparse_inputs, self.dropout)
 
         outputs = []
         for i in range(len(self.E_start)):
             # E_start, E_end : E x V
             x = original_x
             # conv1
-            Vix = dot(x, self.Vi1[i])  # Vij[i] is 6000x100
-            Vjx = dot(x, self.Vj1[i])
+            Vix = dot(x, self.Vi1[i], sparse=self.sparse_inputs)  # Vij[i] is 6000x100
+            Vjx = dot(x, self.Vj1[i], sparse=self.sparse_inputs)
             x1 = tf.add(dot(self.E_end[i], Vix, sparse=True), dot(self.E_start[i], Vjx, sparse=True))
             x1 = tf.nn.bias_add(x1, self.bv1[i])
             x1 = tf.nn.sigmoid(x1)
-            Uix = dot(x, self.Ui1[i])
-            Ujx = dot(x, self.Uj1[i])
+            Uix = dot(x, self.Ui1[i], sparse=self.sparse_inputs)
+            Ujx = dot(x, self.Uj1[i], sparse=self.sparse_inputs)
             x2 = dot(self.E_start[i], Ujx, sparse=True)
             x = tf.add(Uix, dot(tf.sparse_transpose(self.E_end[i]), tf.multiply(x1, x2), sparse=True))
             x = tf.nn.bias_add(x, self.bu1[i])
@@ -356,7 +353,7 @@ class StackRGGCN(Layer):
             outputs.append(x)
         
         output = tf.concat(axis=1, values=outputs)
-        output = tf.add(output, tf.matmul(original_x, self.R))
+        output = tf.add(output, dot(original_x, self.R, sparse=self.sparse_inputs))
         output = tf.nn.relu(output)
 
         u = output[:tf.cast(num_users, tf.int32)]
@@ -428,32 +425,20 @@ class StackRGGCNDouble(Layer):
         return var
 
     def _call(self, inputs):
-        if self.sparse_inputs:
-            num_users = inputs[0].dense_shape[0]
-            num_items = inputs[1].dense_shape[0]
-            users = tf.sparse_to_dense(inputs[0].indices, inputs[0].dense_shape, inputs[0].values)
-            items = tf.sparse_to_dense(inputs[1].indices, inputs[1].dense_shape, inputs[1].values)
-        else:
-            num_users = inputs[0].shape[0]
-            num_items = inputs[1].shape[0]
-            users = inputs[0]
-            items = inputs[1]
-        
-        original_x = tf.concat([users, items], axis=0)  # CHECK THIS! need to combine users and items into one single array. becomes 6000 (users+items) x 6000 (input_dim)
-        original_x = tf.nn.dropout(original_x, 1-self.dropout)
+        original_x, num_users = stack_node_inputs(inputs, self.sparse_inputs, self.dropout)
 
         outputs = []
         for i in range(len(self.E_start)):
             # E_start, E_end : E x V
             x = original_x
             # conv1
-            Vix = dot(x, self.Vi1[i])  # Vij[i] is 6000x100
-            Vjx = dot(x, self.Vj1[i])
+            Vix = dot(x, self.Vi1[i], sparse=self.sparse_inputs)  # Vij[i] is 6000x100
+            Vjx = dot(x, self.Vj1[i], sparse=self.sparse_inputs)
             x1 = tf.add(dot(self.E_end[i], Vix, sparse=True), dot(self.E_start[i], Vjx, sparse=True))
             x1 = tf.nn.bias_add(x1, self.bv1[i])
             x1 = tf.nn.sigmoid(x1)
-            Uix = dot(x, self.Ui1[i])
-            Ujx = dot(x, self.Uj1[i])
+            Uix = dot(x, self.Ui1[i], sparse=self.sparse_inputs)
+            Ujx = dot(x, self.Uj1[i], sparse=self.sparse_inputs)
             x2 = dot(self.E_start[i], Ujx, sparse=True)
             x = tf.add(Uix, dot(tf.sparse_transpose(self.E_end[i]), tf.multiply(x1, x2), sparse=True))
             x = tf.nn.bias_add(x, self.bu1[i])
@@ -480,7 +465,7 @@ class StackRGGCNDouble(Layer):
             outputs.append(x)
 
         output = tf.concat(axis=1, values=outputs)
-        output = tf.add(output, tf.matmul(original_x, self.R))
+        output = tf.add(output, dot(original_x, self.R, sparse=self.sparse_inputs))
         output = tf.nn.relu(output)
 
         u = output[:tf.cast(num_users, tf.int32)]
@@ -552,27 +537,15 @@ class StackSimple(Layer):
         return var
 
     def _call(self, inputs):
-        if self.sparse_inputs:
-            num_users = inputs[0].dense_shape[0]
-            num_items = inputs[1].dense_shape[0]
-            users = tf.sparse_to_dense(inputs[0].indices, inputs[0].dense_shape, inputs[0].values)
-            items = tf.sparse_to_dense(inputs[1].indices, inputs[1].dense_shape, inputs[1].values)
-        else:
-            num_users = inputs[0].shape[0]
-            num_items = inputs[1].shape[0]
-            users = inputs[0]
-            items = inputs[1]
-        
-        original_x = tf.concat([users, items], axis=0)  # CHECK THIS! need to combine users and items into one single array. becomes 6000 (users+items) x 6000 (input_dim)
-        original_x = tf.nn.dropout(original_x, 1-self.dropout)
+        original_x, num_users = stack_node_inputs(inputs, self.sparse_inputs, self.dropout)
 
         outputs = []
         for i in range(len(self.E_start)):
             # E_start, E_end : E x V
             x = original_x
             # conv1
-            Uix = dot(x, self.Ui1[i])
-            Ujx = dot(x, self.Uj1[i])
+            Uix = dot(x, self.Ui1[i], sparse=self.sparse_inputs)
+            Ujx = dot(x, self.Uj1[i], sparse=self.sparse_inputs)
             x2 = dot(self.E_start[i], Ujx, sparse=True)
             x = tf.add(Uix, dot(tf.sparse_transpose(self.E_end[i]), x2, sparse=True))
             x = tf.nn.bias_add(x, self.bu1[i])
@@ -594,7 +567,7 @@ class StackSimple(Layer):
             outputs.append(x)
 
         output = tf.concat(axis=1, values=outputs)
-        output = tf.add(output, tf.matmul(original_x, self.R))
+        output = tf.add(output, dot(original_x, self.R, sparse=self.sparse_inputs))
         output = tf.nn.relu(output)
 
         u = output[:tf.cast(num_users, tf.int32)]
@@ -645,20 +618,8 @@ class Simple(Layer):
         return var
 
     def _call(self, inputs):
-        if self.sparse_inputs:
-            num_users = inputs[0].dense_shape[0]
-            num_items = inputs[1].dense_shape[0]
-            users = tf.sparse_to_dense(inputs[0].indices, inputs[0].dense_shape, inputs[0].values)
-            items = tf.sparse_to_dense(inputs[1].indices, inputs[1].dense_shape, inputs[1].values)
-        else:
-            num_users = inputs[0].shape[0]
-            num_items = inputs[1].shape[0]
-            users = inputs[0]
-            items = inputs[1]
-        
-        x = tf.concat([users, items], axis=0)  # CHECK THIS! need to combine users and items into one single array. becomes 6000 (users+items) x 6000 (input_dim)
-        x = tf.nn.dropout(x, 1-self.dropout)
-        x = tf.nn.bias_add(dot(x, self.W1), self.b1)
+        x, num_users = stack_node_inputs(inputs, self.sparse_inputs, self.dropout)
+        x = tf.nn.bias_add(dot(x, self.W1, sparse=self.sparse_inputs), self.b1)
         x = tf.nn.bias_add(dot(x, self.W2), self.b2)
 
         u = x[:tf.cast(num_users, tf.int32)]
@@ -1015,7 +976,7 @@ class BilinearMixture(Layer):
 
     def __init__(self, num_classes, u_indices, v_indices, input_dim, num_users, num_items, user_item_bias=False,
                  dropout=0., act=tf.nn.softmax, num_weights=3,
-                 diagonal=True, **kwargs):
+                 diagonal=True, fused=False, chunk_size=None, **kwargs):
         super(BilinearMixture, self).__init__(**kwargs)
         with tf.variable_scope(self.name + '_vars'):
 
@@ -1043,37 +1004,81 @@ class BilinearMixture(Layer):
 
         self.num_classes = num_classes
         self.num_weights = num_weights
+        self.input_dim = input_dim
+        self.diagonal = diagonal
         self.u_indices = u_indices
         self.v_indices = v_indices
 
+        # fused decoder: all basis scores from a single matmul, optionally in chunks of pairs
+        self.fused = fused or chunk_size is not None
+        self.chunk_size = chunk_size
+
         self.dropout = dropout
         self.act = act  # default is softmax (as written in paper)
         if self.logging:
             self._log_vars()
 
+    def _fused_basis_outputs(self, u_inputs, v_inputs, basis):
+        """ Scores of all basis matrices for gathered (user, item) pairs, num_pairs x num_weights. """
+        if self.diagonal:
+            # basis is num_weights x input_dim
+            return tf.matmul(tf.multiply(u_inputs, v_inputs), basis, transpose_b=True)
+
+        # basis is input_dim x (num_weights * input_dim), i.e. [Q_0 | Q_1 | ...]
+        u_w = tf.reshape(tf.matmul(u_inputs, basis), [-1, self.num_weights, self.input_dim])
+        return tf.reduce_sum(tf.multiply(u_w, tf.expand_dims(v_inputs, 1)), axis=2)
+
     def _call(self, inputs):
 
         u_inputs = tf.nn.dropout(inputs[0], 1 - self.dropout)
         v_inputs = tf.nn.dropout(inputs[1], 1 - self.dropout)
 
-        u_inputs = tf.gather(u_inputs, self.u_indices) # only predicting for these indices
-        v_inputs = tf.gather(v_inputs, self.v_indices)
-        # u_inputs = tf.gather(u_inputs, [0, 1, 200, 2999]) # this won't work because u_indices only has 2999 elements
-
         if self.user_item_bias:
             u_bias = tf.gather(self.vars['user_bias'], self.u_indices)
             v_bias = tf.gather(self.vars['item_bias'], self.v_indices)
 
-        basis_outputs = []
-        for i in range(self.num_weights):
+        if self.fused:
+            weights = [self.vars['weights_%d' % i] for i in range(self.num_weights)]
+            if self.diagonal:
+                basis = tf.concat(weights, axis=0)
+            else:
+                basis = tf.concat(weights, axis=1)
+
+            if self.chunk_size is None:
+                basis_outputs = self._fused_basis_outputs(tf.gather(u_inputs, self.u_indices),
+                                                          tf.gather(v_inputs, self.v_indices), basis)
+            else:
+                # pad the pairs to a multiple of chunk_size and score one chunk at a time,
+                # so that only a chunk_size x num_weights x input_dim intermediate is live
+                num_pairs = tf.shape(self.u_indices)[0]
+                num_chunks = (num_pairs + self.chunk_size - 1) // self.chunk_size
+                padding = [[0, num_chunks * self.chunk_size - num_pairs]]
+                u_chunks = tf.reshape(tf.pad(self.u_indices, padding), [-1, self.chunk_size])
+                v_chunks = tf.reshape(tf.pad(self.v_indices, padding), [-1, self.chunk_size])
+
+                def score_chunk(chunk):
+                    return self._fused_basis_outputs(tf.gather(u_inputs, chunk[0]),
+                                                     tf.gather(v_inputs, chunk[1]), basis)
+
+                basis_outputs = tf.map_fn(score_chunk, (u_chunks, v_chunks), dtype=tf.float32,
+                                          parallel_iterations=1)
+                basis_outputs = tf.reshape(basis_outputs, [-1, self.num_weights])[:num_pairs]
+
+        else:
+            u_inputs = tf.gather(u_inputs, self.u_indices) # only predicting for these indices
+            v_inputs = tf.gather(v_inputs, self.v_indices)
+            # u_inputs = tf.gather(u_inputs, [0, 1, 200, 2999]) # this won't work because u_indices only has 2999 elements
+
+            basis_outputs = []
+            for i in range(self.num_weights):
 
-            u_w = self._multiply_inputs_weights(u_inputs, self.vars['weights_%d' % i])
-            x = tf.reduce_sum(tf.multiply(u_w, v_inputs), axis=1)
+                u_w = self._multiply_inputs_weights(u_inputs, self.vars['weights_%d' % i])
+                x = tf.reduce_sum(tf.multiply(u_w, v_inputs), axis=1)
 
-            basis_outputs.append(x)
+                basis_outputs.append(x)
 
-        # Store outputs in (Nu x Nv) x num_classes (num_weights?) tensor and apply activation function. (activation function only applied later?)
-        basis_outputs = tf.stack(basis_outputs, axis=1)
+            # Store outputs in (Nu x Nv) x num_classes (num_weights?) tensor and apply activation function. (activation function only applied later?)
+            basis_outputs = tf.stack(basis_outputs, axis=1)
 
         outputs = tf.matmul(basis_outputs,  self.vars['weights_scalars'], transpose_b=False)
 
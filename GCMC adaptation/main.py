@@ -10,6 +10,7 @@ import tensorflow as tf
 import numpy as np
 import scipy.sparse as sp
 import sys
+import os
 import json
 from tqdm import tqdm
 
@@ -18,9 +19,29 @@ from preprocessing import create_trainvaltest_split, \
 	load_data_monti, load_official_trainvaltest_split, normalize_features, get_edges_matrices
 from model import RecommenderGAE, RecommenderSideInfoGAE
 from utils import construct_feed_dict
+from resident import ResidentInputs
+from embeddings import export_embeddings
+from inference import export_inference_graph, export_decoder_graph
+from quantize import export_quantized, accuracy_report
+from checkpoints import CheckpointManager, default_run_dir
+from controller import TrainingController
+from polyak import PolyakAverages
+from telemetry import Telemetry, num_edges, FILENAME as TELEMETRY_FILE
+from execution import session_config, jit_scope, compile_time, profile_key, resolve_profile, apply_cpu_affinity
 
 def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HIDDEN=[100, 75], FEATHIDDEN=64, LR=0.01, decay_rate=1.25, consecutive_threshold=5, 
-	FEATURES=False, SYM=True, TESTING=False, ACCUM='stackRGGCN', NUM_LAYERS=1, GCMC_INDICES=False):
+	FEATURES=False, SYM=True, TESTING=False, ACCUM='stackRGGCN', NUM_LAYERS=1, GCMC_INDICES=False,
+	FUSED_DECODER=False, DECODER_CHUNK=None, JIT=False, AUTOTUNE=False, PIN_CPUS=False, RESIDENT=True,
+	EXPORTDIR=None, INFERENCE_GRAPH=None, QUANTIZE=None, RUNDIR=None, CHECKPOINT_EVERY=0, KEEP_CHECKPOINTS=3,
+	PATIENCE=0, PLATEAU_DECAY=False, RESTORE_BEST=False, POLYAK_EVERY=0, TELEMETRY=False):
+	# the arguments of the run, for the telemetry file
+	settings = dict(locals())
+
+	# the row-sliced supports of GCMC_INDICES only cover the users and items of one split,
+	# which the exported embeddings and inference graph can not be built from
+	if EXPORTDIR is not None and GCMC_INDICES:
+		raise ValueError('EXPORTDIR can not be combined with GCMC_INDICES')
+
 	np.random.seed(random_seed)
 	tf.set_random_seed(random_seed)
 
@@ -81,6 +102,7 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 
 	num_users, num_items = adj_train.shape
 	num_side_features = 0
+	num_user_side_features = 0
 
 	# feature loading
 	if not FEATURES:
@@ -102,6 +124,7 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 		v_features_side = np.array(v_features_side.todense(), dtype=np.float32)
 
 		num_side_features = u_features_side.shape[1]
+		num_user_side_features = u_features.shape[1]
 
 		# node id's for node input features
 		id_csr_v = sp.identity(num_items, format='csr')
@@ -225,6 +248,14 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 		train_u_features_side = None
 		train_v_features_side = None
 
+	# XLA specializes on static shapes. The full-graph supports keep their shape across steps,
+	# their row-sliced versions (GCMC_INDICES) do not.
+	if JIT and not GCMC_INDICES:
+		support_shape = support.shape
+		support_t_shape = support_t.shape
+	else:
+		support_shape = support_t_shape = (None, None)
+
 	placeholders = {
 		'u_features': tf.sparse_placeholder(tf.float32, shape=np.array(u_features.shape, dtype=np.int64)),
 		'v_features': tf.sparse_placeholder(tf.float32, shape=np.array(v_features.shape, dtype=np.int64)),
@@ -243,10 +274,25 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 		'dropout': tf.placeholder_with_default(0., shape=()),
 		'weight_decay': tf.placeholder_with_default(0., shape=()),
 
-		'support': tf.sparse_placeholder(tf.float32, shape=(None, None)),
-		'support_t': tf.sparse_placeholder(tf.float32, shape=(None, None)),
+		'support': tf.sparse_placeholder(tf.float32, shape=support_shape),
+		'support_t': tf.sparse_placeholder(tf.float32, shape=support_t_shape),
 	}
 
+	# the features stay the same across steps and splits, the supports only if they are not
+	# row-sliced per split (GCMC_INDICES)
+	if RESIDENT:
+		resident = ResidentInputs()
+		placeholders['u_features'] = resident.sparse('u_features', shape=u_features.shape)
+		placeholders['v_features'] = resident.sparse('v_features', shape=v_features.shape)
+		placeholders['u_features_nonzero'] = resident.dense('u_features_nonzero', tf.int32)
+		placeholders['v_features_nonzero'] = resident.dense('v_features_nonzero', tf.int32)
+		placeholders['class_values'] = resident.dense('class_values', tf.float32, class_values.shape)
+		if not GCMC_INDICES:
+			placeholders['support'] = resident.sparse('support', shape=support_shape)
+			placeholders['support_t'] = resident.sparse('support_t', shape=support_t_shape)
+	else:
+		resident = None
+
 	##################################################################################################################
 	E_start, E_end = get_edges_matrices(adj_train)
 	# E_start = sp.hstack(E_start, format='csr')  # confirm if vstack is correct and not hstack
@@ -258,43 +304,53 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 	placeholders['E_start_list'] = []
 	placeholders['E_end_list'] = []
 	for i in range(num_support):
-		placeholders['E_start_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
-		placeholders['E_end_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
+		E_shape = E_start[i].shape if JIT else (None, None)
+		if RESIDENT:
+			placeholders['E_start_list'].append(resident.sparse('E_start_%d' % i, shape=E_shape))
+			placeholders['E_end_list'].append(resident.sparse('E_end_%d' % i, shape=E_shape))
+		else:
+			placeholders['E_start_list'].append(tf.sparse_placeholder(tf.float32, shape=E_shape))
+			placeholders['E_end_list'].append(tf.sparse_placeholder(tf.float32, shape=E_shape))
 
 	# print('shape of E_end for first rating type: {}'.format(E_end[0].toarray().shape))
 
 	##################################################################################################################
 
 	# create model
-	if FEATURES:
-		model = RecommenderSideInfoGAE(placeholders,
-									   input_dim=u_features.shape[1],
-									   feat_hidden_dim=FEATHIDDEN,
-									   num_classes=NUMCLASSES,
-									   num_support=num_support,
-									   self_connections=SELFCONNECTIONS,
-									   num_basis_functions=BASES,
-									   hidden=HIDDEN,
-									   num_users=num_users,
-									   num_items=num_items,
-									   accum=ACCUM,
-									   learning_rate=LR,
-									   num_side_features=num_side_features,
-									   logging=True)
-	else:
-		model = RecommenderGAE(placeholders,
-							   input_dim=u_features.shape[1],
-							   num_classes=NUMCLASSES,
-							   num_support=num_support,
-							   self_connections=SELFCONNECTIONS,
-							   num_basis_functions=BASES,
-							   hidden=HIDDEN,
-							   num_users=num_users,
-							   num_items=num_items,
-							   accum=ACCUM,
-							   learning_rate=LR,
-							   num_layers=NUM_LAYERS,
-							   logging=True)
+	with jit_scope(JIT):
+		if FEATURES:
+			model = RecommenderSideInfoGAE(placeholders,
+										   input_dim=u_features.shape[1],
+										   feat_hidden_dim=FEATHIDDEN,
+										   num_classes=NUMCLASSES,
+										   num_support=num_support,
+										   self_connections=SELFCONNECTIONS,
+										   num_basis_functions=BASES,
+										   hidden=HIDDEN,
+										   num_users=num_users,
+										   num_items=num_items,
+										   accum=ACCUM,
+										   learning_rate=LR,
+										   num_side_features=num_side_features,
+										   fused_decoder=FUSED_DECODER,
+										   decoder_chunk_size=DECODER_CHUNK,
+										   logging=True)
+		else:
+			model = RecommenderGAE(placeholders,
+								   input_dim=u_features.shape[1],
+								   num_classes=NUMCLASSES,
+								   num_support=num_support,
+								   self_connections=SELFCONNECTIONS,
+								   num_basis_functions=BASES,
+								   hidden=HIDDEN,
+								   num_users=num_users,
+								   num_items=num_items,
+								   accum=ACCUM,
+								   learning_rate=LR,
+								   num_layers=NUM_LAYERS,
+								   fused_decoder=FUSED_DECODER,
+								   decoder_chunk_size=DECODER_CHUNK,
+								   logging=True)
 
 	# Convert sparse placeholders to tuples to construct feed_dict. sparse placeholders expect tuple of (indices, values, shape)
 	test_support = sparse_to_tuple(test_support)
@@ -342,13 +398,32 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 										 test_labels, test_u_indices, test_v_indices, class_values, 0.,
 										 test_u_features_side, test_v_features_side, test_E_start, test_E_end)
 
+	# evaluation head and swap ops for the Polyak averages
+	polyak = PolyakAverages(model)
 
 	# Collect all variables to be logged into summary
 	merged_summary = tf.summary.merge_all()
 
-	sess = tf.Session()
+	# thread pool sizes (and CPU pinning) stored for this configuration, tuned first if requested.
+	# Tuning raises once a session exists in the process, i.e. AUTOTUNE only works on the first
+	# run of e.g. hyperparam_search.py, later runs load the stored profile
+	profile = resolve_profile(profile_key('full_batch', DATASET, ACCUM, HIDDEN), [model.training_op, model.loss], train_feed_dict,
+							  num_support, tune=AUTOTUNE, pin_cpus=PIN_CPUS, jit=JIT)
+	apply_cpu_affinity(profile)
+
+	sess = tf.Session(config=session_config(jit=JIT, profile=profile))
 	sess.run(tf.global_variables_initializer())
 
+	if resident is not None:
+		# load the static inputs once, from then on only the per-step tensors are fed
+		resident.load(sess, train_feed_dict)
+		for feed_dict in (train_feed_dict, val_feed_dict, test_feed_dict):
+			resident.strip(feed_dict)
+
+	run_dir = RUNDIR if RUNDIR is not None else default_run_dir(model.name, DATASET)
+	checkpoints = CheckpointManager(sess, model, run_dir, keep_last=KEEP_CHECKPOINTS)
+	telemetry = Telemetry(os.path.join(run_dir, TELEMETRY_FILE) if TELEMETRY else None, settings=settings)
+
 	if WRITESUMMARY:
 		train_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/train', sess.graph)
 		val_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/val')
@@ -380,29 +455,41 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 	old_loss = float('inf')
 	# print('Original learning rate is {}'.format(sess.run(model.optimizer._lr)))
 
+	controller = TrainingController(sess, model, LR, patience=PATIENCE,
+									lr_patience=consecutive_threshold if PLATEAU_DECAY else 0, decay_rate=decay_rate,
+									restore_best=RESTORE_BEST, assign_op=assign_op,
+									assign_placeholder=assign_placeholder, verbose=VERBOSE)
+
 	train_rmses, val_rmses, train_losses, val_losses = [], [], [], []
+	# wall times of the train and validation runs. With JIT the first run of each includes XLA compilation.
+	train_step_times, val_step_times = [], []
+	# message passing edges (nonzeros of the supports) and rated pairs of a training step
+	train_edges = num_edges(train_support, train_support_t)
+	train_pairs = len(train_labels)
 	for epoch in tqdm(range(NB_EPOCH)):
 		t = time.time()
+		record = telemetry.step(epoch)
 		# Run single weight update
 		# outs = sess.run([model.opt_op, model.loss, model.rmse], feed_dict=train_feed_dict)
 		# with exponential moving averages
-		outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict)
+		with record.time('train'):
+			outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict)
+		train_step_times.append(record.times['train'])
+		record.count(edges=train_edges, pairs=train_pairs)
 
 		train_avg_loss = outs[1]
 		train_rmse = outs[2]
 
-		val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
-
-		# if train_avg_loss > 0.999*old_loss:
-		# 	consecutive += 1
-		# 	if consecutive >= consecutive_threshold:
-		# 		LR /= decay_rate
-		# 		sess.run(assign_op, feed_dict={assign_placeholder: LR})
-		# 		print('New learning rate is {}'.format(sess.run(model.optimizer._lr)))
-		# 		consecutive = 0
-		# else:
-		# 	consecutive = 0
-		# old_loss = train_avg_loss
+		with record.time('eval'):
+			if POLYAK_EVERY > 0 and (epoch + 1) % POLYAK_EVERY == 0:
+				# raw and Polyak-averaged parameters in one run, without touching the variables
+				val_avg_loss, val_rmse, polyak_val_loss, polyak_val_rmse = polyak.evaluate(sess, val_feed_dict)
+				if VERBOSE:
+					print("[*] Polyak:", "polyak_val_loss=", "{:.5f}".format(polyak_val_loss),
+						  "polyak_val_rmse=", "{:.5f}".format(polyak_val_rmse))
+			else:
+				val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+		val_step_times.append(record.times['eval'])
 
 		train_rmses.append(train_rmse)
 		val_rmses.append(val_rmse)
@@ -419,74 +506,108 @@ def run(DATASET='douban', DATASEED=1234, random_seed=123, NB_EPOCH=200, DO=0, HI
 		if val_rmse < best_val_score:
 			best_val_score = val_rmse
 			best_epoch = epoch
+			checkpoints.save_best(epoch, val_rmse)
 
-		if epoch % 20 == 0 and WRITESUMMARY:
-			# Train set summary
-			summary = sess.run(merged_summary, feed_dict=train_feed_dict)
-			train_summary_writer.add_summary(summary, epoch)
-			train_summary_writer.flush()
-
-			# Validation set summary
-			summary = sess.run(merged_summary, feed_dict=val_feed_dict)
-			val_summary_writer.add_summary(summary, epoch)
-			val_summary_writer.flush()
+		# early stopping and plateau learning rate decay
+		stop = controller.update(epoch, val_rmse)
 
-		if epoch % 100 == 0 and epoch > 1000 and not TESTING and False:
-			saver = tf.train.Saver()
-			save_path = saver.save(sess, "tmp/%s_seed%d.ckpt" % (model.name, DATASEED), global_step=model.global_step)
+		if epoch % 20 == 0 and WRITESUMMARY:
+			with record.time('summary'):
+				# Train set summary
+				summary = sess.run(merged_summary, feed_dict=train_feed_dict)
+				train_summary_writer.add_summary(summary, epoch)
+				train_summary_writer.flush()
 
-			# load polyak averages
-			variables_to_restore = model.variable_averages.variables_to_restore()
-			saver = tf.train.Saver(variables_to_restore)
-			saver.restore(sess, save_path)
+				# Validation set summary
+				summary = sess.run(merged_summary, feed_dict=val_feed_dict)
+				val_summary_writer.add_summary(summary, epoch)
+				val_summary_writer.flush()
 
-			val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+		if CHECKPOINT_EVERY > 0 and epoch > 0 and epoch % CHECKPOINT_EVERY == 0:
+			# snapshot only, the checkpoint is written in the background
+			checkpoints.save(epoch)
 
-			print('polyak val loss = ', val_avg_loss)
-			print('polyak val rmse = ', val_rmse)
+		telemetry.write(record)
 
-			# Load back normal variables
-			saver = tf.train.Saver()
-			saver.restore(sess, save_path)
+		if stop:
+			break
 
 
-	# store model including exponential moving averages
-	saver = tf.train.Saver()
-	save_path = saver.save(sess, "tmp/%s.ckpt" % model.name, global_step=model.global_step)
+	# store model including exponential moving averages (the best one with RESTORE_BEST)
+	controller.finish(checkpoints, epoch + 1)
 
 
 	if VERBOSE:
 		print("\nOptimization Finished!")
 		print('best validation score =', best_val_score, 'at iteration', best_epoch)
 
+	if JIT:
+		print('XLA compile time = ', compile_time(train_step_times) + compile_time(val_step_times))
+		print('median train step time = ', np.median(train_step_times[1:] or train_step_times))
+		print('median val step time = ', np.median(val_step_times[1:] or val_step_times))
+
 
 	if TESTING:
-		test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
+		# raw and polyak averages of parameters in one run
+		test_avg_loss, test_rmse, polyak_test_loss, polyak_test_rmse = polyak.evaluate(sess, test_feed_dict)
 		print('test loss = ', test_avg_loss)
 		print('test rmse = ', test_rmse)
-
-		# restore with polyak averages of parameters
-		variables_to_restore = model.variable_averages.variables_to_restore()
-		saver = tf.train.Saver(variables_to_restore)
-		saver.restore(sess, save_path)
-
-		test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
-		print('polyak test loss = ', test_avg_loss)
-		print('polyak test rmse = ', test_rmse)
-
+		print('polyak test loss = ', polyak_test_loss)
+		print('polyak test rmse = ', polyak_test_rmse)
+		test_rmse = polyak_test_rmse
+
+		# load the polyak averages of parameters into the model for the export
+		polyak.load(sess)
+
+		if EXPORTDIR is not None:
+			export_embeddings(sess, model, test_feed_dict, class_values, EXPORTDIR,
+							  adj_train=adj_train, symmetric=SYM, num_user_side_features=num_user_side_features)
+
+			if INFERENCE_GRAPH == 'decoder':
+				export_decoder_graph(EXPORTDIR)
+			elif INFERENCE_GRAPH == 'full':
+				inference_feed_dict = dict(test_feed_dict)
+				if FEATURES:
+					inference_feed_dict.update({placeholders['u_features_side']: u_features_side,
+												placeholders['v_features_side']: v_features_side})
+				export_inference_graph(sess, model, placeholders, inference_feed_dict, class_values, EXPORTDIR)
+
+			if QUANTIZE is not None:
+				export_quantized(EXPORTDIR, QUANTIZE)
+				accuracy_report(EXPORTDIR, QUANTIZE, test_u_indices, test_v_indices, class_values[test_labels])
+
+		checkpoints.close()
+		telemetry.close(best_val_score=best_val_score, best_epoch=best_epoch)
 		sess.close()
 		tf.reset_default_graph()
 		return train_rmses, val_rmses, train_losses, val_losses, test_rmse
 	else:
-		# restore with polyak averages of parameters
-		variables_to_restore = model.variable_averages.variables_to_restore()
-		saver = tf.train.Saver(variables_to_restore)
-		saver.restore(sess, save_path)
-
-		val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+		_, _, val_avg_loss, val_rmse = polyak.evaluate(sess, val_feed_dict)
 		print('polyak val loss = ', val_avg_loss)
 		print('polyak val rmse = ', val_rmse)
 
+		# load the polyak averages of parameters into the model for the export
+		polyak.load(sess)
+
+		if EXPORTDIR is not None:
+			export_embeddings(sess, model, val_feed_dict, class_values, EXPORTDIR,
+							  adj_train=adj_train, symmetric=SYM, num_user_side_features=num_user_side_features)
+
+			if INFERENCE_GRAPH == 'decoder':
+				export_decoder_graph(EXPORTDIR)
+			elif INFERENCE_GRAPH == 'full':
+				inference_feed_dict = dict(val_feed_dict)
+				if FEATURES:
+					inference_feed_dict.update({placeholders['u_features_side']: u_features_side,
+												placeholders['v_features_side']: v_features_side})
+				export_inference_graph(sess, model, placeholders, inference_feed_dict, class_values, EXPORTDIR)
+
+			if QUANTIZE is not None:
+				export_quantized(EXPORTDIR, QUANTIZE)
+				accuracy_report(EXPORTDIR, QUANTIZE, val_u_indices, val_v_indices, class_values[val_labels])
+
+		checkpoints.close()
+		telemetry.close(best_val_score=best_val_score, best_epoch=best_epoch)
 		sess.close()
 		tf.reset_default_graph()
 		return train_rmses, val_rmses, train_losses, val_losses, val_rmse
@@ -0,0 +1,414 @@
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from preprocessing import sparse_to_tuple
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class SideFeatureStore(object):
+    """
+    Side features of all users and items, of which a minibatch only gathers the rows of its
+    users and items, as dense float32 arrays for the side feature placeholders. They are
+    kept as sparse matrices, or as dense arrays such as memory-mapped .npy files (see
+    memmap), so the dense side features of all nodes never have to be in memory.
+    """
+
+    U_FILE = 'u_features_side.npy'
+    V_FILE = 'v_features_side.npy'
+
+    def __init__(self, u_features_side, v_features_side):
+        """
+        :param u_features_side, v_features_side: scipy sparse matrices or (memory-mapped) arrays
+        """
+        if sp.issparse(u_features_side):
+            u_features_side = sp.csr_matrix(u_features_side, dtype=np.float32)
+        if sp.issparse(v_features_side):
+            v_features_side = sp.csr_matrix(v_features_side, dtype=np.float32)
+        self.u_features_side = u_features_side
+        self.v_features_side = v_features_side
+        self.num_features = u_features_side.shape[1]
+
+    @staticmethod
+    def _write(path, features, chunk_size=4096):
+        # row chunks, so that sparse features are never densified as a whole
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=features.shape)
+        for start in range(0, features.shape[0], chunk_size):
+            chunk = features[start:start + chunk_size]
+            out[start:start + chunk_size] = chunk.toarray() if sp.issparse(chunk) else chunk
+        out.flush()
+        del out
+
+    @classmethod
+    def memmap(cls, directory, u_features_side=None, v_features_side=None):
+        """
+        Store with the side features in memory-mapped .npy files in directory. If given, the
+        side features are written to the files first, otherwise the existing files are used.
+        """
+        u_path = os.path.join(directory, cls.U_FILE)
+        v_path = os.path.join(directory, cls.V_FILE)
+        if u_features_side is not None and v_features_side is not None:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            cls._write(u_path, u_features_side)
+            cls._write(v_path, v_features_side)
+        return cls(np.load(u_path, mmap_mode='r'), np.load(v_path, mmap_mode='r'))
+
+    @staticmethod
+    def _rows(features, indices):
+        rows = features[np.asarray(indices)]
+        if sp.issparse(rows):
+            return rows.toarray()
+        return np.asarray(rows, dtype=np.float32)
+
+    def users(self, indices):
+        return self._rows(self.u_features_side, indices)
+
+    def items(self, indices):
+        return self._rows(self.v_features_side, indices)
+
+
+class MinibatchBuilder(object):
+    """
+    Builds the subgraph of a minibatch of (user, item, label) training pairs: the rows of
+    the supports of the users and items in the batch, and the pair indices remapped to the
+    rows of the subgraph.
+    """
+
+    def __init__(self, support, support_t, edge_dropout=None, side_features=None):
+        """
+        :param support: num_users x (num_items * num_support) hstacked normalized supports
+        :param support_t: num_items x (num_users * num_support) hstacked normalized supports
+        :param edge_dropout: optional EdgeDropout, resampled for every minibatch
+        :param side_features: optional SideFeatureStore
+        """
+        self.support = support
+        self.support_t = support_t
+        self.edge_dropout = edge_dropout
+        self.side_features = side_features
+
+    def build(self, u_indices, v_indices, labels, random=None):
+        """
+        :param random: optional np.random.RandomState for the edge dropout
+        :return: dict with the support and support_t rows of the batch nodes (as sparse tuples),
+            the local user and item indices of the pairs, their labels and the global user and
+            item indices of the subgraph rows, and with side features their rows of the
+            subgraph (u_features_side, v_features_side)
+        """
+
+        # local index of a node: its rank among the distinct nodes of the batch
+        users, u_local = np.unique(u_indices, return_inverse=True)
+        items, v_local = np.unique(v_indices, return_inverse=True)
+
+        if self.edge_dropout is not None:
+            # resample the training edges and renormalize the supports for this step
+            support, support_t = self.edge_dropout.supports(self.edge_dropout.sample(random))
+        else:
+            support, support_t = self.support, self.support_t
+
+        batch = {'support': sparse_to_tuple(support[users]),
+                 'support_t': sparse_to_tuple(support_t[items]),
+                 'u_indices': u_local,
+                 'v_indices': v_local,
+                 'labels': labels,
+                 'users': users,
+                 'items': items}
+        return _add_side_features(batch, self.side_features)
+
+
+def _add_side_features(batch, side_features):
+    """ Adds the side features of the users and items of the subgraph to batch. """
+    if side_features is not None:
+        batch['u_features_side'] = side_features.users(batch['users'])
+        batch['v_features_side'] = side_features.items(batch['items'])
+    return batch
+
+
+def _node_edges(node_of_edge, num_nodes):
+    """ CSR-like index of the edges of every node: edges of node n are order[ptr[n]:ptr[n + 1]]. """
+    order = np.argsort(node_of_edge, kind='mergesort')
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(node_of_edge, minlength=num_nodes))])
+    return order, ptr
+
+
+def _gather_edges(order, ptr, nodes):
+    """ Ids of all edges of the given nodes. """
+    starts = ptr[nodes]
+    counts = ptr[nodes + 1] - starts
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # position of every gathered edge in order: start of its node plus its rank within the node
+    offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    return order[offsets + np.arange(total)]
+
+
+def _sample_edges(order, ptr, nodes, fanout=None, keep=None, random=None):
+    """
+    Ids of the edges of the given nodes, at most fanout random ones per node (all of them
+    without fanout), among the edges where keep is True (all of them without keep).
+    """
+    random = random if random is not None else np.random
+    counts = ptr[nodes + 1] - ptr[nodes]
+    edges = _gather_edges(order, ptr, nodes)
+    node = np.repeat(np.arange(nodes.shape[0]), counts)
+    if keep is not None:
+        kept = keep[edges]
+        edges = edges[kept]
+        node = node[kept]
+    if fanout is None or edges.shape[0] == 0:
+        return edges
+
+    # random order within every node, then the first fanout edges of each node
+    shuffled = np.lexsort((random.random_sample(edges.shape[0]), node))
+    node = node[shuffled]
+    rank = np.arange(node.shape[0]) - np.searchsorted(node, node, side='left')
+    return edges[shuffled[rank < fanout]]
+
+
+def _incidence(edge_nodes, num_nodes):
+    """ num_edges x num_nodes incidence matrix with a single one per row, as a sparse tuple. """
+    num_edges = edge_nodes.shape[0]
+    coords = np.stack([np.arange(num_edges, dtype=np.int64), edge_nodes.astype(np.int64)], axis=1)
+    return coords, np.ones(num_edges, dtype=np.float32), (num_edges, num_nodes)
+
+
+class IncidenceMinibatchBuilder(object):
+    """
+    Builds the subgraph of a minibatch for the RGGCN layers (stackRGGCN, sumRGGCN, stackSimple),
+    which take the edges as E_start/E_end incidence matrices over all users and items instead
+    of the supports.
+
+    The subgraph holds the training edges of the users and items of the batch and their
+    end points: its nodes are the batch nodes and their neighbours, users first and items
+    after them, as in get_edges_matrices. Every edge is stored once in each direction, and
+    the incidence matrices and feature rows only cover the nodes of the subgraph. Neighbours
+    only see their edges to the batch nodes, like in sampled-subgraph training.
+
+    With fanout, every batch node keeps at most fanout of its edges, resampled at every
+    build, so the subgraph has at most fanout edges per batch node and its memory depends
+    on the batch size only, and not on the degrees of the nodes or the size of the graph.
+    """
+
+    def __init__(self, adj_train, num_classes, u_features, v_features, edge_dropout=None, side_features=None,
+                 fanout=None):
+        """
+        :param adj_train: num_users x num_items sparse matrix of training ratings, with
+            values 1, ..., num_classes (class index + 1)
+        :param num_classes: number of rating classes, i.e. number of incidence matrices
+        :param u_features, v_features: sparse feature matrices of all users and items
+        :param edge_dropout: optional EdgeDropout built from the same adj_train, resampled for
+            every minibatch
+        :param side_features: optional SideFeatureStore
+        :param fanout: optional maximum number of edges sampled per batch node
+        """
+        # same edge order as EdgeDropout, so that its keep masks apply to the edge ids
+        adj = sp.coo_matrix(adj_train)
+        self.num_users, self.num_items = adj.shape
+        self.num_classes = num_classes
+        self.rows = adj.row.astype(np.int64)
+        self.cols = adj.col.astype(np.int64)
+        self.classes = np.rint(adj.data).astype(np.int64) - 1
+
+        self.user_edges = _node_edges(self.rows, self.num_users)
+        self.item_edges = _node_edges(self.cols, self.num_items)
+
+        self.u_features = sp.csr_matrix(u_features)
+        self.v_features = sp.csr_matrix(v_features)
+        self.edge_dropout = edge_dropout
+        self.side_features = side_features
+        self.fanout = fanout
+
+    def build(self, u_indices, v_indices, labels, random=None):
+        """
+        :param random: optional np.random.RandomState for the edge dropout and the neighbour sampling
+        :return: dict with the per-class E_start and E_end incidence matrices and the feature
+            rows of the subgraph (as sparse tuples) with their number of non-zeros, the local
+            user and item indices of the pairs, their labels and the global user and item
+            indices of the subgraph rows, and with side features their rows of the subgraph
+        """
+        u_indices = np.asarray(u_indices, dtype=np.int64)
+        v_indices = np.asarray(v_indices, dtype=np.int64)
+
+        # edge dropout before the sampling, so that the fanout is filled with kept edges
+        keep = self.edge_dropout.sample(random) if self.edge_dropout is not None else None
+        edges = np.union1d(_sample_edges(self.user_edges[0], self.user_edges[1], np.unique(u_indices),
+                                         self.fanout, keep, random),
+                           _sample_edges(self.item_edges[0], self.item_edges[1], np.unique(v_indices),
+                                         self.fanout, keep, random))
+
+        rows = self.rows[edges]
+        cols = self.cols[edges]
+        classes = self.classes[edges]
+
+        # local index of a node: its rank among the nodes of the subgraph
+        users, u_local = np.unique(np.concatenate([u_indices, rows]), return_inverse=True)
+        items, v_local = np.unique(np.concatenate([v_indices, cols]), return_inverse=True)
+        num_users = users.shape[0]
+        num_nodes = num_users + items.shape[0]
+        rows_local = u_local[u_indices.shape[0]:]
+        cols_local = v_local[v_indices.shape[0]:] + num_users
+
+        E_start = []
+        E_end = []
+        for i in range(self.num_classes):
+            mask = classes == i
+            # user -> item edges first, then item -> user edges
+            E_start.append(_incidence(np.concatenate([rows_local[mask], cols_local[mask]]), num_nodes))
+            E_end.append(_incidence(np.concatenate([cols_local[mask], rows_local[mask]]), num_nodes))
+
+        u_features = sparse_to_tuple(self.u_features[users])
+        v_features = sparse_to_tuple(self.v_features[items])
+
+        batch = {'E_start': E_start,
+                 'E_end': E_end,
+                 'u_features': u_features,
+                 'v_features': v_features,
+                 'u_features_nonzero': u_features[1].shape[0],
+                 'v_features_nonzero': v_features[1].shape[0],
+                 'u_indices': u_local[:u_indices.shape[0]],
+                 'v_indices': v_local[:v_indices.shape[0]],
+                 'labels': labels,
+                 'users': users,
+                 'items': items}
+        return _add_side_features(batch, self.side_features)
+
+
+_DONE = object()
+
+
+class BatchProducer(object):
+    """
+    Prepares minibatches on num_workers background threads while the training step runs,
+    and hands them over through a queue of at most prefetch batches. Every epoch visits
+    the training pairs in a new random order. Only the index permutation is shuffled, each
+    batch gathers its own pairs, so there is no copy of the training arrays per epoch.
+
+    Iterating yields (epoch, batch_iter, batch) with batch as returned by builder.build,
+    plus the time the worker spent building it as batch['build_time'].
+    Several training threads can instead share the producer through next_batch.
+    Batches are handed over in order, even though the workers finish them in any order,
+    and the batches of the next epoch are prepared before the current one is finished.
+    The shuffling and every batch draw from their own random states, seeded from np.random
+    when the producer is created, so the batches do not depend on the number of workers
+    or on the timing of the threads.
+    Like data_iterator, the last remainder of less than batch_size pairs is dropped.
+    """
+
+    def __init__(self, builder, u_indices, v_indices, labels, batch_size, num_epochs, num_workers=2, prefetch=4):
+        self.builder = builder
+        self.u_indices = np.asarray(u_indices)
+        self.v_indices = np.asarray(v_indices)
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.num_workers = max(num_workers, 1)
+        self.num_batches = self.labels.shape[0] // batch_size
+
+        self._tasks = queue.Queue(maxsize=prefetch)
+        self._batches = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._error = None
+        self._consumer_lock = threading.Lock()
+        self._done = 0
+        self._random = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+        # batches that arrived before the ones scheduled earlier, by their position in the schedule
+        self._pending = {}
+        self._next = 0
+
+        self._threads = [threading.Thread(target=self._schedule)]
+        self._threads += [threading.Thread(target=self._work) for _ in range(self.num_workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, q, item):
+        # a timeout, so that the threads notice close while the queue is full
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _schedule(self):
+        position = 0
+        for epoch in range(self.num_epochs):
+            order = self._random.permutation(self.labels.shape[0])
+            for batch_iter in range(self.num_batches):
+                idx = order[batch_iter * self.batch_size:(batch_iter + 1) * self.batch_size]
+                seed = self._random.randint(2 ** 31 - 1)
+                if not self._put(self._tasks, (position, epoch, batch_iter, idx, seed)):
+                    return
+                position += 1
+        for _ in range(self.num_workers):
+            self._put(self._tasks, _DONE)
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                task = self._tasks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if task is _DONE:
+                self._put(self._batches, _DONE)
+                return
+            position, epoch, batch_iter, idx, seed = task
+            try:
+                t = time.time()
+                batch = self.builder.build(self.u_indices[idx], self.v_indices[idx], self.labels[idx],
+                                           random=np.random.RandomState(seed))
+                batch['build_time'] = time.time() - t
+            except Exception as e:
+                self._error = e
+                self._put(self._batches, _DONE)
+                return
+            if not self._put(self._batches, (position, (epoch, batch_iter, batch))):
+                return
+
+    def next_batch(self):
+        """ Next (epoch, batch_iter, batch), or None after the last one or close. Thread-safe. """
+        with self._consumer_lock:
+            while not self._stop.is_set():
+                if self._next in self._pending:
+                    self._next += 1
+                    return self._pending.pop(self._next - 1)
+                if self._done == self.num_workers:
+                    break
+                try:
+                    item = self._batches.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    self._done += 1
+                    if self._error is not None:
+                        self._stop.set()
+                        raise self._error
+                    continue
+                position, batch = item
+                self._pending[position] = batch
+            return None
+
+    def __iter__(self):
+        while True:
+            item = self.next_batch()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        """ Stops the background threads, e.g. after early stopping. """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
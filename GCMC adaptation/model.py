@@ -73,18 +73,21 @@ class Model(object):
     def _accuracy(self):
         raise NotImplementedError
 
-    def save(self, sess=None):
+    def save(self, sess=None, save_path=None):
         if not sess:
             raise AttributeError("TensorFlow session not provided.")
+        if save_path is None:
+            save_path = "tmp/%s.ckpt" % self.name
         saver = tf.train.Saver(self.vars)
-        save_path = saver.save(sess, "tmp/%s.ckpt" % self.name)
+        save_path = saver.save(sess, save_path)
         print("Model saved in file: %s" % save_path)
 
-    def load(self, sess=None):
+    def load(self, sess=None, save_path=None):
         if not sess:
             raise AttributeError("TensorFlow session not provided.")
+        if save_path is None:
+            save_path = "tmp/%s.ckpt" % self.name
         saver = tf.train.Saver(self.vars)
-        save_path = "tmp/%s.ckpt" % self.name
         saver.restore(sess, save_path)
         print("Model restored from file: %s" % save_path)
 
@@ -92,7 +95,7 @@ class Model(object):
 class RecommenderGAE(Model):
     def __init__(self, placeholders, input_dim, num_classes, num_support,
                  learning_rate, num_basis_functions, hidden, num_users, num_items, accum, num_layers,
-                 self_connections=False, **kwargs):
+                 self_connections=False, fused_decoder=False, decoder_chunk_size=None, **kwargs):
         super(RecommenderGAE, self).__init__(**kwargs)
 
         self.inputs = (placeholders['u_features'], placeholders['v_features'])
@@ -117,6 +120,8 @@ class RecommenderGAE(Model):
         self.num_users = num_users
         self.num_items = num_items
         self.accum = accum
+        self.fused_decoder = fused_decoder
+        self.decoder_chunk_size = decoder_chunk_size
         self.learning_rate = tf.Variable(learning_rate)
         self.num_layers = num_layers
 
@@ -320,13 +325,16 @@ class RecommenderGAE(Model):
                                            act=lambda x: x,
                                            num_weights=self.num_basis_functions,
                                            logging=self.logging,
-                                           diagonal=False))
+                                           diagonal=False,
+                                           fused=self.fused_decoder,
+                                           chunk_size=self.decoder_chunk_size))
 
 
 class RecommenderSideInfoGAE(Model):
     def __init__(self,  placeholders, input_dim, feat_hidden_dim, num_classes, num_support,
                  learning_rate, num_basis_functions, hidden, num_users, num_items, accum,
-                 num_side_features, self_connections=False, **kwargs):
+                 num_side_features, self_connections=False, fused_decoder=False, decoder_chunk_size=None,
+                 **kwargs):
         super(RecommenderSideInfoGAE, self).__init__(**kwargs)
 
         self.inputs = (placeholders['u_features'], placeholders['v_features'])
@@ -364,6 +372,8 @@ class RecommenderSideInfoGAE(Model):
         self.num_users = num_users
         self.num_items = num_items
         self.accum = accum
+        self.fused_decoder = fused_decoder
+        self.decoder_chunk_size = decoder_chunk_size
         self.learning_rate = tf.Variable(learning_rate)
 
         # standard settings: beta1=0.9, beta2=0.999, epsilon=1.e-8
@@ -497,7 +507,9 @@ class RecommenderSideInfoGAE(Model):
                                            act=lambda x: x,
                                            num_weights=self.num_basis_functions,
                                            logging=self.logging,
-                                           diagonal=False))
+                                           diagonal=False,
+                                           fused=self.fused_decoder,
+                                           chunk_size=self.decoder_chunk_size))
 
     def build(self):
         """ Wrapper for _build() """
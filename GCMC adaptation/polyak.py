@@ -0,0 +1,113 @@
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+PLACEHOLDER_OPS = ('Placeholder', 'PlaceholderWithDefault')
+
+
+def copy_forward(fetches, replacements, name):
+    """
+    Imports a copy of the forward pass of fetches into the default graph, under the name
+    scope name, that reads the tensors of replacements (variable name -> tensor) instead of
+    those variables. All other variables (e.g. resident inputs) and the placeholders are
+    shared with the original, so the copy is fed like it and holds no copies of their values.
+    :return: the copies of fetches
+    """
+    graph = tf.get_default_graph()
+    output_names = [fetch.op.name for fetch in fetches]
+    graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(), output_names)
+    nodes = dict((node.name, node) for node in graph_def.node)
+
+    input_map = {}
+    for v in tf.global_variables() + tf.local_variables():
+        read = v.value()
+        if read.op.name in nodes:
+            input_map[read.name] = replacements.get(v.op.name, read)
+    for node in graph_def.node:
+        if node.op in PLACEHOLDER_OPS:
+            input_map[node.name + ':0'] = graph.get_tensor_by_name(node.name + ':0')
+
+    # drop the mapped nodes, and the nodes (variables) that only fed them
+    mapped = set(tensor_name.split(':')[0] for tensor_name in input_map)
+    kept = [node for node in graph_def.node if node.name not in mapped]
+    while True:
+        consumed = set(output_names)
+        for node in kept:
+            consumed.update(input_name.lstrip('^').split(':')[0] for input_name in node.input)
+        pruned = [node for node in kept if node.name in consumed]
+        if len(pruned) == len(kept):
+            break
+        kept = pruned
+
+    copy_def = tf.GraphDef()
+    copy_def.versions.CopyFrom(graph_def.versions)
+    copy_def.library.CopyFrom(graph_def.library)
+    for node in kept:
+        copy = copy_def.node.add()
+        copy.CopyFrom(node)
+        # colocation with the dropped variables
+        if '_class' in copy.attr:
+            del copy.attr['_class']
+
+    return tf.import_graph_def(copy_def, input_map=input_map, return_elements=[fetch.name for fetch in fetches],
+                               name=name)
+
+
+class PolyakAverages(object):
+    """
+    Evaluation of the exponential moving averages (Polyak averages) of the trainable
+    variables without checkpoint round-trips.
+
+    loss and rmse are a second evaluation head: a copy of the forward pass of model.loss
+    and model.rmse that reads the EMA shadow variables instead of the trainable ones, and
+    the same placeholders and non-trainable variables (e.g. resident inputs) as the model.
+    evaluate runs both heads in a single sess.run with the usual feed_dict.
+
+    load and unload swap the Polyak averages into the trainable variables and back with
+    in-graph assign ops (the raw values are kept in backup variables outside the variable
+    collections, so they are neither checkpointed nor initialized), e.g. to export or
+    test the model with its Polyak averages.
+    """
+
+    def __init__(self, model, name='polyak'):
+        self.model = model
+        self.name = name
+        self.loaded = False
+
+        averages = model.variable_averages
+        pairs = [(v, averages.average(v)) for v in tf.trainable_variables() if averages.average(v) is not None]
+
+        self._build_head([model.loss, model.rmse], pairs)
+        self._build_swap(pairs)
+
+    def _build_head(self, fetches, pairs):
+        shadows = dict((v.op.name, average.value()) for v, average in pairs)
+        self.loss, self.rmse = copy_forward(fetches, shadows, self.name)
+
+    def _build_swap(self, pairs):
+        with tf.name_scope(self.name + '_swap'):
+            backups = [tf.Variable(v.initial_value, trainable=False, collections=[], name=v.op.name.replace('/', '_'))
+                       for v, _ in pairs]
+            save = tf.group(*[backup.assign(v) for backup, (v, _) in zip(backups, pairs)])
+            with tf.control_dependencies([save]):
+                self.load_op = tf.group(*[v.assign(average) for v, average in pairs])
+            self.unload_op = tf.group(*[v.assign(backup) for backup, (v, _) in zip(backups, pairs)])
+
+    def evaluate(self, sess, feed_dict):
+        """ :return: loss and rmse of the raw parameters and of their Polyak averages, from one sess.run """
+        assert not self.loaded, 'the trainable variables hold the Polyak averages'
+        return sess.run([self.model.loss, self.model.rmse, self.loss, self.rmse], feed_dict=feed_dict)
+
+    def load(self, sess):
+        """ Loads the Polyak averages into the trainable variables, the raw values are kept for unload. """
+        if not self.loaded:
+            sess.run(self.load_op)
+            self.loaded = True
+
+    def unload(self, sess):
+        """ Loads the raw values back into the trainable variables. """
+        if self.loaded:
+            sess.run(self.unload_op)
+            self.loaded = False
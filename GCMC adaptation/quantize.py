@@ -0,0 +1,249 @@
+""" Quantized (int8 or product-quantized) embedding storage for serving """
+
+# python quantize.py tmp/export_douban --method pq --num_subspaces 8
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from embeddings import BilinearScorer, META
+from topk import softmax
+
+
+QUANTIZED = 'quantized_%s.npz'
+
+
+def quantize_int8(x):
+    """
+    Symmetric int8 quantization with one scale per row (last axis).
+    :return: int8 codes and float32 scales with the shape of x without its last axis
+    """
+    x = np.asarray(x, dtype=np.float32)
+    scales = np.abs(x).max(axis=-1) / 127.
+    scales[scales == 0.] = 1.
+    codes = np.clip(np.rint(x / scales[..., None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes, scales):
+    return codes.astype(np.float32) * scales[..., None]
+
+
+class ProductQuantizer(object):
+    """
+    Product quantizer: vectors are split into num_subspaces contiguous subvectors, and each
+    subvector is replaced by the index (uint8) of its nearest k-means centroid in its subspace.
+    """
+
+    def __init__(self, num_subspaces=8, num_centroids=256, num_iterations=20, seed=0):
+        assert num_centroids <= 256, 'codes are stored as uint8'
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.num_iterations = num_iterations
+        self.seed = seed
+        self.codebooks = None
+
+    def _assign(self, x, centroids):
+        distances = (x ** 2).sum(axis=1)[:, None] - 2. * np.dot(x, centroids.T) + (centroids ** 2).sum(axis=1)[None, :]
+        return np.argmin(distances, axis=1)
+
+    def fit(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        assert x.shape[1] % self.num_subspaces == 0, 'the dimension must be divisible by num_subspaces'
+
+        random = np.random.RandomState(self.seed)
+        num_centroids = min(self.num_centroids, x.shape[0])
+        subspaces = np.split(x, self.num_subspaces, axis=1)
+
+        self.codebooks = []
+        for sub in subspaces:
+            centroids = sub[random.choice(sub.shape[0], num_centroids, replace=False)].copy()
+            for _ in range(self.num_iterations):
+                assignment = self._assign(sub, centroids)
+                counts = np.bincount(assignment, minlength=num_centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sub)
+                filled = counts > 0
+                centroids[filled] = sums[filled] / counts[filled, None]
+            self.codebooks.append(centroids)
+        self.codebooks = np.stack(self.codebooks, axis=0)
+        return self
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        subspaces = np.split(x, self.num_subspaces, axis=1)
+        return np.stack([self._assign(sub, self.codebooks[m]) for m, sub in enumerate(subspaces)],
+                        axis=1).astype(np.uint8)
+
+
+def decode_pq(codes, codebooks):
+    """ Vectors of PQ codes (..., num_subspaces) with codebooks (num_subspaces, num_centroids, d / num_subspaces). """
+    parts = [codebooks[m][codes[..., m]] for m in range(codebooks.shape[0])]
+    return np.concatenate(parts, axis=-1)
+
+
+def export_quantized(export_dir, method='int8', num_subspaces=8, num_centroids=256, num_iterations=20):
+    """
+    Stores the item embeddings and the per-basis user projections u^T Q_s of an export as
+    int8 codes with one scale per row, or as product-quantized codes with one set of
+    codebooks per basis, to quantized_<method>.npz in export_dir. Scoring then no longer
+    needs the float32 embeddings or the basis matrices, see QuantizedScorer.
+    """
+
+    assert method in ('int8', 'pq'), 'method can only be int8 or pq'
+    scorer = BilinearScorer(export_dir, mmap=False)
+    u_projected = scorer.project_users(scorer.u_embeddings)  # num_users x num_weights x hidden
+    v = scorer.v_embeddings
+
+    if method == 'pq' and scorer.hidden % num_subspaces != 0:
+        # e.g. hidden 75: the largest divisor below the requested number of subspaces
+        num_subspaces = max(m for m in range(1, num_subspaces + 1) if scorer.hidden % m == 0)
+        print('Using %d product quantization subspaces for dimension %d' % (num_subspaces, scorer.hidden))
+
+    arrays = {}
+    if method == 'int8':
+        arrays['user_codes'], arrays['user_scales'] = quantize_int8(u_projected)
+        arrays['item_codes'], arrays['item_scales'] = quantize_int8(v)
+    else:
+        codebooks = []
+        codes = []
+        for s in range(scorer.num_weights):
+            pq = ProductQuantizer(num_subspaces, num_centroids, num_iterations).fit(u_projected[:, s])
+            codebooks.append(pq.codebooks)
+            codes.append(pq.encode(u_projected[:, s]))
+        arrays['user_codebooks'] = np.stack(codebooks, axis=0)
+        arrays['user_codes'] = np.stack(codes, axis=1)
+
+        pq = ProductQuantizer(num_subspaces, num_centroids, num_iterations).fit(v)
+        arrays['item_codebooks'] = pq.codebooks
+        arrays['item_codes'] = pq.encode(v)
+
+    path = os.path.join(export_dir, QUANTIZED % method)
+    np.savez(path, **arrays)
+
+    float_bytes = (u_projected.nbytes + v.nbytes)
+    quantized_bytes = sum(a.nbytes for a in arrays.values())
+    print('Quantized (%s) embeddings exported to %s: %.1f MB instead of %.1f MB' % (method, path,
+                                                                                   quantized_bytes / 1e6,
+                                                                                   float_bytes / 1e6))
+    return path
+
+
+class QuantizedScorer(object):
+    """
+    Scorer for quantized exports with the interface of BilinearScorer for pairs. Only the
+    rows of the scored pairs are dequantized, into float32 (int8: codes times row scales,
+    pq: codebook lookups), and scored with the float decoder scalars.
+    """
+
+    def __init__(self, export_dir, method='int8'):
+        base = BilinearScorer(export_dir)
+        self.meta = base.meta
+        self.scalars = base.scalars
+        self.class_values = base.class_values
+        self.num_users = base.num_users
+        self.num_items = base.num_items
+        self.num_weights = base.num_weights
+        self.hidden = base.hidden
+        self.method = method
+
+        with np.load(os.path.join(export_dir, QUANTIZED % method)) as f:
+            self.arrays = {key: f[key] for key in f.files}
+
+    def users(self, u_indices):
+        """ Dequantized projections u^T Q_s of the given users, n x num_weights x hidden. """
+        codes = self.arrays['user_codes'][np.asarray(u_indices)]
+        if self.method == 'int8':
+            return dequantize_int8(codes, self.arrays['user_scales'][np.asarray(u_indices)])
+        codebooks = self.arrays['user_codebooks']
+        return np.stack([decode_pq(codes[:, s], codebooks[s]) for s in range(self.num_weights)], axis=1)
+
+    def items(self, v_indices):
+        """ Dequantized item embeddings, n x hidden. """
+        codes = self.arrays['item_codes'][np.asarray(v_indices)]
+        if self.method == 'int8':
+            return dequantize_int8(codes, self.arrays['item_scales'][np.asarray(v_indices)])
+        return decode_pq(codes, self.arrays['item_codebooks'])
+
+    def basis_scores(self, u_indices, v_indices):
+        return np.einsum('nkd,nd->nk', self.users(u_indices), self.items(v_indices))
+
+    def logits(self, u_indices, v_indices):
+        return np.dot(self.basis_scores(u_indices, v_indices), self.scalars)
+
+    def probabilities(self, u_indices, v_indices):
+        return softmax(self.logits(u_indices, v_indices), axis=1)
+
+    def predict(self, u_indices, v_indices):
+        return np.dot(self.probabilities(u_indices, v_indices), self.class_values)
+
+
+def _rmse(predictions, ratings):
+    return float(np.sqrt(np.mean((predictions - ratings) ** 2)))
+
+
+def accuracy_report(export_dir, method, u_indices, v_indices, ratings=None, batch_size=65536):
+    """
+    Compares the quantized export with the float32 export on (user, item) pairs, e.g. the
+    test split. With ratings, the RMSE of both is reported, otherwise only the deviation of
+    the quantized predictions from the float32 ones.
+    """
+
+    scorer = BilinearScorer(export_dir)
+    quantized = QuantizedScorer(export_dir, method)
+
+    u_indices = np.asarray(u_indices)
+    v_indices = np.asarray(v_indices)
+    float_predictions = np.zeros(len(u_indices), dtype=np.float32)
+    quantized_predictions = np.zeros(len(u_indices), dtype=np.float32)
+    for start in range(0, len(u_indices), batch_size):
+        batch = slice(start, start + batch_size)
+        float_predictions[batch] = scorer.predict(u_indices[batch], v_indices[batch])
+        quantized_predictions[batch] = quantized.predict(u_indices[batch], v_indices[batch])
+
+    report = {'method': method,
+              'pairs': int(len(u_indices)),
+              'prediction_rmse_vs_float': _rmse(quantized_predictions, float_predictions),
+              'max_abs_prediction_diff': float(np.abs(quantized_predictions - float_predictions).max())
+              if len(u_indices) else 0.}
+    if ratings is not None:
+        ratings = np.asarray(ratings, dtype=np.float32)
+        report['float_rmse'] = _rmse(float_predictions, ratings)
+        report['quantized_rmse'] = _rmse(quantized_predictions, ratings)
+
+    print(json.dumps(report))
+    return report
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("export_dir", type=str,
+                    help="Directory with the exported embeddings and decoder weights.")
+
+    ap.add_argument("-m", "--method", type=str, default='int8', choices=['int8', 'pq'],
+                    help="int8 codes with one scale per row, or product quantization.")
+
+    ap.add_argument("-ns", "--num_subspaces", type=int, default=8,
+                    help="Number of product quantization subspaces, reduced to a divisor of the embedding dimension if needed.")
+
+    ap.add_argument("-nc", "--num_centroids", type=int, default=256,
+                    help="Number of centroids per product quantization subspace (at most 256).")
+
+    ap.add_argument("-np", "--num_pairs", type=int, default=100000,
+                    help="Number of random (user, item) pairs for the accuracy report.")
+
+    args = vars(ap.parse_args())
+
+    export_quantized(args['export_dir'], args['method'], args['num_subspaces'], args['num_centroids'])
+
+    with open(os.path.join(args['export_dir'], META)) as f:
+        meta = json.load(f)
+    random = np.random.RandomState(0)
+    accuracy_report(args['export_dir'], args['method'],
+                    random.randint(0, meta['num_users'], args['num_pairs']),
+                    random.randint(0, meta['num_items'], args['num_pairs']))
@@ -0,0 +1,352 @@
+""" Incremental refresh of exported embeddings when new ratings arrive """
+
+# python refresh.py tmp/export_douban new_ratings.csv
+#
+# new_ratings.csv has one user,item,class row per rating, with class the index into class_values.
+# With --serve_url http://127.0.0.1:8000, the cache of a running serve.py on the same export drops
+# the entries of the refreshed users and items.
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from urllib.request import Request, urlopen
+
+import numpy as np
+import scipy.sparse as sp
+
+from embeddings import USER_EMBEDDINGS, ITEM_EMBEDDINGS, TRAIN_RATINGS, ENCODER, META, load_train_ratings, new_version
+
+
+OTHER = {'user': 'item', 'item': 'user'}
+
+
+def _replace(path, write, mode='wb'):
+    """ Writes path through write(file) atomically, so a serving process never reads a partial file. """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class ServerCache(object):
+    """ The HotUserCache of a running serve.py, invalidated through its /invalidate endpoint. """
+
+    def __init__(self, url, timeout=10.):
+        self.url = url.rstrip('/') + '/invalidate'
+        self.timeout = timeout
+
+    def invalidate(self, users=None, items=None):
+        payload = {'users': np.asarray(users if users is not None else [], dtype=np.int64).tolist(),
+                   'items': np.asarray(items if items is not None else [], dtype=np.int64).tolist()}
+        request = Request(self.url, data=json.dumps(payload).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+
+class EmbeddingRefresher(object):
+    """
+    Updates the exported embeddings in place after new (user, item, class) ratings.
+    Only nodes inside the receptive field of the new edges change: the endpoints, their
+    neighbours if the supports are symmetrically normalized (the degrees of the endpoints
+    enter c_ij of all their edges), and one more hop per additional graph convolution layer.
+    Their layer activations are recomputed from the cached activations of the layer below,
+    restricted to their neighbourhood, and the change of the last graph convolution output
+    is pushed through the (linear) Dense layer into the embedding store. Side features do
+    not change, so their part of the Dense layer input drops out of the update.
+
+    New edges are kept in an overlay on top of the CSR rating matrices, which is merged in
+    once it holds compact_ratio times the number of training ratings, so that the cost of a
+    refresh scales with the affected neighbourhood and not with the graph.
+
+    The embeddings are updated in place, so a cache over them (a HotUserCache of the same
+    process, or a ServerCache) is passed as cache, and add_ratings drops its entries of all
+    refreshed users and items.
+
+    Requires an export with adj_train of a model with stack or sum graph convolution layers,
+    see embeddings.export_embeddings.
+    """
+
+    def __init__(self, export_dir, compact_ratio=0.1, cache=None):
+        with open(os.path.join(export_dir, META)) as f:
+            meta = json.load(f)
+        self.meta = meta
+        assert meta.get('encoder') is not None, 'no encoder weights in %s, export with adj_train' % export_dir
+
+        self.export_dir = export_dir
+        self.compact_ratio = compact_ratio
+        self.cache = cache
+        self.num_users = meta['num_users']
+        self.num_items = meta['num_items']
+        self.num_classes = meta['num_classes']
+        self.accum = meta['encoder']['accum']
+        self.num_layers = meta['encoder']['num_layers']
+        self.num_support = meta['encoder']['num_support']
+        self.symmetric = meta['encoder']['symmetric']
+
+        encoder = np.load(os.path.join(export_dir, ENCODER))
+        self.encoder = {key: encoder[key] for key in encoder.files}
+
+        # users aggregate item inputs with weights_v, items aggregate user inputs with weights_u
+        self.weights = []
+        for l in range(self.num_layers):
+            weights = {'user': self.encoder['gcn_weights_v_%d' % l], 'item': self.encoder['gcn_weights_u_%d' % l]}
+            if self.accum == 'sum':
+                # ordinal weight sharing: class c uses W_0 + ... + W_c
+                weights = {key: np.cumsum(w, axis=0) for key, w in weights.items()}
+            self.weights.append(weights)
+
+        hidden = self.weights[-1]['user'].shape[-1]
+        self.dense_weights = {'user': self.encoder['dense_weights_u'][:hidden],
+                              'item': self.encoder['dense_weights_v'][:hidden]}
+
+        ratings = sp.csr_matrix(load_train_ratings(export_dir), dtype=np.int32)
+        ratings.eliminate_zeros()
+        self._set_ratings(ratings)
+
+        self.embeddings = {'user': np.load(os.path.join(export_dir, USER_EMBEDDINGS), mmap_mode='r+'),
+                           'item': np.load(os.path.join(export_dir, ITEM_EMBEDDINGS), mmap_mode='r+')}
+
+        # cached graph convolution activations of all nodes, one full pass
+        self.activations = []
+        for l in range(self.num_layers):
+            self.activations.append({})
+            for node_type, num_nodes in (('user', self.num_users), ('item', self.num_items)):
+                self.activations[l][node_type] = self._layer(l, node_type, np.arange(num_nodes))
+
+    def _set_ratings(self, ratings):
+        """ ratings: num_users x num_items CSR matrix with class + 1 as values, as adj_train. """
+        self.ratings = {'user': ratings, 'item': ratings.T.tocsr()}
+        self.degrees = {'user': np.diff(self.ratings['user'].indptr).astype(np.float32),
+                        'item': np.diff(self.ratings['item'].indptr).astype(np.float32)}
+        self.pending = {'user': {}, 'item': {}}
+        self.num_pending = 0
+
+    def _has_edge(self, user, item):
+        if item in self.pending['user'].get(user, {}):
+            return True
+        row = self.ratings['user']
+        return item in row.indices[row.indptr[user]:row.indptr[user + 1]]
+
+    def _neighbourhood(self, node_type, nodes):
+        """
+        Edges of nodes as (row into nodes, neighbour, class) arrays, with the new edges of the
+        overlay replacing training edges between the same nodes.
+        """
+
+        sub = self.ratings[node_type][nodes].tocoo()
+        rows, neighbours, classes = sub.row.astype(np.int64), sub.col.astype(np.int64), sub.data - 1
+
+        pending = self.pending[node_type]
+        new_rows, new_neighbours, new_classes = [], [], []
+        for row, node in enumerate(nodes if pending else ()):
+            for neighbour, value in pending.get(node, {}).items():
+                new_rows.append(row)
+                new_neighbours.append(neighbour)
+                new_classes.append(value - 1)
+
+        if new_rows:
+            num_neighbours = self.degrees[OTHER[node_type]].shape[0]
+            keys = rows * num_neighbours + neighbours
+            new_keys = np.array(new_rows) * num_neighbours + np.array(new_neighbours)
+            keep = ~np.isin(keys, new_keys)
+            rows = np.concatenate([rows[keep], new_rows])
+            neighbours = np.concatenate([neighbours[keep], new_neighbours])
+            classes = np.concatenate([classes[keep], new_classes])
+
+        return rows, neighbours, classes
+
+    def _layer(self, l, node_type, nodes):
+        """ Activations of graph convolution layer l for the given nodes, from the cached layer l - 1. """
+
+        rows, neighbours, classes = self._neighbourhood(node_type, nodes)
+        neighbour_type = OTHER[node_type]
+
+        if self.symmetric:
+            values = 1. / np.sqrt(self.degrees[node_type][nodes][rows] * self.degrees[neighbour_type][neighbours])
+        else:
+            values = 1. / self.degrees[node_type][nodes][rows]
+
+        unique, inverse = np.unique(neighbours, return_inverse=True)
+        weights = self.weights[l][node_type]
+
+        if l == 0:
+            # node id input features, so x_j W is a row of W. Item rows follow the user rows.
+            offset = self.num_users if neighbour_type == 'item' else 0
+            inputs = None
+            input_rows = offset + unique
+        else:
+            inputs = self.activations[l - 1][neighbour_type][unique]
+
+        def messages(c):
+            w = weights if self.accum == 'stack' else weights[c]
+            if inputs is None:
+                return w[input_rows]
+            return np.dot(inputs, w)
+
+        hidden = weights.shape[-1]
+        z = np.zeros((len(nodes), hidden), dtype=np.float32)
+        if self.accum == 'stack':
+            split = hidden // self.num_support
+            all_messages = messages(None)
+
+        for c in range(self.num_classes):
+            mask = classes == c
+            if not mask.any():
+                continue
+            support = sp.csr_matrix((values[mask], (rows[mask], inverse[mask])), shape=(len(nodes), len(unique)))
+            if self.accum == 'stack':
+                # weights are split along the output dimension, one slice per support
+                z[:, c * split:(c + 1) * split] = support.dot(all_messages[:, c * split:(c + 1) * split])
+            else:
+                z += support.dot(messages(c))
+
+        return np.maximum(z, 0.)
+
+    def _neighbours(self, node_type, nodes):
+        if len(nodes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(self._neighbourhood(node_type, nodes)[1])
+
+    def add_ratings(self, users, items, classes):
+        """
+        Adds new ratings (or replaces the class of existing ones) and refreshes all affected
+        embeddings in the store.
+        :param classes: rating class of every rating, i.e. index into class_values
+        :return: dict with the refreshed user and item indices
+        """
+
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        classes = np.asarray(classes, dtype=np.int64)
+        if classes.size and (classes.min() < 0 or classes.max() >= self.num_classes):
+            raise ValueError('rating classes must be in [0, %d)' % self.num_classes)
+
+        degree_changed = {'user': set(), 'item': set()}
+        for u, i, c in zip(users, items, classes):
+            if not self._has_edge(u, i):
+                self.degrees['user'][u] += 1
+                self.degrees['item'][i] += 1
+                self.num_pending += 1
+                degree_changed['user'].add(u)
+                degree_changed['item'].add(i)
+            self.pending['user'].setdefault(u, {})[i] = c + 1
+            self.pending['item'].setdefault(i, {})[u] = c + 1
+
+        # first layer: the endpoints, and with symmetric normalization all neighbours of nodes
+        # whose degree changed
+        first = {'user': set(users.tolist()), 'item': set(items.tolist())}
+        if self.symmetric:
+            for node_type in ('user', 'item'):
+                changed = np.array(sorted(degree_changed[node_type]), dtype=np.int64)
+                first[OTHER[node_type]].update(self._neighbours(node_type, changed).tolist())
+
+        affected = {key: np.array(sorted(nodes), dtype=np.int64) for key, nodes in first.items()}
+        old = None
+        for l in range(self.num_layers):
+            if l > 0:
+                # one more hop: every node next to a changed activation of the layer below
+                affected = {'user': np.union1d(self._neighbours('item', affected['item']), list(first['user'])),
+                            'item': np.union1d(self._neighbours('user', affected['user']), list(first['item']))}
+                affected = {key: nodes.astype(np.int64) for key, nodes in affected.items()}
+
+            if l == self.num_layers - 1:
+                old = {key: self.activations[l][key][nodes] for key, nodes in affected.items()}
+
+            new = {key: self._layer(l, key, nodes) for key, nodes in affected.items()}
+            for key, nodes in affected.items():
+                self.activations[l][key][nodes] = new[key]
+
+        for key, nodes in affected.items():
+            if len(nodes):
+                delta = self.activations[-1][key][nodes] - old[key]
+                self.embeddings[key][nodes] += np.dot(delta, self.dense_weights[key])
+
+        if self.cache is not None:
+            self.cache.invalidate(affected['user'], affected['item'])
+
+        if self.num_pending > self.compact_ratio * self.ratings['user'].nnz:
+            self.compact()
+
+        return {'users': affected['user'], 'items': affected['item']}
+
+    def compact(self):
+        """ Merges the new ratings of the overlay into the CSR rating matrices. """
+
+        if not self.pending['user']:
+            return
+
+        rows, cols, values = [], [], []
+        for u, row in self.pending['user'].items():
+            for i, c in row.items():
+                rows.append(u)
+                cols.append(i)
+                values.append(c)
+
+        ratings = self.ratings['user'].tocoo()
+        shape = ratings.shape
+        keys = ratings.row.astype(np.int64) * shape[1] + ratings.col
+        keep = ~np.isin(keys, np.array(rows, dtype=np.int64) * shape[1] + np.array(cols))
+
+        ratings = sp.csr_matrix((np.concatenate([ratings.data[keep], values]),
+                                 (np.concatenate([ratings.row[keep], rows]),
+                                  np.concatenate([ratings.col[keep], cols]))), shape=shape, dtype=np.int32)
+        self._set_ratings(ratings)
+
+    def flush(self):
+        """
+        Writes the embeddings, the updated rating matrix and node degrees back to the export,
+        under a new export version. Files are replaced atomically and meta.json (with the
+        version a serving process polls) last.
+        """
+
+        self.compact()
+        for embeddings in self.embeddings.values():
+            embeddings.flush()
+
+        _replace(os.path.join(self.export_dir, TRAIN_RATINGS), lambda f: sp.save_npz(f, self.ratings['user']))
+        self.encoder['user_degrees'] = self.degrees['user']
+        self.encoder['item_degrees'] = self.degrees['item']
+        _replace(os.path.join(self.export_dir, ENCODER), lambda f: np.savez(f, **self.encoder))
+
+        # the new version is written last, readers only reload once the files above are complete
+        self.meta['version'] = new_version()
+        _replace(os.path.join(self.export_dir, META), lambda f: json.dump(self.meta, f, indent=2, sort_keys=True),
+                 mode='w')
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("export_dir", type=str,
+                    help="Directory with the exported embeddings and encoder weights.")
+
+    ap.add_argument("ratings", type=str,
+                    help="CSV file with one user,item,class row per new rating.")
+
+    ap.add_argument("--serve_url", type=str, default=None,
+                    help="URL of a serve.py running on the export, whose cache entries of the refreshed nodes are dropped.")
+
+    args = vars(ap.parse_args())
+
+    new_ratings = np.loadtxt(args['ratings'], delimiter=',', dtype=np.int64, ndmin=2)
+
+    cache = ServerCache(args['serve_url']) if args['serve_url'] is not None else None
+    refresher = EmbeddingRefresher(args['export_dir'], cache=cache)
+
+    t = time.time()
+    refreshed = refresher.add_ratings(new_ratings[:, 0], new_ratings[:, 1], new_ratings[:, 2])
+    print('%d ratings: refreshed %d users and %d items in %.4f s' % (new_ratings.shape[0],
+                                                                     len(refreshed['users']),
+                                                                     len(refreshed['items']),
+                                                                     time.time() - t))
+    refresher.flush()
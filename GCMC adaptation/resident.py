@@ -0,0 +1,89 @@
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+class ResidentInputs(object):
+    """
+    Static graph inputs (features, supports, incidence matrices) kept in local variables
+    of the session instead of being fed at every step. They are loaded once with load, so
+    a step only feeds the small per-step tensors (indices, labels, dropout), and can be
+    loaded again when they change.
+
+    The tensors stand in for the placeholders of the model. They are local variables, so
+    they are neither checkpointed nor averaged, and they can still be fed like placeholders
+    (e.g. for autotuning in a separate session).
+    """
+
+    def __init__(self, name='resident_inputs'):
+        self.name = name
+        self.tensors = {}  # key -> tensor or SparseTensor standing in for the placeholder
+        self._components = {}  # key -> (placeholder, assign op) per component, in the order of the fed value
+
+    def _variable(self, dtype, shape):
+        initial_value = tf.zeros([0] * len(shape), dtype=dtype)
+        variable = tf.Variable(initial_value, trainable=False, validate_shape=False,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        placeholder = tf.placeholder(dtype, shape=shape)
+        assign_op = tf.assign(variable, placeholder, validate_shape=False)
+
+        # identity, so that the input stays feedable
+        tensor = tf.identity(variable)
+        tensor.set_shape(shape)
+        return tensor, (placeholder, assign_op)
+
+    def sparse(self, key, dtype=tf.float32, shape=None):
+        """
+        SparseTensor that is loaded from a (indices, values, dense_shape) tuple, as a sparse placeholder.
+        If shape is fully known, dense_shape is a constant of it instead of a resident variable, so
+        the SparseTensor keeps its static shape (e.g. for XLA), and only indices and values are loaded.
+        """
+        static = shape is not None and all(dim is not None for dim in shape)
+        with tf.name_scope(self.name + '/' + key):
+            indices, indices_component = self._variable(tf.int64, (None, 2))
+            values, values_component = self._variable(dtype, (None,))
+            if static:
+                dense_shape = tf.constant(shape, dtype=tf.int64)
+            else:
+                dense_shape, shape_component = self._variable(tf.int64, (2,))
+        tensor = tf.SparseTensor(indices, values, dense_shape)
+        self.tensors[key] = tensor
+        if static:
+            self._components[key] = (indices_component, values_component)
+        else:
+            self._components[key] = (indices_component, values_component, shape_component)
+        return tensor
+
+    def dense(self, key, dtype=tf.float32, shape=()):
+        """ Dense tensor that is loaded from an array, as a placeholder. """
+        with tf.name_scope(self.name + '/' + key):
+            tensor, component = self._variable(dtype, shape)
+        self.tensors[key] = tensor
+        self._components[key] = (component,)
+        return tensor
+
+    def load(self, sess, feed_dict):
+        """
+        Loads the values of the resident tensors in feed_dict (a feed_dict with the resident
+        tensors as keys, as built by construct_feed_dict) into the session, with one sess.run.
+        """
+        assign_feed_dict = {}
+        ops = []
+        for key, tensor in self.tensors.items():
+            if tensor not in feed_dict:
+                continue
+            value = feed_dict[tensor]
+            components = self._components[key]
+            values = value if len(components) > 1 else (value,)
+            # a constant dense_shape has no component, zip skips it
+            for (placeholder, assign_op), component in zip(components, values):
+                assign_feed_dict[placeholder] = component
+                ops.append(assign_op)
+        sess.run(ops, feed_dict=assign_feed_dict)
+
+    def strip(self, feed_dict):
+        """ Removes the resident tensors from feed_dict, so that they are no longer fed. """
+        for tensor in self.tensors.values():
+            feed_dict.pop(tensor, None)
+        return feed_dict
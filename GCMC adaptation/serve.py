@@ -0,0 +1,358 @@
+""" Local recommendation server with micro-batching on top of exported embeddings """
+
+# python serve.py tmp/export_douban --port 8000 --max_batch_size 64 --max_wait_ms 2
+#
+# POST /score  {"users": [0, 1], "items": [10, 20]}  ->  {"predictions": [3.71, 4.02]}
+# POST /topk   {"users": [0, 1], "k": 10}            ->  {"items": [[...], [...]], "scores": [[...], [...]]}
+# POST /invalidate {"users": [0], "items": [10]}     ->  drops cached entries after new ratings
+# GET  /stats                                        ->  latency percentiles, throughput and cache counters
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cache import HotUserCache
+from embeddings import META, BilinearScorer, load_train_ratings
+from topk import TopKRecommender
+
+
+class LatencyStats(object):
+    """ Request counters and latency percentiles over the last window requests. """
+
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+
+    def add_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.batch_sizes.append(len(latencies))
+        self.num_requests += len(latencies)
+        self.num_batches += 1
+
+    def summary(self):
+        uptime = time.time() - self.start_time
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'requests': self.num_requests,
+                'batches': self.num_batches,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.,
+                'p50_ms': float(np.percentile(latencies, 50) * 1000.),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000.),
+                'throughput': self.num_requests / uptime if uptime > 0 else 0.}
+
+
+class MicroBatcher(object):
+    """
+    Coalesces concurrent requests into micro-batches. A batch is closed when it holds
+    max_batch_size requests or max_wait seconds after its first request arrived, and is
+    then handed to run_batch(list of requests) -> list of results on a worker thread, so
+    that the event loop keeps accepting requests meanwhile. Payloads are parsed with
+    parse before they are queued, so an invalid request is rejected on its own instead of
+    failing the batch it would have joined.
+    """
+
+    def __init__(self, parse, run_batch, executor, max_batch_size=64, max_wait=0.002):
+        self.parse = parse
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # created by run, inside the event loop that serves the requests
+        self.queue = None
+        self.stats = LatencyStats()
+
+    async def submit(self, payload):
+        request = self.parse(payload)
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((request, future, time.time()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            requests = [b[0] for b in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, requests)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.time()
+            for (_, future, t_start), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.stats.add_batch([now - t_start for _, _, t_start in batch])
+
+
+def load_export(export_dir):
+    """ Scorer and top-K recommender (excluding training ratings) of an export. """
+    scorer = BilinearScorer(export_dir)
+    return scorer, TopKRecommender(scorer, rated=load_train_ratings(export_dir), num_threads=1)
+
+
+class RecommendationService(object):
+    """
+    Vectorized batch handlers for score and top-K requests, optionally through a
+    HotUserCache. With reload_interval, the export is checked for a new version at most
+    every reload_interval seconds and reloaded, which also drops the cache.
+    """
+
+    def __init__(self, scorer, recommender, cache=None, reload_interval=0.):
+        self.scorer = scorer
+        self.recommender = recommender
+        self.cache = cache
+        self.reload_interval = reload_interval
+        self.last_check = time.time()
+        self.reload_lock = threading.Lock()
+
+    def _maybe_reload(self):
+        if not self.reload_interval or time.time() - self.last_check < self.reload_interval:
+            return
+        with self.reload_lock:
+            if time.time() - self.last_check < self.reload_interval:
+                return
+            self.last_check = time.time()
+            with open(os.path.join(self.scorer.export_dir, META)) as f:
+                version = json.load(f).get('version')
+            if version == self.scorer.meta.get('version'):
+                return
+            scorer, recommender = load_export(self.scorer.export_dir)
+            if self.cache is not None:
+                self.cache.sync(scorer, recommender)
+            self.scorer, self.recommender = scorer, recommender
+
+    def _check_indices(self, indices, num, name):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if indices.size and (indices.min() < 0 or indices.max() >= num):
+            raise ValueError('%s index out of range [0, %d)' % (name, num))
+        return indices
+
+    def parse_score(self, payload):
+        """ (users, items) of a score request. """
+        users = self._check_indices(payload['users'], self.scorer.num_users, 'user')
+        items = self._check_indices(payload['items'], self.scorer.num_items, 'item')
+        if users.size != items.size:
+            raise ValueError('users and items must have the same length')
+        return users, items
+
+    def parse_topk(self, payload):
+        """ (users, k) of a top-K request. """
+        users = self._check_indices(payload['users'], self.scorer.num_users, 'user')
+        k = int(payload.get('k', 10))
+        if k < 1:
+            raise ValueError('k must be positive')
+        return users, k
+
+    def score_batch(self, requests):
+        """ Expected ratings for the (user, item) pairs of all requests, with a single decoder pass. """
+
+        self._maybe_reload()
+        predict = self.cache.predict if self.cache is not None else self.scorer.predict
+
+        users = [r[0] for r in requests]
+        predictions = predict(np.concatenate(users), np.concatenate([r[1] for r in requests]))
+        offsets = np.cumsum([0] + [u.size for u in users])
+        return [{'predictions': predictions[offsets[i]:offsets[i + 1]].tolist()} for i in range(len(requests))]
+
+    def topk_batch(self, requests):
+        """ Top-k items for the users of all requests, with a single recommender pass. """
+
+        self._maybe_reload()
+        recommend = self.cache.recommend if self.cache is not None else self.recommender.recommend
+
+        users = [r[0] for r in requests]
+        items, scores = recommend(np.concatenate(users), k=max(r[1] for r in requests))
+        offsets = np.cumsum([0] + [u.size for u in users])
+
+        results = []
+        for i, (_, k) in enumerate(requests):
+            rows = slice(offsets[i], offsets[i + 1])
+            # users with fewer than k unrated items get shorter lists, without the -inf padding
+            # (which is not valid JSON)
+            found = np.isfinite(scores[rows, :k])
+            results.append({'items': [row[mask].tolist() for row, mask in zip(items[rows, :k], found)],
+                             'scores': [row[mask].tolist() for row, mask in zip(scores[rows, :k], found)]})
+        return results
+
+    def invalidate(self, payload):
+        """ Drops the cached entries of users and items whose embeddings changed. """
+        users = self._check_indices(payload.get('users', []), self.scorer.num_users, 'user')
+        items = self._check_indices(payload.get('items', []), self.scorer.num_items, 'item')
+        if self.cache is not None:
+            self.cache.invalidate(users, items)
+        return {'users': int(users.size), 'items': int(items.size)}
+
+
+class RecommendationServer(object):
+    """
+    Minimal asyncio HTTP/1.1 server (standard library only) in front of the micro-batchers.
+    Request bodies larger than max_body_size bytes are rejected without being read.
+    """
+
+    def __init__(self, service, max_batch_size=64, max_wait=0.002, num_threads=None, max_body_size=2 ** 20):
+        self.service = service
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.batchers = {'/score': MicroBatcher(service.parse_score, service.score_batch, self.executor,
+                                                max_batch_size, max_wait),
+                         '/topk': MicroBatcher(service.parse_topk, service.topk_batch, self.executor,
+                                               max_batch_size, max_wait)}
+
+    def stats(self):
+        stats = {path.strip('/'): batcher.stats.summary() for path, batcher in self.batchers.items()}
+        if self.service.cache is not None:
+            stats['cache'] = self.service.cache.summary()
+        return stats
+
+    async def _respond(self, writer, status, body, keep_alive):
+        data = json.dumps(body).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large'}[status]
+        header = ('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                  'Connection: %s\r\n\r\n' % (status, reason, len(data), 'keep-alive' if keep_alive else 'close'))
+        writer.write(header.encode('latin-1') + data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    # readline raises ValueError as well for lines over the limit of the reader
+                    request_line = await reader.readline()
+                    if not request_line:
+                        break
+                    method, path, version = request_line.decode('latin-1').split()
+
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        key, value = line.decode('latin-1').split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                    content_length = int(headers.get('content-length', 0))
+                    if content_length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError as e:
+                    # the rest of the stream cannot be framed, so the connection is closed
+                    await self._respond(writer, 400, {'error': 'malformed request: %s' % e}, False)
+                    break
+
+                if content_length > self.max_body_size:
+                    await self._respond(writer, 413, {'error': 'request body over %d bytes' % self.max_body_size}, False)
+                    break
+
+                body = b''
+                if content_length:
+                    body = await reader.readexactly(content_length)
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                if method == 'GET' and path == '/stats':
+                    await self._respond(writer, 200, self.stats(), keep_alive)
+                elif method == 'POST' and path in self.batchers:
+                    try:
+                        result = await self.batchers[path].submit(json.loads(body.decode('utf-8')))
+                        await self._respond(writer, 200, result, keep_alive)
+                    except (ValueError, KeyError, TypeError) as e:
+                        await self._respond(writer, 400, {'error': str(e)}, keep_alive)
+                elif method == 'POST' and path == '/invalidate':
+                    try:
+                        result = self.service.invalidate(json.loads(body.decode('utf-8')))
+                        await self._respond(writer, 200, result, keep_alive)
+                    except (ValueError, KeyError, TypeError) as e:
+                        await self._respond(writer, 400, {'error': str(e)}, keep_alive)
+                else:
+                    await self._respond(writer, 404, {'error': 'unknown endpoint %s %s' % (method, path)}, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        for batcher in self.batchers.values():
+            asyncio.ensure_future(batcher.run())
+        # let the batchers create their queues before the first request arrives
+        await asyncio.sleep(0)
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://%s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("export_dir", type=str,
+                    help="Directory with the exported embeddings and decoder weights.")
+
+    ap.add_argument("--host", type=str, default='127.0.0.1',
+                    help="Address to listen on.")
+
+    ap.add_argument("-p", "--port", type=int, default=8000,
+                    help="Port to listen on.")
+
+    ap.add_argument("-mbs", "--max_batch_size", type=int, default=64,
+                    help="Maximum number of requests per micro-batch.")
+
+    ap.add_argument("-mw", "--max_wait_ms", type=float, default=2.,
+                    help="Maximum time in ms a request waits for its micro-batch to fill up.")
+
+    ap.add_argument("-nt", "--num_threads", type=int, default=None,
+                    help="Number of worker threads for scoring.")
+
+    ap.add_argument("-cc", "--cache_capacity", type=int, default=10000,
+                    help="Number of users whose projections and top-K lists are cached, 0 to disable the cache.")
+
+    ap.add_argument("-cp", "--cache_policy", type=str, default='lru', choices=['lru', 'lfu'],
+                    help="Eviction policy of the cache.")
+
+    ap.add_argument("-mb", "--max_body_size", type=int, default=2 ** 20,
+                    help="Maximum size of a request body in bytes.")
+
+    ap.add_argument("-ri", "--reload_interval", type=float, default=5.,
+                    help="Seconds between checks for a new export version, 0 to never reload.")
+
+    args = vars(ap.parse_args())
+
+    scorer, recommender = load_export(args['export_dir'])
+    cache = None
+    if args['cache_capacity'] > 0:
+        cache = HotUserCache(scorer, recommender, capacity=args['cache_capacity'], policy=args['cache_policy'])
+
+    service = RecommendationService(scorer, recommender, cache=cache, reload_interval=args['reload_interval'])
+    server = RecommendationServer(service,
+                                  max_batch_size=args['max_batch_size'],
+                                  max_wait=args['max_wait_ms'] / 1000.,
+                                  num_threads=args['num_threads'],
+                                  max_body_size=args['max_body_size'])
+
+    asyncio.run(server.serve(args['host'], args['port']))
@@ -0,0 +1,183 @@
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+FILENAME = 'telemetry.jsonl'
+
+# time spent per step: building (or waiting for) the batch, converting it into a feed_dict,
+# the training sess.run, validation and summary writing
+PHASES = ('batch', 'feed', 'train', 'eval', 'summary')
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the process in MB, or None where it is not available. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2. ** 20 if sys.platform == 'darwin' else peak / 2. ** 10
+
+
+def num_edges(*supports):
+    """ Number of nonzeros of sparse tuples (as from sparse_to_tuple), or of lists of them. """
+    count = 0
+    for support in supports:
+        if support is None:
+            continue
+        if isinstance(support, list):
+            count += num_edges(*support)
+        else:
+            count += support[1].shape[0]
+    return count
+
+
+def batch_edges(batch):
+    """ Message passing edges of a minibatch subgraph, from its supports or incidence matrices. """
+    return num_edges(batch.get('support'), batch.get('support_t'), batch.get('E_start'))
+
+
+class StepRecord(object):
+    """ Phase times and counters of one step, filled in by the training loop. """
+
+    def __init__(self, step, **fields):
+        self.step = step
+        self.fields = fields
+        self.times = dict((phase, 0.) for phase in PHASES)
+        self.edges = 0
+        self.pairs = 0
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        """ Context manager that adds the time spent inside it to phase. """
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.times[phase] += time.time() - t
+
+    def add(self, phase, seconds):
+        """ Adds time measured elsewhere, e.g. the build time of a batch on a producer thread. """
+        self.times[phase] = self.times.get(phase, 0.) + seconds
+
+    def count(self, edges=0, pairs=0):
+        """ Adds the message passing edges and the rated pairs of the training step. """
+        self.edges += edges
+        self.pairs += pairs
+
+    def as_dict(self):
+        """ The record as written. Throughputs are per second of the training sess.run. """
+        record = {'step': self.step}
+        record.update(self.fields)
+        record.update(('%s_time' % phase, seconds) for phase, seconds in self.times.items())
+        record['step_time'] = time.time() - self.start
+        record['edges'] = self.edges
+        record['pairs'] = self.pairs
+        train_time = self.times['train']
+        record['edges_per_sec'] = self.edges / train_time if train_time > 0 else None
+        record['pairs_per_sec'] = self.pairs / train_time if train_time > 0 else None
+        record['peak_rss_mb'] = peak_rss_mb()
+        return record
+
+
+class Telemetry(object):
+    """
+    Per-step telemetry of a training run, written as JSON lines (by default telemetry.jsonl
+    in the run directory). The first line describes the run (type 'run', with the given
+    settings), then every step the training loop writes has type 'step' and holds the
+    time spent in each phase (batch_time, feed_time, train_time, eval_time, summary_time),
+    the wall time of the whole step, the edges and pairs of the training step with their
+    throughput, and the peak RSS of the process so far. close writes a 'summary' line
+    with the median phase times, over a uniform sample (reservoir) of at most max_samples
+    steps, so the memory of the telemetry does not grow with the length of the run.
+
+    Without a path, steps are recorded but nothing is written or kept, so the training loops
+    can time their phases unconditionally. write can be called from several training threads.
+    """
+
+    def __init__(self, path, settings=None, flush_every=20, max_samples=10000):
+        self.path = path
+        self.flush_every = flush_every
+        self.max_samples = max_samples
+        self.records = 0
+        self._phase_times = dict((phase, []) for phase in PHASES)
+        self._random = np.random.RandomState(0)
+        self._lock = threading.Lock()
+        self._file = None
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = open(path, 'w')
+            self._write({'type': 'run', 'time': time.time(), 'pid': os.getpid(), 'settings': settings or {}})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, default=_json_default) + '\n')
+
+    def step(self, step, **fields):
+        """ New record of step, fields (e.g. epoch) are written with it. """
+        return StepRecord(step, **fields)
+
+    def write(self, record):
+        """ Writes a finished step record. """
+        with self._lock:
+            if self._file is None:
+                return
+            line = {'type': 'step'}
+            line.update(record.as_dict())
+            self._write(line)
+            self.records += 1
+
+            # reservoir sampling: every step written so far is in the sample with equal probability
+            if self.records <= self.max_samples:
+                slot = self.records - 1
+            else:
+                slot = self._random.randint(self.records)
+            if slot < self.max_samples:
+                for phase in PHASES:
+                    times = self._phase_times[phase]
+                    if slot == len(times):
+                        times.append(record.times[phase])
+                    else:
+                        times[slot] = record.times[phase]
+            if self.records % self.flush_every == 0:
+                self._file.flush()
+
+    def summary(self):
+        """ Median time per step of every phase, over (a sample of) the steps written so far. """
+        with self._lock:
+            return dict(('%s_time' % phase, float(np.median(times)) if times else None)
+                        for phase, times in self._phase_times.items())
+
+    def close(self, **fields):
+        """ Writes the summary line (with fields, e.g. the final validation score) and closes the file. """
+        if self._file is None:
+            return
+        line = {'type': 'summary', 'steps': self.records, 'peak_rss_mb': peak_rss_mb()}
+        line.update(self.summary())
+        line.update(fields)
+        self._write(line)
+        self._file.close()
+        self._file = None
+
+
+def _json_default(value):
+    # numpy scalars in the settings and fields
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
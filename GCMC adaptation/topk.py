@@ -0,0 +1,174 @@
+""" Exact top-K recommendation over the full item catalog with an exported BilinearMixture decoder """
+
+# python topk.py tmp/export_douban -k 50 -o recommendations.npz
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from embeddings import BilinearScorer, load_train_ratings
+
+
+def softmax(logits, axis=-1):
+    """ Numerically stable softmax along axis. """
+    logits = logits - logits.max(axis=axis, keepdims=True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=axis, keepdims=True)
+
+
+class TopKRecommender(object):
+    """
+    Exact top-K recommender. Users are processed in blocks of user_block users, which are
+    scored against the item catalog in tiles of item_tile items. Every tile is merged into
+    a running top-K per user with argpartition, so peak memory is bounded by
+    user_block x item_tile x num_classes scores per worker thread, independent of the
+    catalog size. Blocks are distributed over a thread pool (numpy releases the GIL in
+    the matmuls).
+    """
+
+    def __init__(self, scorer, rated=None, user_block=256, item_tile=4096, num_threads=None,
+                 score='expected', class_index=None):
+        """
+        :param scorer: BilinearScorer with the exported embeddings and decoder weights
+        :param rated: optional num_users x num_items sparse matrix of items to exclude (e.g. training ratings)
+        :param score: 'expected' to rank by expected rating, 'class' to rank by the probability of class_index
+        """
+        assert score in ('expected', 'class'), 'score can only be expected or class'
+        if score == 'class':
+            assert class_index is not None, 'class_index is required to rank by class probability'
+
+        self.scorer = scorer
+        self.rated = rated.tocsr() if rated is not None else None
+        self.user_block = user_block
+        self.item_tile = item_tile
+        self.num_threads = num_threads
+        self.score = score
+        self.class_index = class_index
+
+    def tile_scores(self, u_projected, item_start, item_end):
+        """ Scores of a block of projected users against items [item_start, item_end), block x tile. """
+
+        v = np.asarray(self.scorer.v_embeddings[item_start:item_end])
+        num_users = u_projected.shape[0]
+        num_weights = u_projected.shape[1]
+
+        # basis scores: block x num_weights x tile
+        basis = np.dot(u_projected.reshape(num_users * num_weights, -1), v.T).reshape(num_users, num_weights, -1)
+        logits = np.einsum('bkt,kc->btc', basis, self.scorer.scalars)
+        probs = softmax(logits, axis=2)
+
+        if self.score == 'expected':
+            return np.dot(probs, self.scorer.class_values)
+        return probs[:, :, self.class_index]
+
+    def _recommend_block(self, users, k):
+        u = np.asarray(self.scorer.u_embeddings[users])
+        u_projected = self.scorer.project_users(u)
+        rated = self.rated[users] if self.rated is not None else None
+
+        best_items = np.full((len(users), 0), -1, dtype=np.int64)
+        best_scores = np.full((len(users), 0), -np.inf, dtype=np.float32)
+
+        for item_start in range(0, self.scorer.num_items, self.item_tile):
+            item_end = min(item_start + self.item_tile, self.scorer.num_items)
+            scores = self.tile_scores(u_projected, item_start, item_end).astype(np.float32)
+
+            if rated is not None:
+                rated_tile = rated[:, item_start:item_end].tocoo()
+                scores[rated_tile.row, rated_tile.col] = -np.inf
+
+            items = np.broadcast_to(np.arange(item_start, item_end), scores.shape)
+            candidate_scores = np.hstack([best_scores, scores])
+            candidate_items = np.hstack([best_items, items])
+
+            if candidate_scores.shape[1] > k:
+                top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+                candidate_scores = np.take_along_axis(candidate_scores, top, axis=1)
+                candidate_items = np.take_along_axis(candidate_items, top, axis=1)
+
+            best_scores = candidate_scores
+            best_items = candidate_items
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        return np.take_along_axis(best_items, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def recommend(self, users=None, k=50):
+        """
+        Top-k items for every user in users (default: all users).
+        :return: items (num_users x k) and scores (num_users x k), sorted by decreasing score.
+            Items that are excluded (rated) only show up with score -inf if a user has fewer
+            than k unrated items.
+        """
+
+        if users is None:
+            users = np.arange(self.scorer.num_users)
+        users = np.asarray(users)
+        k = min(k, self.scorer.num_items)
+
+        blocks = [users[i:i + self.user_block] for i in range(0, len(users), self.user_block)]
+
+        pool = ThreadPool(self.num_threads)
+        try:
+            results = pool.map(lambda block: self._recommend_block(block, k), blocks)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not results:
+            return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+
+        items = np.vstack([r[0] for r in results])
+        scores = np.vstack([r[1] for r in results])
+        return items, scores
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("export_dir", type=str,
+                    help="Directory with the exported embeddings and decoder weights.")
+
+    ap.add_argument("-k", "--top_k", type=int, default=50,
+                    help="Number of recommended items per user.")
+
+    ap.add_argument("-ub", "--user_block", type=int, default=256,
+                    help="Number of users scored together.")
+
+    ap.add_argument("-it", "--item_tile", type=int, default=4096,
+                    help="Number of items scored together.")
+
+    ap.add_argument("-nt", "--num_threads", type=int, default=None,
+                    help="Number of worker threads (default: number of CPUs).")
+
+    ap.add_argument("-ci", "--class_index", type=int, default=None,
+                    help="Rank by the probability of this rating class instead of the expected rating.")
+
+    ap.add_argument("-o", "--output", type=str, default='recommendations.npz',
+                    help="Output .npz file with the recommended items and scores.")
+
+    ap.add_argument('--include_rated', action='store_true',
+                    help='Option to also recommend items that are rated in the training set')
+
+    args = vars(ap.parse_args())
+
+    scorer = BilinearScorer(args['export_dir'])
+    rated = None if args['include_rated'] else load_train_ratings(args['export_dir'])
+
+    recommender = TopKRecommender(scorer, rated=rated,
+                                  user_block=args['user_block'],
+                                  item_tile=args['item_tile'],
+                                  num_threads=args['num_threads'],
+                                  score='expected' if args['class_index'] is None else 'class',
+                                  class_index=args['class_index'])
+
+    t = time.time()
+    items, scores = recommender.recommend(k=args['top_k'])
+    print('top-%d for %d users over %d items in %.2f s' % (args['top_k'], items.shape[0], scorer.num_items,
+                                                          time.time() - t))
+
+    np.savez(args['output'], items=items, scores=scores)
+    print('Recommendations saved to %s' % args['output'])
@@ -13,6 +13,7 @@ import tensorflow as tf
 import numpy as np
 import scipy.sparse as sp
 import sys
+import os
 import json
 
 from preprocessing import create_trainvaltest_split, \
@@ -20,6 +21,17 @@ from preprocessing import create_trainvaltest_split, \
 	load_data_monti, load_official_trainvaltest_split, normalize_features, get_edges_matrices
 from model import RecommenderGAE, RecommenderSideInfoGAE
 from utils import construct_feed_dict
+from resident import ResidentInputs
+from edge_dropout import EdgeDropout
+from embeddings import export_embeddings
+from inference import export_inference_graph, export_decoder_graph
+from quantize import export_quantized, accuracy_report
+from checkpoints import CheckpointManager, default_run_dir
+from validation import ValidationScheduler
+from controller import TrainingController
+from polyak import PolyakAverages
+from telemetry import Telemetry, num_edges, FILENAME as TELEMETRY_FILE
+from execution import session_config, jit_scope, compile_time, profile_key, resolve_profile, apply_cpu_affinity
 
 # Set random seed
 # seed = 123 # use only for unit testing
@@ -51,6 +63,9 @@ ap.add_argument("-cons", "--consecutive", type=int, default=2,
 ap.add_argument("-dr", "--decay_rate", type=float, default=1.25,
 				help="Decay rate of learning rate")
 
+ap.add_argument("-pat", "--patience", type=int, default=0,
+				help="Stop after this many validations without improvement, 0 to always train for all epochs.")
+
 ap.add_argument("-fhi", "--feat_hidden", type=int, default=64,
 				help="Number hidden units in the dense layer for features")
 
@@ -60,13 +75,46 @@ ap.add_argument("-ac", "--accumulation", type=str, default="sum", choices=['sum'
 ap.add_argument("-do", "--dropout", type=float, default=0.7,
 				help="Dropout fraction")
 
+ap.add_argument("-edo", "--edge_dropout", type=float, default=0.,
+				help="Fraction of rating edges dropped from the supports at every training step.")
+
+ap.add_argument("-mdeg", "--max_degree", type=int, default=None,
+				help="Maximum number of rating edges kept per item at every training step.")
+
 ap.add_argument("-nb", "--num_basis_functions", type=int, default=2,
 				help="Number of basis functions for Mixture Model GCN.")
 
+ap.add_argument("-dchunk", "--decoder_chunk_size", type=int, default=None,
+				help="Number of (user, item) pairs scored per chunk by the fused decoder. Implies --fused_decoder.")
+
 ap.add_argument("-ds", "--data_seed", type=int, default=1234,
 				help="""Seed used to shuffle data in data_utils, taken from cf-nade (1234, 2341, 3412, 4123, 1324).
 					 Only used for ml_1m and ml_10m datasets. """)
 
+ap.add_argument("-exp", "--export_dir", type=str, default=None,
+				help="Directory to export the Polyak-averaged embeddings and decoder weights to after training.")
+
+ap.add_argument("-ig", "--inference_graph", type=str, default=None, choices=['full', 'decoder'],
+				help="Also export a frozen inference graph of the encoder and decoder (full) or of the decoder only to --export_dir.")
+
+ap.add_argument("-q", "--quantize", type=str, default=None, choices=['int8', 'pq'],
+				help="Also export int8 or product-quantized embeddings to --export_dir, with an accuracy report on the test (or validation) split.")
+
+ap.add_argument("-rdir", "--run_dir", type=str, default=None,
+				help="Checkpoint directory of this run (default: a new directory under tmp/runs).")
+
+ap.add_argument("-ckpt", "--checkpoint_every", type=int, default=100,
+				help="Write a checkpoint every n epochs, 0 to only keep the best and the final one.")
+
+ap.add_argument("-kc", "--keep_checkpoints", type=int, default=3,
+				help="Number of periodic checkpoints to keep.")
+
+ap.add_argument("-ve", "--val_every", type=int, default=1,
+				help="Run validation every n epochs (and after the last one).")
+
+ap.add_argument("-pe", "--polyak_every", type=int, default=0,
+				help="Evaluate the Polyak averages on the validation set every n epochs, 0 to only evaluate them after training.")
+
 ap.add_argument("-sdir", "--summaries_dir", type=str, default='logs/' + str(datetime.datetime.now()).replace(' ', '_'),
 				help="Directory for saving tensorflow summaries.")
 
@@ -99,11 +147,67 @@ fp.add_argument('-v', '--validation', dest='testing',
 				help="Option to only use validation set evaluation", action='store_false')
 ap.set_defaults(testing=False)
 
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-fdec', '--fused_decoder', dest='fused_decoder',
+				help="Option to compute all bilinear basis scores of the decoder with a single matmul", action='store_true')
+fp.add_argument('-no_fdec', '--no_fused_decoder', dest='fused_decoder',
+				help="Option to compute the bilinear basis scores of the decoder one basis at a time", action='store_false')
+ap.set_defaults(fused_decoder=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-res', '--resident_inputs', dest='resident_inputs',
+				help="Option to load the static features, supports and incidence matrices into the session once instead of feeding them every step", action='store_true')
+fp.add_argument('-no_res', '--no_resident_inputs', dest='resident_inputs',
+				help="Option to feed all graph inputs at every step", action='store_false')
+ap.set_defaults(resident_inputs=True)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-aval', '--async_validation', dest='async_validation',
+				help="Option to validate parameter snapshots on a background thread while training continues", action='store_true')
+fp.add_argument('-no_aval', '--no_async_validation', dest='async_validation',
+				help="Option to validate in the training loop", action='store_false')
+ap.set_defaults(async_validation=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-plr', '--plateau_decay', dest='plateau_decay',
+				help="Option to divide the learning rate by --decay_rate after --consecutive validations without improvement", action='store_true')
+fp.add_argument('-no_plr', '--no_plateau_decay', dest='plateau_decay',
+				help="Option to keep the learning rate constant", action='store_false')
+ap.set_defaults(plateau_decay=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-rb', '--restore_best', dest='restore_best',
+				help="Option to continue from the best validation checkpoint (and its Polyak averages) after training", action='store_true')
+fp.add_argument('-no_rb', '--no_restore_best', dest='restore_best',
+				help="Option to continue from the last training step after training", action='store_false')
+ap.set_defaults(restore_best=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-tel', '--telemetry', dest='telemetry',
+				help="Option to write per-step phase times, throughput and peak memory to telemetry.jsonl in the run directory", action='store_true')
+fp.add_argument('-no_tel', '--no_telemetry', dest='telemetry',
+				help="Option to not write per-step telemetry", action='store_false')
+ap.set_defaults(telemetry=False)
+
+ap.add_argument('--jit', action='store_true',
+				help='Option to compile the graph conv stack and decoder with XLA, specialized on static support shapes')
+
+ap.add_argument('--autotune', action='store_true',
+				help='Option to benchmark TF thread pool sizes and store the fastest one for this dataset/accum/hidden')
+
+ap.add_argument('--pin_cpus', action='store_true',
+				help='Option to pin the process to as many CPUs (not used by other pinned runs) as threads of its tuned or stored execution profile')
+
 ap.add_argument('-gi', '--use_gcmc_indices', action='store_true', help='Option to use original GCMC way of producing user/item indices')
 
 
 args = vars(ap.parse_args())
 
+# the row-sliced supports of --use_gcmc_indices only cover the users and items of one split,
+# which the exported embeddings and inference graph can not be built from
+if args['export_dir'] is not None and args['use_gcmc_indices']:
+	ap.error('--export_dir can not be combined with --use_gcmc_indices')
+
 print('Settings:')
 print(args, '\n')
 
@@ -112,6 +216,8 @@ DATASET = args['dataset']
 DATASEED = args['data_seed']
 NB_EPOCH = args['epochs']
 DO = args['dropout']
+EDGE_DO = args['edge_dropout']
+MAX_DEGREE = args['max_degree']
 HIDDEN = args['hidden']
 FEATHIDDEN = args['feat_hidden']
 BASES = args['num_basis_functions']
@@ -120,12 +226,31 @@ decay_rate = args['decay_rate']
 consecutive_threshold = args['consecutive']
 WRITESUMMARY = args['write_summary']
 SUMMARIESDIR = args['summaries_dir']
+EXPORTDIR = args['export_dir']
+INFERENCE_GRAPH = args['inference_graph']
+QUANTIZE = args['quantize']
+RUNDIR = args['run_dir']
+CHECKPOINT_EVERY = args['checkpoint_every']
+KEEP_CHECKPOINTS = args['keep_checkpoints']
 FEATURES = args['features']
 SYM = args['norm_symmetric']
 TESTING = args['testing']
 ACCUM = args['accumulation']
 NUM_LAYERS = args['num_layers']
 GCMC_INDICES = args['use_gcmc_indices']
+FUSED_DECODER = args['fused_decoder']
+DECODER_CHUNK = args['decoder_chunk_size']
+JIT = args['jit']
+AUTOTUNE = args['autotune']
+PIN_CPUS = args['pin_cpus']
+RESIDENT = args['resident_inputs']
+VAL_EVERY = args['val_every']
+POLYAK_EVERY = args['polyak_every']
+ASYNC_VAL = args['async_validation']
+PATIENCE = args['patience']
+PLATEAU_DECAY = args['plateau_decay']
+RESTORE_BEST = args['restore_best']
+TELEMETRY = args['telemetry']
 
 SELFCONNECTIONS = False
 SPLITFROMFILE = True
@@ -182,6 +307,7 @@ else:
 num_users, num_items = adj_train.shape
 
 num_side_features = 0
+num_user_side_features = 0
 
 # feature loading
 if not FEATURES:
@@ -203,6 +329,7 @@ elif FEATURES and u_features is not None and v_features is not None:
 	v_features_side = np.array(v_features_side.todense(), dtype=np.float32)
 
 	num_side_features = u_features_side.shape[1]
+	num_user_side_features = u_features.shape[1]
 
 	# node id's for node input features
 	id_csr_v = sp.identity(num_items, format='csr')
@@ -326,6 +453,14 @@ else:
 	train_u_features_side = None
 	train_v_features_side = None
 
+# XLA specializes on static shapes. The full-graph supports keep their shape across steps,
+# their row-sliced versions (GCMC_INDICES) do not.
+if JIT and not GCMC_INDICES:
+	support_shape = support.shape
+	support_t_shape = support_t.shape
+else:
+	support_shape = support_t_shape = (None, None)
+
 placeholders = {
 	'u_features': tf.sparse_placeholder(tf.float32, shape=np.array(u_features.shape, dtype=np.int64)),
 	'v_features': tf.sparse_placeholder(tf.float32, shape=np.array(v_features.shape, dtype=np.int64)),
@@ -344,10 +479,26 @@ placeholders = {
 	'dropout': tf.placeholder_with_default(0., shape=()),
 	'weight_decay': tf.placeholder_with_default(0., shape=()),
 
-	'support': tf.sparse_placeholder(tf.float32, shape=(None, None)),
-	'support_t': tf.sparse_placeholder(tf.float32, shape=(None, None)),
+	'support': tf.sparse_placeholder(tf.float32, shape=support_shape),
+	'support_t': tf.sparse_placeholder(tf.float32, shape=support_t_shape),
 }
 
+# The features stay the same across steps and splits. The incidence matrices do without edge
+# dropout, the supports only if they are not row-sliced per split either (GCMC_INDICES).
+STATIC_EDGES = not (EDGE_DO > 0. or MAX_DEGREE is not None)
+if RESIDENT:
+	resident = ResidentInputs()
+	placeholders['u_features'] = resident.sparse('u_features', shape=u_features.shape)
+	placeholders['v_features'] = resident.sparse('v_features', shape=v_features.shape)
+	placeholders['u_features_nonzero'] = resident.dense('u_features_nonzero', tf.int32)
+	placeholders['v_features_nonzero'] = resident.dense('v_features_nonzero', tf.int32)
+	placeholders['class_values'] = resident.dense('class_values', tf.float32, class_values.shape)
+	if STATIC_EDGES and not GCMC_INDICES:
+		placeholders['support'] = resident.sparse('support', shape=support_shape)
+		placeholders['support_t'] = resident.sparse('support_t', shape=support_t_shape)
+else:
+	resident = None
+
 ##################################################################################################################
 E_start, E_end = get_edges_matrices(adj_train)
 # E_start = sp.hstack(E_start, format='csr')  # confirm if vstack is correct and not hstack
@@ -359,44 +510,65 @@ E_start, E_end = get_edges_matrices(adj_train)
 placeholders['E_start_list'] = []
 placeholders['E_end_list'] = []
 for i in range(num_support):
-	placeholders['E_start_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
-	placeholders['E_end_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
+	if JIT:
+		# number of edges changes from step to step with edge dropout
+		class_edges = None if (EDGE_DO > 0. or MAX_DEGREE is not None) else E_start[i].shape[0]
+		E_shape = (class_edges, E_start[i].shape[1])
+	else:
+		E_shape = (None, None)
+	if RESIDENT and STATIC_EDGES:
+		placeholders['E_start_list'].append(resident.sparse('E_start_%d' % i, shape=E_shape))
+		placeholders['E_end_list'].append(resident.sparse('E_end_%d' % i, shape=E_shape))
+	else:
+		placeholders['E_start_list'].append(tf.sparse_placeholder(tf.float32, shape=E_shape))
+		placeholders['E_end_list'].append(tf.sparse_placeholder(tf.float32, shape=E_shape))
 
 print('shape of E_end for first rating type: {}'.format(E_end[0].toarray().shape))
 
+if EDGE_DO > 0. or MAX_DEGREE is not None:
+	edge_dropout = EdgeDropout(adj_train, NUMCLASSES, rate=EDGE_DO, max_degree=MAX_DEGREE, symmetric=SYM,
+							   E_start=E_start, E_end=E_end, self_connections=SELFCONNECTIONS)
+else:
+	edge_dropout = None
+
 ##################################################################################################################
 
 
 # create model
-if FEATURES:
-	model = RecommenderSideInfoGAE(placeholders,
-								   input_dim=u_features.shape[1],
-								   feat_hidden_dim=FEATHIDDEN,
-								   num_classes=NUMCLASSES,
-								   num_support=num_support,
-								   self_connections=SELFCONNECTIONS,
-								   num_basis_functions=BASES,
-								   hidden=HIDDEN,
-								   num_users=num_users,
-								   num_items=num_items,
-								   accum=ACCUM,
-								   learning_rate=LR,
-								   num_side_features=num_side_features,
-								   logging=True)
-else:
-	model = RecommenderGAE(placeholders,
-						   input_dim=u_features.shape[1],
-						   num_classes=NUMCLASSES,
-						   num_support=num_support,
-						   self_connections=SELFCONNECTIONS,
-						   num_basis_functions=BASES,
-						   hidden=HIDDEN,
-						   num_users=num_users,
-						   num_items=num_items,
-						   accum=ACCUM,
-						   learning_rate=LR,
-						   num_layers=NUM_LAYERS,
-						   logging=True)
+with jit_scope(JIT):
+	if FEATURES:
+		model = RecommenderSideInfoGAE(placeholders,
+									   input_dim=u_features.shape[1],
+									   feat_hidden_dim=FEATHIDDEN,
+									   num_classes=NUMCLASSES,
+									   num_support=num_support,
+									   self_connections=SELFCONNECTIONS,
+									   num_basis_functions=BASES,
+									   hidden=HIDDEN,
+									   num_users=num_users,
+									   num_items=num_items,
+									   accum=ACCUM,
+									   learning_rate=LR,
+									   num_side_features=num_side_features,
+									   fused_decoder=FUSED_DECODER,
+									   decoder_chunk_size=DECODER_CHUNK,
+									   logging=True)
+	else:
+		model = RecommenderGAE(placeholders,
+							   input_dim=u_features.shape[1],
+							   num_classes=NUMCLASSES,
+							   num_support=num_support,
+							   self_connections=SELFCONNECTIONS,
+							   num_basis_functions=BASES,
+							   hidden=HIDDEN,
+							   num_users=num_users,
+							   num_items=num_items,
+							   accum=ACCUM,
+							   learning_rate=LR,
+							   num_layers=NUM_LAYERS,
+							   fused_decoder=FUSED_DECODER,
+							   decoder_chunk_size=DECODER_CHUNK,
+							   logging=True)
 
 # Convert sparse placeholders to tuples to construct feed_dict. sparse placeholders expect tuple of (indices, values, shape)
 test_support = sparse_to_tuple(test_support)
@@ -444,13 +616,32 @@ test_feed_dict = construct_feed_dict(placeholders, u_features, v_features, u_fea
 									 test_labels, test_u_indices, test_v_indices, class_values, 0.,
 									 test_u_features_side, test_v_features_side, test_E_start, test_E_end)
 
+# evaluation head and swap ops for the Polyak averages
+polyak = PolyakAverages(model)
 
 # Collect all variables to be logged into summary
 merged_summary = tf.summary.merge_all()
 
-sess = tf.Session()
+# thread pool sizes (and CPU pinning) stored for this configuration, tuned first if requested
+profile = resolve_profile(profile_key('full_batch', DATASET, ACCUM, HIDDEN), [model.training_op, model.loss], train_feed_dict,
+						  num_support, tune=AUTOTUNE, pin_cpus=PIN_CPUS, jit=JIT)
+if profile is not None:
+	print('Using execution profile: {}'.format(profile))
+	apply_cpu_affinity(profile)
+
+sess = tf.Session(config=session_config(jit=JIT, profile=profile))
 sess.run(tf.global_variables_initializer())
 
+if resident is not None:
+	# load the static inputs once, from then on only the per-step tensors are fed
+	resident.load(sess, train_feed_dict)
+	for feed_dict in (train_feed_dict, val_feed_dict, test_feed_dict):
+		resident.strip(feed_dict)
+
+run_dir = RUNDIR if RUNDIR is not None else default_run_dir(model.name, DATASET)
+checkpoints = CheckpointManager(sess, model, run_dir, keep_last=KEEP_CHECKPOINTS)
+telemetry = Telemetry(os.path.join(run_dir, TELEMETRY_FILE) if TELEMETRY else None, settings=args)
+
 if WRITESUMMARY:
 	train_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/train', sess.graph)
 	val_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/val')
@@ -486,30 +677,93 @@ assign_op = model.learning_rate.assign(assign_placeholder)
 old_loss = float('inf')
 print('Original learning rate is {}'.format(sess.run(model.optimizer._lr)))
 
+# wall times of the train and validation runs. With --jit the first run of each includes XLA compilation.
+# With asynchronous validation, the validation time is the time to take the snapshot.
+train_step_times = []
+val_step_times = []
+
+validator = ValidationScheduler(sess, model, val_feed_dict, every=VAL_EVERY, asynchronous=ASYNC_VAL,
+								snapshot=checkpoints.snapshot)
+val_avg_loss = val_rmse = np.nan
+
+controller = TrainingController(sess, model, LR, patience=PATIENCE,
+								lr_patience=consecutive_threshold if PLATEAU_DECAY else 0, decay_rate=decay_rate,
+								restore_best=RESTORE_BEST, assign_op=assign_op, assign_placeholder=assign_placeholder)
+
+
+def record_validations():
+	"""
+	Best-epoch bookkeeping, best checkpoints, early stopping and learning rate decay for the
+	finished validations, possibly of earlier epochs. The printed values are the latest ones.
+	:return: whether training should stop
+	"""
+	global val_avg_loss, val_rmse, best_val_score, best_epoch
+
+	stop = False
+	for val_epoch, (val_avg_loss, val_rmse), values in validator.poll():
+		if val_rmse < best_val_score:
+			best_val_score = val_rmse
+			best_epoch = val_epoch
+			checkpoints.save_best(val_epoch, val_rmse, values=values)
+		# early stopping and plateau learning rate decay
+		stop = controller.update(val_epoch, val_rmse) or stop
+	return stop
+
+
+# message passing edges (nonzeros of the supports) and rated pairs of a training step
+train_edges = num_edges(train_support, train_support_t)
+train_pairs = len(train_labels)
+
 for epoch in range(NB_EPOCH):
 
 	t = time.time()
+	record = telemetry.step(epoch)
+
+	if edge_dropout is not None:
+		with record.time('batch'):
+			# resample the training edges and renormalize the supports for this step
+			keep = edge_dropout.sample()
+			support_drop, support_t_drop = edge_dropout.supports(keep)
+			if GCMC_INDICES:
+				support_drop = support_drop[np.array(train_u)]
+				support_t_drop = support_t_drop[np.array(train_v)]
+			E_start_drop, E_end_drop = edge_dropout.incidence(keep)
+
+		with record.time('feed'):
+			train_feed_dict[placeholders['support']] = sparse_to_tuple(support_drop)
+			train_feed_dict[placeholders['support_t']] = sparse_to_tuple(support_t_drop)
+			for i in range(num_support):
+				train_feed_dict[placeholders['E_start_list'][i]] = sparse_to_tuple(E_start_drop[i])
+				train_feed_dict[placeholders['E_end_list'][i]] = sparse_to_tuple(E_end_drop[i])
+		train_edges = num_edges(train_feed_dict[placeholders['support']], train_feed_dict[placeholders['support_t']])
 
 	# Run single weight update
 	# outs = sess.run([model.opt_op, model.loss, model.rmse], feed_dict=train_feed_dict)
 	# with exponential moving averages
-	outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict)
+	with record.time('train'):
+		outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict)
+	train_step_times.append(record.times['train'])
+	record.count(edges=train_edges, pairs=train_pairs)
 
 	train_avg_loss = outs[1]
 	train_rmse = outs[2]
 
-	val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+	with record.time('eval'):
+		if validator.due(epoch, NB_EPOCH):
+			t_step = time.time()
+			validator.schedule(epoch)
+			val_step_times.append(time.time() - t_step)
 
-	# if train_avg_loss > 0.999*old_loss:
-	# 	consecutive += 1
-	# 	if consecutive >= consecutive_threshold:
-	# 		LR /= decay_rate
-	# 		sess.run(assign_op, feed_dict={assign_placeholder: LR})
-	# 		print('New learning rate is {}'.format(sess.run(model.optimizer._lr)))
-	# 		consecutive = 0
-	# else:
-	# 	consecutive = 0
-	# old_loss = train_avg_loss
+		if epoch == NB_EPOCH - 1:
+			validator.wait()
+
+		stop = record_validations()
+
+		if POLYAK_EVERY > 0 and (epoch + 1) % POLYAK_EVERY == 0:
+			# raw and Polyak-averaged parameters in one run, without touching the variables
+			_, raw_val_rmse, polyak_val_loss, polyak_val_rmse = polyak.evaluate(sess, val_feed_dict)
+		else:
+			polyak_val_rmse = None
 
 	if VERBOSE:
 		print("[*] Epoch:", '%04d' % (epoch + 1), "train_loss=", "{:.5f}".format(train_avg_loss),
@@ -518,74 +772,92 @@ for epoch in range(NB_EPOCH):
 			  "val_rmse=", "{:.5f}".format(val_rmse),
 			  "\t\ttime=", "{:.5f}".format(time.time() - t))
 
-	if val_rmse < best_val_score:
-		best_val_score = val_rmse
-		best_epoch = epoch
+		if polyak_val_rmse is not None:
+			print("[*] Polyak:", "val_rmse=", "{:.5f}".format(raw_val_rmse),
+				  "polyak_val_loss=", "{:.5f}".format(polyak_val_loss),
+				  "polyak_val_rmse=", "{:.5f}".format(polyak_val_rmse))
 
 	if epoch % 20 == 0 and WRITESUMMARY:
-		# Train set summary
-		summary = sess.run(merged_summary, feed_dict=train_feed_dict)
-		train_summary_writer.add_summary(summary, epoch)
-		train_summary_writer.flush()
+		with record.time('summary'):
+			# Train set summary
+			summary = sess.run(merged_summary, feed_dict=train_feed_dict)
+			train_summary_writer.add_summary(summary, epoch)
+			train_summary_writer.flush()
 
-		# Validation set summary
-		summary = sess.run(merged_summary, feed_dict=val_feed_dict)
-		val_summary_writer.add_summary(summary, epoch)
-		val_summary_writer.flush()
+			# Validation set summary
+			summary = sess.run(merged_summary, feed_dict=val_feed_dict)
+			val_summary_writer.add_summary(summary, epoch)
+			val_summary_writer.flush()
 
-	if epoch % 100 == 0 and epoch > 1000 and not TESTING and False:
-		saver = tf.train.Saver()
-		save_path = saver.save(sess, "tmp/%s_seed%d.ckpt" % (model.name, DATASEED), global_step=model.global_step)
+	if CHECKPOINT_EVERY > 0 and epoch > 0 and epoch % CHECKPOINT_EVERY == 0:
+		# snapshot only, the checkpoint is written in the background
+		checkpoints.save(epoch)
 
-		# load polyak averages
-		variables_to_restore = model.variable_averages.variables_to_restore()
-		saver = tf.train.Saver(variables_to_restore)
-		saver.restore(sess, save_path)
+	telemetry.write(record)
 
-		val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+	if stop:
+		break
 
-		print('polyak val loss = ', val_avg_loss)
-		print('polyak val rmse = ', val_rmse)
 
-		# Load back normal variables
-		saver = tf.train.Saver()
-		saver.restore(sess, save_path)
+# validations still queued after early stopping
+validator.close()
+record_validations()
 
-
-# store model including exponential moving averages
-saver = tf.train.Saver()
-save_path = saver.save(sess, "tmp/%s.ckpt" % model.name, global_step=model.global_step)
+# store model including exponential moving averages (the best one with --restore_best)
+controller.finish(checkpoints, epoch + 1)
 
 
 if VERBOSE:
 	print("\nOptimization Finished!")
 	print('best validation score =', best_val_score, 'at iteration', best_epoch)
+	if JIT:
+		print('XLA compile time = ', compile_time(train_step_times) + compile_time(val_step_times))
+	print('median train step time = ', np.median(train_step_times[1:] or train_step_times))
+	print('median val step time = ', np.median(val_step_times[1:] or val_step_times))
 
 
 if TESTING:
-	test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
+	# raw and polyak averages of parameters in one run
+	test_avg_loss, test_rmse, polyak_test_loss, polyak_test_rmse = polyak.evaluate(sess, test_feed_dict)
 	print('test loss = ', test_avg_loss)
 	print('test rmse = ', test_rmse)
-
-	# restore with polyak averages of parameters
-	variables_to_restore = model.variable_averages.variables_to_restore()
-	saver = tf.train.Saver(variables_to_restore)
-	saver.restore(sess, save_path)
-
-	test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
-	print('polyak test loss = ', test_avg_loss)
-	print('polyak test rmse = ', test_rmse)
+	print('polyak test loss = ', polyak_test_loss)
+	print('polyak test rmse = ', polyak_test_rmse)
 
 else:
-	# restore with polyak averages of parameters
-	variables_to_restore = model.variable_averages.variables_to_restore()
-	saver = tf.train.Saver(variables_to_restore)
-	saver.restore(sess, save_path)
-
-	val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+	_, _, val_avg_loss, val_rmse = polyak.evaluate(sess, val_feed_dict)
 	print('polyak val loss = ', val_avg_loss)
 	print('polyak val rmse = ', val_rmse)
 
+# load the polyak averages of parameters into the model, e.g. for the export
+polyak.load(sess)
+
+if EXPORTDIR is not None:
+	# the Polyak averages are loaded at this point
+	export_embeddings(sess, model, test_feed_dict if TESTING else val_feed_dict, class_values, EXPORTDIR,
+					  adj_train=adj_train, symmetric=SYM, num_user_side_features=num_user_side_features)
+
+	if INFERENCE_GRAPH == 'decoder':
+		export_decoder_graph(EXPORTDIR)
+	elif INFERENCE_GRAPH == 'full':
+		inference_feed_dict = dict(test_feed_dict if TESTING else val_feed_dict)
+		if FEATURES:
+			# side features of all nodes, the graph is queried with global user and item indices
+			inference_feed_dict.update({placeholders['u_features_side']: u_features_side,
+										placeholders['v_features_side']: v_features_side})
+		export_inference_graph(sess, model, placeholders, inference_feed_dict, class_values, EXPORTDIR)
+
+	if QUANTIZE is not None:
+		export_quantized(EXPORTDIR, QUANTIZE)
+		if TESTING:
+			accuracy_report(EXPORTDIR, QUANTIZE, test_u_indices, test_v_indices, class_values[test_labels])
+		else:
+			accuracy_report(EXPORTDIR, QUANTIZE, val_u_indices, val_v_indices, class_values[val_labels])
+
+checkpoints.close()
+print('Checkpoints saved in %s' % run_dir)
+telemetry.close(best_val_score=best_val_score, best_epoch=best_epoch)
+
 print('\nSETTINGS:\n')
 for key, val in sorted(vars(ap.parse_args()).items()):
 	print(key, val)
@@ -594,7 +866,13 @@ print('global seed = ', seed)
 
 # For parsing results from file
 results = vars(ap.parse_args()).copy()
-results.update({'best_val_score': float(best_val_score), 'best_epoch': best_epoch})
+results.update({'best_val_score': float(best_val_score), 'best_epoch': best_epoch, 'run_dir': run_dir})
+if TELEMETRY:
+	results.update({'telemetry': os.path.join(run_dir, TELEMETRY_FILE)})
+results.update({'train_step_time': float(np.median(train_step_times[1:] or train_step_times)),
+				'val_step_time': float(np.median(val_step_times[1:] or val_step_times))})
+if JIT:
+	results.update({'compile_time': compile_time(train_step_times) + compile_time(val_step_times)})
 print(json.dumps(results)) # dumps just dumps into a string, not for saving into a file
 
 sess.close()
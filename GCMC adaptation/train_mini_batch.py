@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import argparse
 import datetime
+import os
 import time
 
 import tensorflow as tf
@@ -13,11 +14,20 @@ import scipy.sparse as sp
 
 import json
 
-from gcmc.preprocessing import create_trainvaltest_split, \
-    sparse_to_tuple, preprocess_user_item_features, globally_normalize_bipartite_adjacency
-from gcmc.model import RecommenderGAE
-from gcmc.utils import construct_feed_dict
-from gcmc.data_utils import data_iterator
+from preprocessing import create_trainvaltest_split, load_data_monti, \
+    sparse_to_tuple, preprocess_user_item_features, globally_normalize_bipartite_adjacency, normalize_features
+from model import RecommenderGAE, RecommenderSideInfoGAE
+from utils import construct_feed_dict
+from resident import ResidentInputs
+from minibatch import SideFeatureStore, MinibatchBuilder, IncidenceMinibatchBuilder, BatchProducer
+from edge_dropout import EdgeDropout
+from checkpoints import CheckpointManager, default_run_dir
+from controller import TrainingController
+from validation import stratified_sample, SampledValidation
+from hogwild import HogwildTrainer
+from polyak import PolyakAverages
+from telemetry import Telemetry, batch_edges, FILENAME as TELEMETRY_FILE
+from execution import session_config, profile_key, resolve_profile, apply_cpu_affinity
 
 
 # Set random seed
@@ -28,7 +38,8 @@ tf.set_random_seed(seed)
 
 # Settings
 ap = argparse.ArgumentParser()
-ap.add_argument("-d", "--dataset", type=str, default="ml_1m", choices=['ml_100k', 'ml_1m', 'ml_10m'],
+ap.add_argument("-d", "--dataset", type=str, default="ml_1m",
+                choices=['ml_100k', 'ml_1m', 'ml_10m', 'douban', 'yahoo_music', 'flixster'],
                 help="Dataset string.")
 
 ap.add_argument("-lr", "--learning_rate", type=float, default=0.01,
@@ -37,27 +48,87 @@ ap.add_argument("-lr", "--learning_rate", type=float, default=0.01,
 ap.add_argument("-e", "--epochs", type=int, default=20,
                 help="Number training epochs")
 
+ap.add_argument("-pat", "--patience", type=int, default=0,
+                help="Stop after this many full validations without improvement, 0 to always train for all epochs.")
+
+ap.add_argument("-cons", "--consecutive", type=int, default=20,
+                help="Number of consecutive full validations without improvement before decaying learning rate")
+
+ap.add_argument("-dr", "--decay_rate", type=float, default=1.25,
+                help="Decay rate of learning rate")
+
 ap.add_argument("-hi", "--hidden", type=int, nargs=2, default=[500, 75],
                 help="Number hidden units in 1st and 2nd layer")
 
-ap.add_argument("-ac", "--accumulation", type=str, default="stack", choices=['sum', 'stack'],
-                help="Accumulation function: sum or stack.")
+ap.add_argument("-ac", "--accumulation", type=str, default="stack",
+                choices=['sum', 'stack', 'stackRGGCN', 'sumRGGCN', 'stackSimple'],
+                help="Accumulation function: sum or stack, or stackRGGCN, sumRGGCN or stackSimple on per-minibatch incidence matrices.")
+
+ap.add_argument("-numlay", "--num_layers", type=int, default=1,
+                help="Number of graph conv layers")
+
+ap.add_argument("-fhi", "--feat_hidden", type=int, default=64,
+                help="Number hidden units in the dense layer for features")
+
+ap.add_argument("-fmm", "--features_mmap", type=str, default=None,
+                help="Directory for memory-mapped side feature files, from which the rows of every minibatch are gathered (default: keep them sparse in memory).")
+
 ap.add_argument("-do", "--dropout", type=float, default=0.3,
                 help="Dropout fraction")
 ap.add_argument("-edo", "--edge_dropout", type=float, default=0.,
                 help="Edge dropout rate (1 - keep probability).")
+ap.add_argument("-mdeg", "--max_degree", type=int, default=None,
+                help="Maximum number of rating edges kept per item at every training step.")
+ap.add_argument("-fo", "--fanout", type=int, default=None,
+                help="Maximum number of edges sampled per user and item of a training minibatch for the RGGCN accumulations (default: all of them).")
 ap.add_argument("-nb", "--num_basis_functions", type=int, default=2,
                 help="Number of basis functions for Mixture Model GCN.")
 
+ap.add_argument("-dchunk", "--decoder_chunk_size", type=int, default=None,
+                help="Number of (user, item) pairs scored per chunk by the fused decoder. Implies --fused_decoder.")
+
 ap.add_argument("-ds", "--data_seed", type=int, default=1234,
                 help="Seed used to shuffle data in data_utils, taken from cf-nade (1234, 2341, 3412, 4123, 1324)")
 
+ap.add_argument("-rdir", "--run_dir", type=str, default=None,
+                help="Checkpoint directory of this run (default: a new directory under tmp/runs).")
+
+ap.add_argument("-ckpt", "--checkpoint_every", type=int, default=1000,
+                help="Write a checkpoint every n iterations, 0 to only keep the best and the final one.")
+
+ap.add_argument("-kc", "--keep_checkpoints", type=int, default=3,
+                help="Number of periodic checkpoints to keep.")
+
 ap.add_argument("-sdir", "--summaries_dir", type=str, default='logs/' + str(datetime.datetime.now()).replace(' ', '_'),
                 help="Dataset string ('ml_100k', 'ml_1m')")
 
 ap.add_argument("-bs", "--batch_size", type=int, default=10000,
                 help="Batch size used for batching loss function contributions.")
 
+ap.add_argument("-vsz", "--val_sample_size", type=int, default=0,
+                help="Number of validation pairs in a stratified subsample that is validated every --val_sample_every iterations, with a full validation only at epoch ends and when the subsample suggests a new best. 0 for a full validation after every iteration.")
+
+ap.add_argument("-vse", "--val_sample_every", type=int, default=20,
+                help="Number of iterations between validations on the subsample.")
+
+ap.add_argument("-nboot", "--num_bootstrap", type=int, default=200,
+                help="Number of bootstrap resamples for the confidence interval of the subsample RMSE.")
+
+ap.add_argument("-hw", "--hogwild_threads", type=int, default=1,
+                help="Number of trainer threads that run asynchronous (Hogwild) training steps in the same session, 1 for synchronous training.")
+
+ap.add_argument("-stale", "--max_staleness", type=int, default=None,
+                help="Maximum number of updates of other trainer threads applied during a Hogwild step (default: --hogwild_threads - 1).")
+
+ap.add_argument("-trmse", "--target_rmse", type=float, default=None,
+                help="Validation RMSE at which the time and number of iterations to reach it are reported.")
+
+ap.add_argument("-nw", "--num_workers", type=int, default=2,
+                help="Number of background threads that build minibatches.")
+
+ap.add_argument("-pf", "--prefetch", type=int, default=4,
+                help="Maximum number of minibatches built ahead of the training step.")
+
 # Boolean flags
 fp = ap.add_mutually_exclusive_group(required=False)
 fp.add_argument('-nsym', '--norm_symmetric', dest='norm_symmetric',
@@ -87,6 +158,47 @@ fp.add_argument('-v', '--validation', dest='testing',
                 help="Option to only use validation set evaluation", action='store_false')
 ap.set_defaults(testing=False)
 
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-fdec', '--fused_decoder', dest='fused_decoder',
+                help="Option to compute all bilinear basis scores of the decoder with a single matmul", action='store_true')
+fp.add_argument('-no_fdec', '--no_fused_decoder', dest='fused_decoder',
+                help="Option to compute the bilinear basis scores of the decoder one basis at a time", action='store_false')
+ap.set_defaults(fused_decoder=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-res', '--resident_inputs', dest='resident_inputs',
+                help="Option to load the static features into the session once instead of feeding them every step", action='store_true')
+fp.add_argument('-no_res', '--no_resident_inputs', dest='resident_inputs',
+                help="Option to feed all graph inputs at every step", action='store_false')
+ap.set_defaults(resident_inputs=True)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-plr', '--plateau_decay', dest='plateau_decay',
+                help="Option to divide the learning rate by --decay_rate after --consecutive validations without improvement", action='store_true')
+fp.add_argument('-no_plr', '--no_plateau_decay', dest='plateau_decay',
+                help="Option to keep the learning rate constant", action='store_false')
+ap.set_defaults(plateau_decay=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-rb', '--restore_best', dest='restore_best',
+                help="Option to continue from the best validation checkpoint (and its Polyak averages) after training", action='store_true')
+fp.add_argument('-no_rb', '--no_restore_best', dest='restore_best',
+                help="Option to continue from the last training step after training", action='store_false')
+ap.set_defaults(restore_best=False)
+
+fp = ap.add_mutually_exclusive_group(required=False)
+fp.add_argument('-tel', '--telemetry', dest='telemetry',
+                help="Option to write per-step phase times, throughput and peak memory to telemetry.jsonl in the run directory", action='store_true')
+fp.add_argument('-no_tel', '--no_telemetry', dest='telemetry',
+                help="Option to not write per-step telemetry", action='store_false')
+ap.set_defaults(telemetry=False)
+
+ap.add_argument('--autotune', action='store_true',
+                help='Option to benchmark TF thread pool sizes and store the fastest one for this dataset/accum/hidden')
+
+ap.add_argument('--pin_cpus', action='store_true',
+                help='Option to pin the process to as many CPUs (not used by other pinned runs) as threads of its tuned or stored execution profile')
+
 
 args = vars(ap.parse_args())
 
@@ -98,39 +210,87 @@ DATASET = args['dataset']
 DATASEED = args['data_seed']
 NB_EPOCH = args['epochs']
 DO = args['dropout']
+EDGE_DO = args['edge_dropout']
+MAX_DEGREE = args['max_degree']
+FANOUT = args['fanout']
 HIDDEN = args['hidden']
+FEATHIDDEN = args['feat_hidden']
+FEATURES_MMAP = args['features_mmap']
 BASES = args['num_basis_functions']
 LR = args['learning_rate']
 WRITESUMMARY = args['write_summary']
 SUMMARIESDIR = args['summaries_dir']
+RUNDIR = args['run_dir']
+CHECKPOINT_EVERY = args['checkpoint_every']
+KEEP_CHECKPOINTS = args['keep_checkpoints']
 FEATURES = args['features']
 TESTING = args['testing']
 BATCHSIZE = args['batch_size']
+VAL_SAMPLE_SIZE = args['val_sample_size']
+VAL_SAMPLE_EVERY = max(args['val_sample_every'], 1)
+NUM_BOOTSTRAP = args['num_bootstrap']
+HOGWILD_THREADS = args['hogwild_threads']
+MAX_STALENESS = args['max_staleness']
+TARGET_RMSE = args['target_rmse']
+NUM_WORKERS = args['num_workers']
+PREFETCH = args['prefetch']
 SYM = args['norm_symmetric']
 ACCUM = args['accumulation']
+NUM_LAYERS = args['num_layers']
+FUSED_DECODER = args['fused_decoder']
+DECODER_CHUNK = args['decoder_chunk_size']
+AUTOTUNE = args['autotune']
+PIN_CPUS = args['pin_cpus']
+RESIDENT = args['resident_inputs']
+PATIENCE = args['patience']
+consecutive_threshold = args['consecutive']
+decay_rate = args['decay_rate']
+PLATEAU_DECAY = args['plateau_decay']
+RESTORE_BEST = args['restore_best']
+TELEMETRY = args['telemetry']
+
+# the RGGCN layers take the minibatch subgraph as incidence matrices and feature rows
+EDGE_INPUTS = ACCUM in ('stackRGGCN', 'sumRGGCN', 'stackSimple')
 
 SELFCONNECTIONS = False
 SPLITFROMFILE = True
 VERBOSE = True
-if DATASET == 'ml_1m' or DATASET == 'ml_100k':
+if DATASET == 'ml_1m' or DATASET == 'ml_100k' or DATASET == 'douban':
     NUMCLASSES = 5
-elif DATASET == 'ml_10m':
+elif DATASET == 'ml_10m' or DATASET == 'flixster':
     NUMCLASSES = 10
+elif DATASET == 'yahoo_music':
+    NUMCLASSES = 71
 else:
     raise ValueError('Invalid choice of dataset: %s' % DATASET)
 
+if FEATURES and ACCUM not in ('sum', 'stack', 'stackRGGCN'):
+    raise ValueError('Side features can only be combined with --accumulation sum, stack or stackRGGCN, not %s' % ACCUM)
+
 # Splitting dataset in training, validation and test set
 
 if DATASET == 'ml_1m' or DATASET == 'ml_10m':
-    datasplit_path = 'data/' + DATASET + '/split_seed' + str(DATASEED) + '.pickle'
-elif DATASET == 'ml_100k':
+    if FEATURES:
+        datasplit_path = 'data/' + DATASET + '/withfeatures_split_seed' + str(DATASEED) + '.pickle'
+    else:
+        datasplit_path = 'data/' + DATASET + '/split_seed' + str(DATASEED) + '.pickle'
+elif FEATURES:
+    datasplit_path = 'data/' + DATASET + '/withfeatures.pickle'
+else:
     datasplit_path = 'data/' + DATASET + '/nofeatures.pickle'
 
 
-u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
-val_labels, val_u_indices, val_v_indices, test_labels, \
-test_u_indices, test_v_indices, class_values = create_trainvaltest_split(DATASET, DATASEED, TESTING,
-                                                                         datasplit_path, SPLITFROMFILE, VERBOSE)
+if DATASET == 'flixster' or DATASET == 'douban' or DATASET == 'yahoo_music':
+    u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
+        val_labels, val_u_indices, val_v_indices, test_labels, \
+        test_u_indices, test_v_indices, class_values = load_data_monti(DATASET, TESTING)
+
+else:
+    u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
+        val_labels, val_u_indices, val_v_indices, test_labels, \
+        test_u_indices, test_v_indices, class_values = create_trainvaltest_split(DATASET, DATASEED, TESTING,
+                                                                                 datasplit_path, SPLITFROMFILE,
+                                                                                 VERBOSE)
 
 # num_mini_batch = np.int(np.ceil(train_labels.shape[0]/float(BATCHSIZE)))
 num_mini_batch = train_labels.shape[0]//BATCHSIZE
@@ -138,6 +298,9 @@ print ('num mini batch = ', num_mini_batch)
 
 num_users, num_items = adj_train.shape
 
+num_side_features = 0
+side_features = None
+
 # feature loading
 if not FEATURES:
     u_features = sp.identity(num_users, format='csr')
@@ -145,8 +308,30 @@ if not FEATURES:
 
     u_features, v_features = preprocess_user_item_features(u_features, v_features)
 
+elif u_features is not None and v_features is not None:
+    # use features as side information and node_id's as node input features.
+    # The side features stay sparse (or on disk), every minibatch only gathers the rows of its nodes.
+
+    print("Normalizing feature vectors...")
+    u_features_side = normalize_features(u_features)
+    v_features_side = normalize_features(v_features)
+
+    u_features_side, v_features_side = preprocess_user_item_features(u_features_side, v_features_side)
+
+    if FEATURES_MMAP is not None:
+        side_features = SideFeatureStore.memmap(FEATURES_MMAP, u_features_side, v_features_side)
+    else:
+        side_features = SideFeatureStore(u_features_side, v_features_side)
+    del u_features_side, v_features_side
+
+    num_side_features = side_features.num_features
+
+    # node id's for node input features
+    u_features, v_features = preprocess_user_item_features(sp.identity(num_users, format='csr'),
+                                                           sp.identity(num_items, format='csr'))
+
 else:
-    raise ValueError('Features are not supported in this implementation.')
+    raise ValueError('Features flag is set to true but no features are loaded from dataset ' + DATASET)
 
 # global normalization
 support = []
@@ -170,37 +355,47 @@ num_support = len(support)
 support = sp.hstack(support, format='csr')
 support_t = sp.hstack(support_t, format='csr')
 
-# Collect all user and item nodes for test set
-test_u = list(set(test_u_indices))
-test_v = list(set(test_v_indices))
-test_u_dict = {n: i for i, n in enumerate(test_u)}
-test_v_dict = {n: i for i, n in enumerate(test_v)}
-
-test_u_indices = np.array([test_u_dict[o] for o in test_u_indices])
-test_v_indices = np.array([test_v_dict[o] for o in test_v_indices])
-
-test_support = support[np.array(test_u)]
-test_support_t = support_t[np.array(test_v)]
-
-# Collect all user and item nodes for validation set
-val_u = list(set(val_u_indices))
-val_v = list(set(val_v_indices))
-val_u_dict = {n: i for i, n in enumerate(val_u)}
-val_v_dict = {n: i for i, n in enumerate(val_v)}
-
-val_u_indices = np.array([val_u_dict[o] for o in val_u_indices])
-val_v_indices = np.array([val_v_dict[o] for o in val_v_indices])
-
-val_support = support[np.array(val_u)]
-val_support_t = support_t[np.array(val_v)]
+if EDGE_DO > 0. or MAX_DEGREE is not None:
+    edge_dropout = EdgeDropout(adj_train, NUMCLASSES, rate=EDGE_DO, max_degree=MAX_DEGREE, symmetric=SYM,
+                               self_connections=SELFCONNECTIONS)
+else:
+    edge_dropout = None
+
+# Training minibatches, and the validation and test sets, are fed as the subgraph of their
+# users and items. Edge dropout only applies to the training minibatches.
+if EDGE_INPUTS:
+    train_builder = IncidenceMinibatchBuilder(adj_train, NUMCLASSES, u_features, v_features, edge_dropout,
+                                              side_features, fanout=FANOUT)
+    eval_builder = IncidenceMinibatchBuilder(adj_train, NUMCLASSES, u_features, v_features,
+                                             side_features=side_features)
+else:
+    train_builder = MinibatchBuilder(support, support_t, edge_dropout, side_features)
+    eval_builder = MinibatchBuilder(support, support_t, side_features=side_features)
+
+val_batch = eval_builder.build(val_u_indices, val_v_indices, val_labels)
+if VAL_SAMPLE_SIZE > 0:
+    val_sample = stratified_sample(val_labels, VAL_SAMPLE_SIZE, seed=DATASEED)
+    val_sample_batch = eval_builder.build(val_u_indices[val_sample], val_v_indices[val_sample],
+                                          val_labels[val_sample])
+test_batch = eval_builder.build(test_u_indices, test_v_indices, test_labels)
+
+# the feature rows of the subgraph change from minibatch to minibatch with incidence matrices
+if EDGE_INPUTS:
+    u_features_shape = v_features_shape = (None, u_features.shape[1])
+else:
+    u_features_shape = np.array(u_features.shape, dtype=np.int64)
+    v_features_shape = np.array(v_features.shape, dtype=np.int64)
 
 placeholders = {
-    'u_features': tf.sparse_placeholder(tf.float32, shape=np.array(u_features.shape, dtype=np.int64)),
-    'v_features': tf.sparse_placeholder(tf.float32, shape=np.array(v_features.shape, dtype=np.int64)),
+    'u_features': tf.sparse_placeholder(tf.float32, shape=u_features_shape),
+    'v_features': tf.sparse_placeholder(tf.float32, shape=v_features_shape),
     'u_features_nonzero': tf.placeholder(tf.int32, shape=()),
     'v_features_nonzero': tf.placeholder(tf.int32, shape=()),
     'labels': tf.placeholder(tf.int32, shape=(None,)),
 
+    'u_features_side': tf.placeholder(tf.float32, shape=(None, num_side_features)),
+    'v_features_side': tf.placeholder(tf.float32, shape=(None, num_side_features)),
+
     'user_indices': tf.placeholder(tf.int32, shape=(None,)),
     'item_indices': tf.placeholder(tf.int32, shape=(None,)),
 
@@ -210,30 +405,65 @@ placeholders = {
 
     'support': tf.sparse_placeholder(tf.float32, shape=(None, None)),
     'support_t': tf.sparse_placeholder(tf.float32, shape=(None, None)),
+
+    'E_start_list': [],
+    'E_end_list': [],
 }
 
+if EDGE_INPUTS:
+    for i in range(num_support):
+        placeholders['E_start_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
+        placeholders['E_end_list'].append(tf.sparse_placeholder(tf.float32, shape=(None, None)))
+
+# the features stay the same for all minibatches (unless they are gathered per subgraph),
+# only the minibatch subgraph is fed
+if RESIDENT:
+    resident = ResidentInputs()
+    if not EDGE_INPUTS:
+        placeholders['u_features'] = resident.sparse('u_features')
+        placeholders['v_features'] = resident.sparse('v_features')
+        placeholders['u_features_nonzero'] = resident.dense('u_features_nonzero', tf.int32)
+        placeholders['v_features_nonzero'] = resident.dense('v_features_nonzero', tf.int32)
+    placeholders['class_values'] = resident.dense('class_values', tf.float32, class_values.shape)
+else:
+    resident = None
+
 # create model
-model = RecommenderGAE(placeholders,
-                       input_dim=u_features.shape[1],
-                       num_classes=NUMCLASSES,
-                       num_support=num_support,
-                       self_connections=SELFCONNECTIONS,
-                       num_basis_functions=BASES,
-                       hidden=HIDDEN,
-                       num_users=num_users,
-                       num_items=num_items,
-                       accum=ACCUM,
-                       learning_rate=LR,
-                       logging=True)
+if FEATURES:
+    model = RecommenderSideInfoGAE(placeholders,
+                                   input_dim=u_features.shape[1],
+                                   feat_hidden_dim=FEATHIDDEN,
+                                   num_classes=NUMCLASSES,
+                                   num_support=num_support,
+                                   self_connections=SELFCONNECTIONS,
+                                   num_basis_functions=BASES,
+                                   hidden=HIDDEN,
+                                   num_users=num_users,
+                                   num_items=num_items,
+                                   accum=ACCUM,
+                                   learning_rate=LR,
+                                   num_side_features=num_side_features,
+                                   fused_decoder=FUSED_DECODER,
+                                   decoder_chunk_size=DECODER_CHUNK,
+                                   logging=True)
+else:
+    model = RecommenderGAE(placeholders,
+                           input_dim=u_features.shape[1],
+                           num_classes=NUMCLASSES,
+                           num_support=num_support,
+                           self_connections=SELFCONNECTIONS,
+                           num_basis_functions=BASES,
+                           hidden=HIDDEN,
+                           num_users=num_users,
+                           num_items=num_items,
+                           accum=ACCUM,
+                           num_layers=NUM_LAYERS,
+                           learning_rate=LR,
+                           fused_decoder=FUSED_DECODER,
+                           decoder_chunk_size=DECODER_CHUNK,
+                           logging=True)
 
 # Convert sparse placeholders to tuples to construct feed_dict
-test_support = sparse_to_tuple(test_support)
-test_support_t = sparse_to_tuple(test_support_t)
-
-val_support = sparse_to_tuple(val_support)
-val_support_t = sparse_to_tuple(val_support_t)
-
-
 u_features = sparse_to_tuple(u_features)
 v_features = sparse_to_tuple(v_features)
 assert u_features[2][1] == v_features[2][1], 'Number of features of users and items must be the same!'
@@ -242,22 +472,70 @@ num_features = u_features[2][1]
 u_features_nonzero = u_features[1].shape[0]
 v_features_nonzero = v_features[1].shape[0]
 
+
+def batch_feed_dict(batch, dropout):
+    """ feed_dict of a subgraph built by the minibatch builder """
+    if EDGE_INPUTS:
+        return construct_feed_dict(placeholders, batch['u_features'], batch['v_features'],
+                                   batch['u_features_nonzero'], batch['v_features_nonzero'], None, None,
+                                   batch['labels'], batch['u_indices'], batch['v_indices'], class_values,
+                                   dropout, batch.get('u_features_side'), batch.get('v_features_side'),
+                                   E_start=batch['E_start'], E_end=batch['E_end'])
+    return construct_feed_dict(placeholders, u_features, v_features, u_features_nonzero, v_features_nonzero,
+                               batch['support'], batch['support_t'], batch['labels'], batch['u_indices'],
+                               batch['v_indices'], class_values, dropout, batch.get('u_features_side'),
+                               batch.get('v_features_side'))
+
+
 # Feed_dicts for validation and test set stay constant over different update steps
 # No dropout for validation and test runs
-val_feed_dict = construct_feed_dict(placeholders, u_features, v_features, u_features_nonzero,
-                                    v_features_nonzero, val_support, val_support_t,
-                                    val_labels, val_u_indices, val_v_indices, class_values, 0.)
+val_feed_dict = batch_feed_dict(val_batch, 0.)
+test_feed_dict = batch_feed_dict(test_batch, 0.)
+if VAL_SAMPLE_SIZE > 0:
+    val_sample_feed_dict = batch_feed_dict(val_sample_batch, 0.)
+else:
+    val_sample_feed_dict = None
 
-test_feed_dict = construct_feed_dict(placeholders, u_features, v_features, u_features_nonzero,
-                                     v_features_nonzero, test_support, test_support_t,
-                                     test_labels, test_u_indices, test_v_indices, class_values, 0.)
+# evaluation head and swap ops for the Polyak averages
+polyak = PolyakAverages(model)
 
 # Collect all variables to be logged into summary
 merged_summary = tf.summary.merge_all()
 
-sess = tf.Session()
+# thread pool sizes (and CPU pinning) stored for this configuration, tuned first if requested.
+# Tuning runs training steps on the first minibatch of the training pairs.
+if AUTOTUNE:
+    tune_feed_dict = batch_feed_dict(eval_builder.build(train_u_indices[:BATCHSIZE], train_v_indices[:BATCHSIZE],
+                                                        train_labels[:BATCHSIZE]), DO)
+else:
+    tune_feed_dict = None
+
+profile = resolve_profile(profile_key('mini_batch', DATASET, ACCUM, HIDDEN), [model.training_op, model.loss], tune_feed_dict,
+                          num_support, tune=AUTOTUNE, pin_cpus=PIN_CPUS)
+if profile is not None:
+    print('Using execution profile: {}'.format(profile))
+    apply_cpu_affinity(profile)
+
+sess = tf.Session(config=session_config(profile=profile))
 sess.run(tf.global_variables_initializer())
 
+if resident is not None:
+    # the inputs shared by all minibatches and splits
+    static_feed_dict = {placeholders['class_values']: class_values}
+    if not EDGE_INPUTS:
+        static_feed_dict.update({placeholders['u_features']: u_features,
+                                 placeholders['v_features']: v_features,
+                                 placeholders['u_features_nonzero']: u_features_nonzero,
+                                 placeholders['v_features_nonzero']: v_features_nonzero})
+    resident.load(sess, static_feed_dict)
+    for feed_dict in (val_feed_dict, test_feed_dict, val_sample_feed_dict):
+        if feed_dict is not None:
+            resident.strip(feed_dict)
+
+run_dir = RUNDIR if RUNDIR is not None else default_run_dir(model.name, DATASET)
+checkpoints = CheckpointManager(sess, model, run_dir, keep_last=KEEP_CHECKPOINTS)
+telemetry = Telemetry(os.path.join(run_dir, TELEMETRY_FILE) if TELEMETRY else None, settings=args)
+
 if WRITESUMMARY:
     train_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/train', sess.graph)
     val_summary_writer = tf.summary.FileWriter(SUMMARIESDIR + '/val')
@@ -270,136 +548,243 @@ best_val_loss = np.inf
 best_epoch = 0
 wait = 0
 
-print('Training...')
+controller = TrainingController(sess, model, LR, patience=PATIENCE,
+                                lr_patience=consecutive_threshold if PLATEAU_DECAY else 0, decay_rate=decay_rate,
+                                restore_best=RESTORE_BEST)
+stop = False
+iteration = 0
+
+if val_sample_feed_dict is not None:
+    sampled_validation = SampledValidation(sess, model, val_sample_feed_dict, val_sample_batch['labels'],
+                                           class_values, num_bootstrap=NUM_BOOTSTRAP, seed=DATASEED)
+    print('Validating %d of %d validation pairs every %d iterations' % (len(val_sample), len(val_labels),
+                                                                         VAL_SAMPLE_EVERY))
+    # the summaries of the validation set are written for the subsample too
+    val_summary_feed_dict = val_sample_feed_dict
+else:
+    sampled_validation = None
+    val_summary_feed_dict = val_feed_dict
 
-for epoch in range(NB_EPOCH):
+steps_to_target = None
+time_to_target = None
 
-    batch_iter = 0
-    data_iter = data_iterator([train_u_indices, train_v_indices, train_labels], batch_size=BATCHSIZE)
 
-    try:
-        while True:
-            t = time.time()
+def validate(step, sample, full_validation):
+    """
+    Validation after step: on the subsample if sample, and on the full validation set if
+    full_validation or the subsample scores better than the best full validation so far.
+    Best checkpoints, the target RMSE and early stopping only follow full validations.
+    :return: whether to stop training, and the validation entries of the log line
+    """
+    global best_val_score, best_epoch, steps_to_target, time_to_target
 
-            train_u_indices_batch, train_v_indices_batch, train_labels_batch = data_iter.next()
+    log = []
+    if sample:
+        sample_loss, sample_rmse, sample_lower, sample_upper = sampled_validation.evaluate()
+        full_validation = full_validation or sample_rmse < best_val_score
+        log += ["val_sample_loss=", "{:.5f}".format(sample_loss),
+                "val_sample_rmse=", "{:.5f}".format(sample_rmse),
+                "[{:.5f}, {:.5f}]".format(sample_lower, sample_upper)]
 
-            # Collect all user and item nodes for train set
-            train_u = list(set(train_u_indices_batch))
-            train_v = list(set(train_v_indices_batch))
-            train_u_dict = {n: i for i, n in enumerate(train_u)}
-            train_v_dict = {n: i for i, n in enumerate(train_v)}
+    if not full_validation:
+        return False, log
 
-            train_u_indices_batch = np.array([train_u_dict[o] for o in train_u_indices_batch])
-            train_v_indices_batch = np.array([train_v_dict[o] for o in train_v_indices_batch])
+    val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+    log += ["val_loss=", "{:.5f}".format(val_avg_loss),
+            "val_rmse=", "{:.5f}".format(val_rmse)]
 
-            train_support_batch = sparse_to_tuple(support[np.array(train_u)])
-            train_support_t_batch = sparse_to_tuple(support_t[np.array(train_v)])
+    if val_rmse < best_val_score:
+        best_val_score = val_rmse
+        best_epoch = step
+        checkpoints.save_best(best_epoch, val_rmse)
 
-            train_feed_dict_batch = construct_feed_dict(placeholders, u_features, v_features, u_features_nonzero,
-                                                        v_features_nonzero,
-                                                        train_support_batch,
-                                                        train_support_t_batch,
-                                                        train_labels_batch, train_u_indices_batch,
-                                                        train_v_indices_batch, class_values, DO)
+    if TARGET_RMSE is not None and steps_to_target is None and val_rmse <= TARGET_RMSE:
+        steps_to_target = step + 1
+        time_to_target = time.time() - train_start
 
-            # with exponential moving averages
-            outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict_batch)
+    # early stopping and plateau learning rate decay
+    return controller.update(step, val_rmse), log
+
+
+def train_feed_dict(batch):
+    feed_dict = batch_feed_dict(batch, DO)
+    if resident is not None:
+        resident.strip(feed_dict)
+    return feed_dict
+
+
+print('Training...')
+
+# minibatch subgraphs are built on background threads while the training steps run
+producer = BatchProducer(train_builder, train_u_indices, train_v_indices, train_labels, BATCHSIZE, NB_EPOCH,
+                         num_workers=NUM_WORKERS, prefetch=PREFETCH)
+
+train_start = time.time()
+hogwild_report = None
+
+if HOGWILD_THREADS > 1:
+    # the trainer threads train asynchronously, this thread validates every VAL_SAMPLE_EVERY
+    # iterations: on the subsample, or on the full validation set without one, and on the
+    # full validation set after every epoch
+    trainer = HogwildTrainer(sess, [model.training_op, model.loss, model.rmse], producer, train_feed_dict,
+                             HOGWILD_THREADS, MAX_STALENESS, telemetry=telemetry)
+    print('Hogwild training with %d threads, maximum staleness %d' % (HOGWILD_THREADS, trainer.max_staleness))
+    trainer.start()
+
+    completed = 0
+    running = True
+    t = time.time()
+    while running and not stop:
+        previous = completed
+        completed, running = trainer.wait_for(completed + VAL_SAMPLE_EVERY)
+        if completed == previous:
+            break
+        iteration = completed - 1
+        epoch_end = completed // num_mini_batch > previous // num_mini_batch or not running
+
+        train_avg_loss, train_rmse = trainer.last_outputs[1:]
+        # the records of this thread only hold validation and summaries, the steps are written by the trainers
+        record = telemetry.step(iteration, thread='main')
+        with record.time('eval'):
+            stop, val_log = validate(iteration, sampled_validation is not None,
+                                     sampled_validation is None or epoch_end)
+
+        if VERBOSE:
+            print(*(['[*] Iteration: %04d' % iteration, " Epoch:", '%04d' % (iteration // num_mini_batch),
+                     "train_loss=", "{:.5f}".format(train_avg_loss),
+                     "train_rmse=", "{:.5f}".format(train_rmse)] + val_log +
+                    ["\t\ttime=", "{:.5f}".format(time.time() - t)]))
+
+        if WRITESUMMARY:
+            with record.time('summary'):
+                # Validation set summary, the training minibatches belong to the trainer threads
+                summary = sess.run(merged_summary, feed_dict=val_summary_feed_dict)
+                val_summary_writer.add_summary(summary, iteration)
+                val_summary_writer.flush()
+
+        if CHECKPOINT_EVERY > 0 and completed // CHECKPOINT_EVERY > previous // CHECKPOINT_EVERY:
+            # snapshot only, the checkpoint is written in the background
+            checkpoints.save(iteration)
 
-            train_avg_loss = outs[1]
-            train_rmse = outs[2]
+        telemetry.write(record)
 
-            val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+        t = time.time()
 
-            if VERBOSE:
-                print('[*] Iteration: %04d' % (epoch*num_mini_batch + batch_iter),  " Epoch:", '%04d' % epoch,
-                      "minibatch iter:", '%04d' % batch_iter,
-                      "train_loss=", "{:.5f}".format(train_avg_loss),
-                      "train_rmse=", "{:.5f}".format(train_rmse),
-                      "val_loss=", "{:.5f}".format(val_avg_loss),
-                      "val_rmse=", "{:.5f}".format(val_rmse),
-                      "\t\ttime=", "{:.5f}".format(time.time() - t))
+    trainer.stop()
+    hogwild_report = trainer.report()
+    for i, thread in enumerate(hogwild_report['threads']):
+        print('thread %d: %d steps, %.2f steps/sec, %.0f pairs/sec, busy %.2f, staleness mean %.2f max %d'
+              % (i, thread['steps'], thread['steps_per_sec'], thread['pairs_per_sec'], thread['busy_fraction'],
+                 thread['mean_staleness'], thread['max_staleness']))
 
-            if val_rmse < best_val_score:
-                best_val_score = val_rmse
-                best_epoch = epoch*num_mini_batch + batch_iter
+else:
+    t = time.time()
+    for epoch, batch_iter, batch in producer:
+
+        step = epoch*num_mini_batch + batch_iter
+
+        # the batch was built on a producer thread, this thread only waited for it
+        record = telemetry.step(step, epoch=epoch, build_time=batch.get('build_time'))
+        record.add('batch', time.time() - t)
 
-            if batch_iter % 20 == 0 and WRITESUMMARY:
+        with record.time('feed'):
+            train_feed_dict_batch = train_feed_dict(batch)
+
+        # with exponential moving averages
+        with record.time('train'):
+            outs = sess.run([model.training_op, model.loss, model.rmse], feed_dict=train_feed_dict_batch)
+        record.count(edges=batch_edges(batch), pairs=len(batch['labels']))
+
+        train_avg_loss = outs[1]
+        train_rmse = outs[2]
+
+        # full validation after every iteration, or with a subsample only at the end of an epoch
+        # and when the subsample scores better than the best full validation so far
+        with record.time('eval'):
+            stop, val_log = validate(step, sampled_validation is not None and (step + 1) % VAL_SAMPLE_EVERY == 0,
+                                     sampled_validation is None or batch_iter == num_mini_batch - 1)
+
+        if VERBOSE:
+            print(*(['[*] Iteration: %04d' % step, " Epoch:", '%04d' % epoch,
+                     "minibatch iter:", '%04d' % batch_iter,
+                     "train_loss=", "{:.5f}".format(train_avg_loss),
+                     "train_rmse=", "{:.5f}".format(train_rmse)] + val_log +
+                    ["\t\ttime=", "{:.5f}".format(time.time() - t)]))
+
+        if batch_iter % 20 == 0 and WRITESUMMARY:
+            with record.time('summary'):
                 # Train set summary
                 summary = sess.run(merged_summary, feed_dict=train_feed_dict_batch)
                 train_summary_writer.add_summary(summary, epoch*num_mini_batch+batch_iter)
                 train_summary_writer.flush()
 
                 # Validation set summary
-                summary = sess.run(merged_summary, feed_dict=val_feed_dict)
+                summary = sess.run(merged_summary, feed_dict=val_summary_feed_dict)
                 val_summary_writer.add_summary(summary, epoch*num_mini_batch+batch_iter)
                 val_summary_writer.flush()
 
-            if epoch*num_mini_batch+batch_iter % 100 == 0 and not TESTING and False:
-                saver = tf.train.Saver()
-                save_path = saver.save(sess, "tmp/%s_seed%d.ckpt" % (model.name, DATASEED), global_step=model.global_step)
-
-                # load polyak averages
-                variables_to_restore = model.variable_averages.variables_to_restore()
-                saver = tf.train.Saver(variables_to_restore)
-                saver.restore(sess, save_path)
+        iteration = max(iteration, epoch*num_mini_batch + batch_iter)
+        if CHECKPOINT_EVERY > 0 and iteration > 0 and iteration % CHECKPOINT_EVERY == 0:
+            # snapshot only, the checkpoint is written in the background
+            checkpoints.save(iteration)
 
-                val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+        telemetry.write(record)
 
-                print('polyak val loss = ', val_avg_loss)
-                print('polyak val rmse = ', val_rmse)
+        if stop:
+            break
 
-                # load back normal variables
-                saver = tf.train.Saver()
-                saver.restore(sess, save_path)
+        # the time of an iteration includes waiting for its minibatch
+        t = time.time()
 
-            batch_iter += 1
+    producer.close()
 
-    except StopIteration:
-        pass
+train_time = time.time() - train_start
+steps_per_sec = (iteration + 1) / train_time
 
-# store model including exponential moving averages
-saver = tf.train.Saver()
-save_path = saver.save(sess, "tmp/%s.ckpt" % model.name, global_step=model.global_step)
+# store model including exponential moving averages (the best one with --restore_best)
+controller.finish(checkpoints, iteration + 1)
 
 
 if VERBOSE:
     print("\nOptimization Finished!")
     print('best validation score =', best_val_score, 'at iteration', best_epoch)
+    print('%.2f iterations/sec over %.1f sec' % (steps_per_sec, train_time))
+    if TARGET_RMSE is not None:
+        print('target validation rmse', TARGET_RMSE, 'reached after', time_to_target, 'sec at iteration',
+              steps_to_target)
 
 
 if TESTING:
-    test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
+    # raw and polyak averages of parameters in one run
+    test_avg_loss, test_rmse, polyak_test_loss, polyak_test_rmse = polyak.evaluate(sess, test_feed_dict)
     print('test loss = ', test_avg_loss)
     print('test rmse = ', test_rmse)
-
-    # restore with polyak averages of parameters
-    variables_to_restore = model.variable_averages.variables_to_restore()
-    saver = tf.train.Saver(variables_to_restore)
-    saver.restore(sess, save_path)
-
-    test_avg_loss, test_rmse = sess.run([model.loss, model.rmse], feed_dict=test_feed_dict)
-    print('polyak test loss = ', test_avg_loss)
-    print('polyak test rmse = ', test_rmse)
+    print('polyak test loss = ', polyak_test_loss)
+    print('polyak test rmse = ', polyak_test_rmse)
 
 else:
-    # restore with polyak averages of parameters
-    variables_to_restore = model.variable_averages.variables_to_restore()
-    saver = tf.train.Saver(variables_to_restore)
-    saver.restore(sess, save_path)
-
-    val_avg_loss, val_rmse = sess.run([model.loss, model.rmse], feed_dict=val_feed_dict)
+    _, _, val_avg_loss, val_rmse = polyak.evaluate(sess, val_feed_dict)
     print('polyak val loss = ', val_avg_loss)
     print('polyak val rmse = ', val_rmse)
 
+checkpoints.close()
+telemetry.close(best_val_score=best_val_score, best_epoch=best_epoch, steps_per_sec=steps_per_sec)
+print('Checkpoints saved in %s' % run_dir)
+
 print('\nSETTINGS:\n')
-for key, val in sorted(vars(ap.parse_args()).iteritems()):
+for key, val in sorted(vars(ap.parse_args()).items()):
     print(key, val)
 
 print('global seed = ', seed)
 
 # For parsing results from file
 results = vars(ap.parse_args()).copy()
-results.update({'best_val_score': float(best_val_score), 'best_epoch': best_epoch})
+results.update({'best_val_score': float(best_val_score), 'best_epoch': best_epoch, 'run_dir': run_dir,
+                'steps_per_sec': steps_per_sec, 'train_time': train_time,
+                'steps_to_target': steps_to_target, 'time_to_target': time_to_target,
+                'hogwild': hogwild_report})
+if TELEMETRY:
+    results.update({'telemetry': os.path.join(run_dir, TELEMETRY_FILE)})
 print(json.dumps(results))
 
 sess.close()
@@ -14,8 +14,9 @@ def construct_feed_dict(placeholders, u_features, v_features, u_features_nonzero
     feed_dict.update({placeholders['v_features']: v_features})
     feed_dict.update({placeholders['u_features_nonzero']: u_features_nonzero})
     feed_dict.update({placeholders['v_features_nonzero']: v_features_nonzero})
-    feed_dict.update({placeholders['support']: support})
-    feed_dict.update({placeholders['support_t']: support_t})
+    if (support is not None) and (support_t is not None):
+        feed_dict.update({placeholders['support']: support})
+        feed_dict.update({placeholders['support_t']: support_t})
 
     feed_dict.update({placeholders['labels']: labels})
     feed_dict.update({placeholders['user_indices']: u_indices})
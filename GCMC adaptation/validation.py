@@ -0,0 +1,193 @@
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from polyak import copy_forward
+from topk import softmax
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ValidationScheduler(object):
+    """
+    Runs the validation fetches (loss and rmse) every `every` epochs.
+
+    Synchronously, they are run in the training session right away. Asynchronously, the
+    variable values are copied (snapshot) and a background thread evaluates the copy while
+    training continues: a copy of the forward pass of the fetches in the training graph, in
+    which the trainable variables are replaced by placeholders fed from the snapshot, and
+    which shares the non-trainable variables (e.g. resident inputs) and the placeholders
+    with the model, so it is fed the same feed_dict and copies none of the inputs. Results are
+    returned in epoch order by poll, with the snapshot they belong to, so that the
+    best-epoch bookkeeping and best checkpoints refer to the evaluated parameters.
+    At most one snapshot waits for evaluation, schedule blocks if validation falls behind.
+    """
+
+    def __init__(self, sess, model, feed_dict, every=1, asynchronous=False, snapshot=None, name='async_validation'):
+        """
+        :param snapshot: function returning the values of all variables as a dict from variable
+            name to array, e.g. CheckpointManager.snapshot. Required for asynchronous validation.
+        """
+        self.sess = sess
+        self.feed_dict = feed_dict
+        self.every = max(every, 1)
+        self.asynchronous = asynchronous
+        self.snapshot = snapshot
+        self.fetches = [model.loss, model.rmse]
+
+        self._results = []
+        self._lock = threading.Lock()
+
+        if asynchronous:
+            assert snapshot is not None, 'asynchronous validation needs a snapshot function'
+            self._build_eval_head(name)
+            self._jobs = queue.Queue(maxsize=1)
+            self._error = None
+            self._worker = threading.Thread(target=self._eval_loop)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _build_eval_head(self, name):
+        with self.sess.graph.as_default():
+            self.variable_names = []
+            self.placeholders = []
+            replacements = {}
+            with tf.name_scope(name + '_snapshot'):
+                for v in tf.trainable_variables():
+                    placeholder = tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                    replacements[v.op.name] = placeholder
+                    self.variable_names.append(v.op.name)
+                    self.placeholders.append(placeholder)
+            self.eval_fetches = copy_forward(self.fetches, replacements, name)
+
+    def _eval_loop(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                epoch, values = job
+                feed_dict = dict(self.feed_dict)
+                for name, placeholder in zip(self.variable_names, self.placeholders):
+                    feed_dict[placeholder] = values[name]
+                outputs = self.sess.run(self.eval_fetches, feed_dict=feed_dict)
+                with self._lock:
+                    self._results.append((epoch, outputs, values))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _check_error(self):
+        if self.asynchronous and self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def due(self, epoch, num_epochs):
+        """ Whether validation runs after epoch (0-based), always after the last one. """
+        return (epoch + 1) % self.every == 0 or epoch == num_epochs - 1
+
+    def schedule(self, epoch):
+        """ Validates the current parameters as those of epoch. """
+        self._check_error()
+        if self.asynchronous:
+            self._jobs.put((epoch, self.snapshot()))
+        else:
+            outputs = self.sess.run(self.fetches, feed_dict=self.feed_dict)
+            self._results.append((epoch, outputs, None))
+
+    def poll(self):
+        """ Finished validations as (epoch, [loss, rmse], snapshot or None) in epoch order. """
+        self._check_error()
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def wait(self):
+        """ Blocks until all scheduled validations are finished. """
+        if self.asynchronous:
+            self._jobs.join()
+        self._check_error()
+
+    def close(self):
+        if self.asynchronous:
+            self.wait()
+            self._jobs.put(None)
+            self._worker.join()
+
+
+def stratified_sample(labels, size, seed=0):
+    """
+    Indices of a random subsample of about size pairs, stratified by rating class: every
+    class keeps its share of the pairs, and at least one pair.
+    """
+    labels = np.asarray(labels)
+    if size >= labels.shape[0]:
+        return np.arange(labels.shape[0])
+
+    random = np.random.RandomState(seed)
+    fraction = size / labels.shape[0]
+    sample = []
+    for label in np.unique(labels):
+        idx = np.flatnonzero(labels == label)
+        count = max(int(round(fraction * idx.shape[0])), 1)
+        sample.append(random.choice(idx, count, replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def bootstrap_rmse(squared_errors, num_bootstrap=200, confidence=0.95, random=None):
+    """
+    RMSE of the squared errors of a sample, with a percentile bootstrap confidence interval.
+    :return: rmse, lower bound, upper bound
+    """
+    squared_errors = np.asarray(squared_errors, dtype=np.float64)
+    rmse = float(np.sqrt(squared_errors.mean()))
+    if num_bootstrap <= 0:
+        return rmse, rmse, rmse
+
+    random = random if random is not None else np.random.RandomState(0)
+    n = squared_errors.shape[0]
+    # the mean of a resample from the counts of every pair, without materializing resamples
+    counts = random.multinomial(n, np.full(n, 1. / n), size=num_bootstrap)
+    rmses = np.sqrt(counts.dot(squared_errors) / n)
+    tail = 100. * (1. - confidence) / 2.
+    lower, upper = np.percentile(rmses, [tail, 100. - tail])
+    return rmse, float(lower), float(upper)
+
+
+class SampledValidation(object):
+    """
+    Validation on a fixed subsample of the validation pairs (e.g. from stratified_sample),
+    much cheaper than a pass over the whole validation set. evaluate returns the loss and
+    the RMSE on the subsample with a bootstrap confidence interval over its pairs, so a
+    change of the sampled RMSE can be told apart from sampling noise.
+    """
+
+    def __init__(self, sess, model, feed_dict, labels, class_values, num_bootstrap=200, confidence=0.95, seed=0):
+        """
+        :param feed_dict: feed_dict of the subsample, without dropout
+        :param labels: class indices of the pairs of the subsample
+        """
+        self.sess = sess
+        self.feed_dict = feed_dict
+        self.fetches = [model.loss, model.outputs]
+        self.class_values = np.asarray(class_values, dtype=np.float64)
+        self.ratings = self.class_values[np.asarray(labels)]
+        self.num_bootstrap = num_bootstrap
+        self.confidence = confidence
+        self.random = np.random.RandomState(seed)
+
+    def evaluate(self):
+        """ :return: loss, rmse, lower and upper bound of the rmse confidence interval """
+        loss, logits = self.sess.run(self.fetches, feed_dict=self.feed_dict)
+        predictions = softmax(logits.astype(np.float64), axis=1).dot(self.class_values)
+        rmse, lower, upper = bootstrap_rmse((predictions - self.ratings) ** 2, self.num_bootstrap,
+                                            self.confidence, self.random)
+        return loss, rmse, lower, upper